@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import warnings
+import numpy as np
+import torch
+
+# Compiled training samples (training.py --cache): the samples of a training config (error, edge types, sample
+# cap) are preprocessed once and written as tensor files, which later runs read instead of the gzip pickles.
+# One directory per config, holding:
+#   index.json                  fingerprint of the sources, the walk of the student directories (see below), then
+#                               every sample's split, shard, offsets in the shard, labels, variables (vars2id of
+#                               both sides) and var_map file
+#   shard-NNNNN-nodes.npy       node types of the shard's samples, left then right side of each (int64)
+#   shard-NNNNN-edges.npy       [edges, 2] edges of the shard's samples, same order (int64)
+#   shard-NNNNN-edge_types.npy  relation of every edge (int64)
+# The .npy files are memory-mapped (np.load(mmap_mode="r")) and the samples' tensors are views of them, so a
+# cached dataset is read as training touches it. The samples' ASTs are reduced to their vars2id, all that training
+# reads from them.
+# The fingerprint covers the config and the path, size and modification time of every source file, in order: a
+# new, changed or removed sample rebuilds the cache. index.json is written last, so a cache whose writing was
+# interrupted is rebuilt too.
+# training.py finds the samples by walking the student directories (rglob) and shuffling their var_map files. The
+# index also keeps the student directories and the modification time of every directory under them: when the same
+# student directories are asked for and no directory nor source file changed (a var_map file added or removed
+# changes its directory's time), read_walked returns the samples without the walk, with the split and the order
+# the walk gave them (the order of the index entries).
+
+shard_size = 4096
+fields = ["nodes", "edges", "edge_types"]
+
+
+def fingerprint(config, files):
+    h = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+    for path in files:
+        stat = os.stat(path)
+        h.update("{p}\0{s}\0{m}\n".format(p=os.path.abspath(path), s=stat.st_size, m=stat.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def directory_times(student_dirs):
+    # {directory: modification time} of the student directories and every directory under them
+    times = {}
+    for student_dir in student_dirs:
+        for directory, _, _ in os.walk(student_dir):
+            times[directory] = os.stat(directory).st_mtime_ns
+    return times
+
+
+def cache_directory(cache_dir, config):
+    return os.path.join(cache_dir, "_".join("{k}{v}".format(k=k, v="-".join(map(str, v)) if isinstance(v, list) else v) for k, v in sorted(config.items())))
+
+
+def save_array(path, array):
+    # written under another name first, so that a path either holds a whole array or nothing
+    with open(path + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def write_index(directory, index):
+    with open(os.path.join(directory, "index.json.tmp"), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(directory, "index.json.tmp"), os.path.join(directory, "index.json"))
+
+
+def write_cache(directory, key, splits, walk=None):
+    # splits is a list of sample lists (e.g. [train samples, validation samples]), walk the walk of the student
+    # directories the samples were found by (see load_or_compile)
+    os.makedirs(directory, exist_ok=True)
+    samples = [(split, sample) for split, split_samples in enumerate(splits) for sample in split_samples]
+    entries = []
+    for shard, start in enumerate(range(0, len(samples), shard_size)):
+        arrays = {field: [] for field in fields}
+        offsets = {field: 0 for field in fields}
+        for split, sample in samples[start:start + shard_size]:
+            entry = {"split": split, "shard": shard, "labels": [int(l) for l in sample[2]], "spec": str(sample[3])}
+            for side, name in [(sample[0], "left"), (sample[1], "right")]:
+                side_arrays = {"nodes": np.asarray(side[0], dtype=np.int64).reshape(-1),
+                               "edges": np.asarray(side[1], dtype=np.int64).reshape(-1, 2),
+                               "edge_types": np.asarray(side[2], dtype=np.int64).reshape(-1)}
+                for field in fields:
+                    arrays[field].append(side_arrays[field])
+                    entry[name + "_" + field] = [offsets[field], offsets[field] + len(side_arrays[field])]
+                    offsets[field] += len(side_arrays[field])
+                entry[name + "_vars"] = [[k, int(v)] for k, v in side[3]['vars2id'].items()]
+            entries.append(entry)
+
+        for field in fields:
+            empty = np.zeros((0, 2) if field == "edges" else 0, dtype=np.int64)
+            save_array(os.path.join(directory, "shard-{s:05d}-{f}.npy".format(s=shard, f=field)), np.concatenate(arrays[field] or [empty]))
+
+    write_index(directory, {"fingerprint": key, "walk": walk, "shards": (len(samples) + shard_size - 1) // shard_size, "samples": entries})
+
+
+def read_index(directory):
+    try:
+        with open(os.path.join(directory, "index.json"), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_samples(directory, index, num_splits):
+    # the sample lists of index
+    with warnings.catch_warnings():
+        # the tensors are views of read-only memory maps, which training never writes
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        shards = [{field: torch.from_numpy(np.load(os.path.join(directory, "shard-{s:05d}-{f}.npy".format(s=shard, f=field)), mmap_mode="r"))
+                   for field in fields} for shard in range(index["shards"])]
+    splits = [[] for _ in range(num_splits)]
+    for entry in index["samples"]:
+        arrays = shards[entry["shard"]]
+        sides = []
+        for name in ["left", "right"]:
+            sides.append(tuple(arrays[field][slice(*entry[name + "_" + field])] for field in fields) + ({'vars2id': dict(entry[name + "_vars"])},))
+        splits[entry["split"]].append((sides[0], sides[1], entry["labels"], Path(entry["spec"])))
+
+    return splits
+
+
+def read_walked(cache_dir, config, student_dirs, num_splits):
+    # sample lists of the cache of config when it was built from the walk of the same student directories and
+    # neither these nor the source files changed since; None otherwise
+    directory = cache_directory(cache_dir, config)
+    index = read_index(directory)
+    walk = index and index.get("walk")
+    if not walk or walk["student_dirs"] != [str(d) for d in student_dirs]:
+        return None
+    try:
+        if any(os.stat(d).st_mtime_ns != t for d, t in walk["directories"].items()):
+            return None
+        if fingerprint(config, walk["sources"]) != index["fingerprint"]:
+            return None
+    except OSError:
+        return None
+
+    print("Training samples read from the cache {d}".format(d=directory))
+    return read_samples(directory, index, num_splits)
+
+
+def load_or_compile(cache_dir, config, split_files, load_samples, student_dirs=()):
+    # split_files has the (var_map file, incorrect AST file, correct AST file) of every sample of every split;
+    # load_samples(files) preprocesses the samples of a split when the cache has to be (re)built. student_dirs
+    # are the directories walked to find the samples, for read_walked on the next runs
+    directory = cache_directory(cache_dir, config)
+    sources = [str(path) for files in split_files for sample_files in files for path in sample_files]
+    key = fingerprint(config, sources)
+    walk = {"student_dirs": [str(d) for d in student_dirs], "directories": directory_times(student_dirs),
+            "sources": sources}
+
+    index = read_index(directory)
+    if index is not None and index.get("fingerprint") == key:
+        print("Training samples read from the cache {d}".format(d=directory))
+        if index.get("walk") != walk:
+            index["walk"] = walk
+            write_index(directory, index)
+        return read_samples(directory, index, len(split_files))
+
+    splits = [load_samples(files) for files in split_files]
+    write_cache(directory, key, splits, walk)
+    print("Training samples compiled into the cache {d}".format(d=directory))
+    return splits
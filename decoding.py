@@ -0,0 +1,41 @@
+# How the [left vars, right vars] scores of a pair are turned into a variable mapping, shared by the torch and NumPy
+# engines, the ensembles and the tiered mapper:
+#   argmax      every incorrect program's variable independently takes its best scoring correct program's variable
+#   assignment  maximum-weight bipartite assignment, so no two variables are mapped to the same one. This only holds
+#               while the incorrect program has at most as many variables as the correct one: the extra variables
+#               keep their argmax, so they share a counterpart with an assigned variable.
+decodings = ["argmax", "assignment"]
+
+
+def assignment(scores):
+    # maximum-weight bipartite assignment over the [left vars, right vars] scores. When the incorrect program has
+    # more variables than the correct one, the variables left unassigned keep their argmax.
+    from scipy.optimize import linear_sum_assignment
+
+    rows, cols = linear_sum_assignment(scores, maximize=True)
+    indices = scores.argmax(axis=1).tolist()
+    for r, c in zip(rows, cols):
+        indices[r] = int(c)
+
+    return indices, float(scores[range(len(indices)), indices].sum())
+
+
+def decode_scores(scores, left_ast, right_ast, decoding="argmax"):
+    # same var_map and var_map_dist as VariableMappingGNN.decode, from a [left vars, right vars] array
+    if decoding not in decodings:
+        raise ValueError("Unknown decoding {d}, use one of: {l}".format(d=decoding, l=", ".join(decodings)))
+    if decoding == "assignment":
+        indices, _ = assignment(scores)
+    else:
+        indices = scores.argmax(axis=1).tolist()
+
+    vars_left_list = [k for k in left_ast['vars2id']]
+    vars_right_list = [k for k in right_ast['vars2id']]
+
+    varmap_result = {}
+    varmap_dist = {}
+    for e, k in enumerate(vars_left_list):
+        varmap_result[k] = vars_right_list[indices[e]]
+        varmap_dist[k] = (scores[e:e + 1].tolist(), vars_right_list)
+
+    return varmap_result, varmap_dist
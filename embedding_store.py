@@ -0,0 +1,160 @@
+from collections import OrderedDict
+import fcntl
+import hashlib
+import os
+import threading
+import numpy as np
+import torch
+
+# On-disk layout, one directory per model (named after the hash of its weights, so a retrained model
+# never reads the embeddings of an older one):
+#   embeddings.f32  every stored node embedding matrix, appended one after the other (float32, {channels} columns)
+#   index.txt       one "<graph key> <first row> <number of rows>" line per stored graph
+
+
+def state_tensors(value):
+    # the tensors of a state_dict entry; the quantized Linear layers of quantization.py keep (weight, bias) tuples
+    # of packed params and their dtype
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [t for v in value for t in state_tensors(v)]
+    return []
+
+
+def tensor_bytes(t):
+    t = t.detach().cpu()
+    if t.is_quantized:
+        if t.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+            scales = t.q_per_channel_scales().double()
+        else:
+            scales = torch.tensor([t.q_scale()], dtype=torch.float64)
+        return t.int_repr().numpy().tobytes() + scales.numpy().tobytes()
+    # NumPy has no bfloat16; float32 tensors hash as before
+    if t.is_floating_point():
+        t = t.float()
+    return t.numpy().tobytes()
+
+
+def weights_hash(model):
+    h = hashlib.sha1()
+    h.update(str(model.message_passing_rounds).encode())
+    # a reduced precision (eval.py --precision) gives other embeddings than the fp32 weights it was made from
+    if getattr(model, "precision", "fp32") != "fp32":
+        h.update(model.precision.encode())
+    state_dict = model.state_dict()
+    for name in sorted(state_dict):
+        h.update(name.encode())
+        for t in state_tensors(state_dict[name]):
+            h.update(tensor_bytes(t))
+
+    return h.hexdigest()
+
+
+def graph_key(side, side_sample):
+    # content hash of a program graph: node types, edges and edge types (the variable names play no role)
+    h = hashlib.sha1(side.encode())
+    for t in side_sample[:3]:
+        h.update(np.ascontiguousarray(torch.as_tensor(t, dtype=torch.long).numpy()).tobytes())
+        h.update(b"|")
+
+    return h.hexdigest()
+
+
+class EmbeddingStore:
+
+    def __init__(self, directory, model_hash, channels, capacity=1024, device="cpu"):
+        self.directory = os.path.join(directory, model_hash)
+        os.makedirs(self.directory, exist_ok=True)
+        self.matrix_file = os.path.join(self.directory, "embeddings.f32")
+        self.index_file = os.path.join(self.directory, "index.txt")
+        self.channels = channels
+        self.capacity = capacity
+        self.device = device
+
+        self.cache = OrderedDict()
+        self.index = {}
+        self.index_read = 0
+        self.matrix = None
+        self.hits = 0
+        self.misses = 0
+        # the LRU cache, the index and the counters are shared by the threads of the mapping server
+        self.lock = threading.Lock()
+        self._read_index()
+
+    def key(self, side, side_sample):
+        return graph_key(side, side_sample)
+
+    def _read_index(self):
+        # only the lines appended since the last read (possibly by other processes) are parsed
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, 'r') as f:
+            f.seek(self.index_read)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                k, row, rows = line.split()
+                self.index[k] = (int(row), int(rows))
+                self.index_read += len(line)
+
+    def _rows(self, row, rows):
+        if self.matrix is None or row + rows > self.matrix.shape[0]:
+            total_rows = os.path.getsize(self.matrix_file) // (4 * self.channels)
+            self.matrix = np.memmap(self.matrix_file, dtype=np.float32, mode='r', shape=(total_rows, self.channels))
+
+        return torch.from_numpy(np.array(self.matrix[row:row + rows])).to(self.device)
+
+    def _remember(self, k, embeddings):
+        self.cache[k] = embeddings
+        self.cache.move_to_end(k)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def get(self, k):
+        with self.lock:
+            return self._get(k)
+
+    def _get(self, k):
+        if k in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(k)
+            return self.cache[k]
+
+        if k not in self.index:
+            self._read_index()
+        if k not in self.index:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        embeddings = self._rows(*self.index[k])
+        self._remember(k, embeddings)
+        return embeddings
+
+    def put(self, k, embeddings):
+        embeddings = embeddings.detach()
+        with self.lock:
+            self._put(k, embeddings)
+
+    def _put(self, k, embeddings):
+        self._remember(k, embeddings)
+
+        data = embeddings.cpu().numpy().astype(np.float32, copy=False).tobytes()
+        # the index file lock makes concurrent writers append whole entries
+        with open(self.index_file, 'a') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                with open(self.matrix_file, 'ab') as f:
+                    row = f.tell() // (4 * self.channels)
+                    f.write(data)
+                index.write("{k} {r} {n}\n".format(k=k, r=row, n=embeddings.shape[0]))
+                index.flush()
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+        self.index[k] = (row, embeddings.shape[0])
+
+
+def attach_embedding_store(model, directory, capacity=1024):
+    model.embedding_store = EmbeddingStore(directory, weights_hash(model), model.channels, capacity, model.device)
+    return model.embedding_store
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
+import numpy as np
+from numpy_gnn import NumpyVariableMappingGNN
+from decoding import decode_scores
+
+# Several trained models (e.g. the wco, vm, ed and all models of gen_gnn_variable_mappings.sh) mapping the same
+# pairs in one process: every pair is read and turned into tensors once, and every model maps the shared samples.
+# The combined mapping decodes the mean, over the models, of every variable's softmax distribution; its
+# var_map_dist holds the log of that mean, so prog_fixer.py's softmax gives back the mean itself.
+
+# model name of the combined mapping in the output paths
+combined_name = "ensemble"
+
+
+def model_path(name, models_dir="gnn_models"):
+    if os.path.isfile(name):
+        return name
+    # same lookup as the shell drivers: find $gnn_models_dir/$model*.pt | tail -1
+    candidates = sorted(glob.glob(os.path.join(models_dir, name + "*.pt")))
+    if not candidates:
+        raise ValueError("No model named {m} in {d}".format(m=name, d=models_dir))
+    return candidates[-1]
+
+
+def numpy_sample(sample):
+    return tuple((np.asarray(side[0]), np.asarray(side[1]), np.asarray(side[2]), side[3]) for side in sample)
+
+
+def combine(outputs, left_ast, right_ast, decoding="argmax"):
+    # outputs are the (var_map, var_map_dist) of every model for one pair
+    probabilities = []
+    for _, var_map_dist in outputs:
+        scores = np.asarray([var_map_dist[k][0][0] for k in left_ast['vars2id']], dtype=np.float64).reshape(len(left_ast['vars2id']), -1)
+        exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+        probabilities.append(exp / exp.sum(axis=1, keepdims=True))
+
+    return decode_scores(np.log(np.mean(probabilities, axis=0)), left_ast, right_ast, decoding)
+
+
+class Ensemble:
+
+    def __init__(self, models, threads=1, combined=False):
+        # models is {name: model}, the models map the samples in this order
+        self.models = OrderedDict(models)
+        self.threads = threads
+        self.combined = combined
+        self.decoding = "argmax"
+        # eval.load_pair builds the samples for the torch models unless they are all NumPy engines
+        if all(isinstance(m, NumpyVariableMappingGNN) for m in self.models.values()):
+            self.as_array = np.asarray
+
+    @property
+    def message_passing_rounds(self):
+        # the shared samples are pruned (eval.py --prune) for the model with the most rounds, exact for all of them
+        rounds = [getattr(m, "message_passing_rounds", None) for m in self.models.values()]
+        return None if None in rounds else max(rounds)
+
+    def run(self, name, samples):
+        model = self.models[name]
+        model.decoding = self.decoding
+        if isinstance(model, NumpyVariableMappingGNN):
+            return model.predict_batch([numpy_sample(sample) for sample in samples])
+
+        import torch
+        # the grad mode is per thread
+        with torch.no_grad():
+            return model.predict_batch(samples)
+
+    def predict_batch(self, samples):
+        # {name: (var_map, var_map_dist)} for every sample
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                outputs = dict(zip(self.models, pool.map(lambda name: self.run(name, samples), self.models)))
+        else:
+            outputs = {name: self.run(name, samples) for name in self.models}
+
+        results = []
+        for e, sample in enumerate(samples):
+            result = OrderedDict((name, outputs[name][e]) for name in self.models)
+            if self.combined:
+                result[combined_name] = combine(list(result.values()), sample[0][3], sample[1][3], self.decoding)
+            results.append(result)
+
+        return results
+
+
+def load_ensemble(names, models_dir="gnn_models", backend="rgcn", threads=1, combined=False):
+    from eval import load_model, load_num_types
+
+    num_types = None
+    models = OrderedDict()
+    for name in names:
+        location = model_path(name, models_dir)
+        if num_types is None and location.endswith(".pt"):
+            num_types = load_num_types()
+        models[name] = load_model(location, num_types, backend)
+
+    return Ensemble(models, threads, combined)
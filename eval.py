@@ -2,12 +2,58 @@ import argparse
 from sys import argv
 import gzip
 import pickle
-from gnn import VariableMappingGNN
-import torch
+from contextlib import nullcontext
+from numpy_gnn import NumpyVariableMappingGNN
+from decoding import decodings
+from ensemble import Ensemble, load_ensemble
+from worker_pool import WorkerPool
+from tiered_mapper import TieredMapper, tiers
+from var_map_format import write_var_map
+from tune_parallelism import load_profile, set_torch_threads
+from profiling import Profiler, span
+import atexit
 import time
 import gzip
+import json
+import os
+
+# torch and torch_geometric are only imported by the torch engines: a model exported by numpy_gnn.py (.npz) is
+# loaded and run without them
+
+def receptive_field(ast, num_hops):
+    # after num_hops rounds of message passing, only the nodes with a path of at most num_hops edges to a variable
+    # node have reached the variables' embeddings, which are all the scores read. The AST is cut down to them and
+    # renumbered (in the same order); the variables' embeddings, and so the scores, are the same as on the whole AST.
+    sources = {}
+    for triple in ast['edges']:
+        sources.setdefault(triple[1], []).append(triple[0])
+
+    kept = set(ast['vars2id'].values())
+    frontier = kept
+    for i in range(num_hops):
+        frontier = {s for n in frontier for s in sources.get(n, []) if s not in kept}
+        if not frontier:
+            break
+        kept |= frontier
+    if len(kept) == len(ast['nodes2types']):
+        return ast
+
+    new_ids = {n: e for e, n in enumerate(k for k in ast['nodes2types'] if k in kept)}
+    return {"edges": [[new_ids[t[0]], new_ids[t[1]], t[2]] for t in ast['edges'] if t[0] in new_ids and t[1] in new_ids],
+            "nodes2types": {new_ids[k]: ast['nodes2types'][k] for k in new_ids},
+            "vars2id": {k: new_ids[ast['vars2id'][k]] for k in ast['vars2id']}}
+
+def pruning_hops(gnn_model):
+    # the model's message passing rounds when it is set to prune its inputs (--prune), otherwise None
+    if not getattr(gnn_model, "prune", False):
+        return None
+    return getattr(gnn_model, "message_passing_rounds", None)
+
+def preprocess_data_test_time(left_ast, right_ast, as_array=None, num_hops=None):
+    if num_hops is not None:
+        left_ast = receptive_field(left_ast, num_hops)
+        right_ast = receptive_field(right_ast, num_hops)
 
-def preprocess_data_test_time(left_ast, right_ast):
     left_edge_index_pairs = []
     left_edge_types = []
     for triple in left_ast['edges']:
@@ -28,52 +74,170 @@ def preprocess_data_test_time(left_ast, right_ast):
     # var_norm_index = {k: e for (e, k) in enumerate(left_ast['vars2id'])}
     # var_norm_index2 = {k: e for (e, k) in enumerate(right_ast['vars2id'])}
 
-    left_node_types = torch.as_tensor(left_node_types)
-    right_node_types = torch.as_tensor(right_node_types)
+    if as_array is None:
+        import torch
+        as_array = torch.as_tensor
+
+    left_node_types = as_array(left_node_types)
+    right_node_types = as_array(right_node_types)
 
-    left_edge_index_pairs = torch.as_tensor(left_edge_index_pairs)
-    right_edge_index_pairs = torch.as_tensor(right_edge_index_pairs)
+    left_edge_index_pairs = as_array(left_edge_index_pairs)
+    right_edge_index_pairs = as_array(right_edge_index_pairs)
 
-    left_edge_types = torch.as_tensor(left_edge_types)
-    right_edge_types = torch.as_tensor(right_edge_types)
+    left_edge_types = as_array(left_edge_types)
+    right_edge_types = as_array(right_edge_types)
 
     return ((left_node_types, left_edge_index_pairs, left_edge_types, left_ast),
             (right_node_types, right_edge_index_pairs, right_edge_types, right_ast))
 
-def load_model(model_location):
-    device = "cpu"
-    with gzip.open("types2int.pkl.gz", 'rb') as f:
+def load_num_types(types_location="types2int.pkl.gz"):
+    with gzip.open(types_location, 'rb') as f:
         node_type_mapping = pickle.load(f)
         print(node_type_mapping)
         # find maximum index
         num_types = node_type_mapping['diff_types']
         print(num_types)
 
-    gnn = VariableMappingGNN(num_types, device).to(device)
+    return num_types
+
+def load_model(model_location, num_types=None, backend="rgcn"):
+    device = "cpu"
+    # weights exported by numpy_gnn.py run on NumPy only
+    if model_location.endswith(".npz"):
+        return NumpyVariableMappingGNN(model_location)
+    # models frozen by freeze_model.py are TorchScript files
+    if model_location.endswith(".ts"):
+        from freeze_model import load_frozen_model
+        return load_frozen_model(model_location)
 
-    gnn.load_state_dict(
-        torch.load(model_location, map_location=torch.device('cpu')))
+    import torch
+    from gnn import VariableMappingGNN
+
+    # callers that load several models can read types2int.pkl.gz once and pass num_types
+    if num_types is None:
+        num_types = load_num_types()
+
+    state_dict = torch.load(model_location, map_location=torch.device('cpu'))
+    # models of another size than the default (e.g. training.py --distill students) are saved with their
+    # architecture, as {"config": VariableMappingGNN keyword arguments, "state_dict": ...}
+    config = {}
+    if "config" in state_dict:
+        config, state_dict = state_dict["config"], state_dict["state_dict"]
+
+    gnn = VariableMappingGNN(num_types, device, backend=backend, **config).to(device)
+
+    gnn.load_state_dict(state_dict)
 
     return gnn
 
-def predict(gnn_model, left_ast_file, right_ast_file):
+def load_pair(left_ast_file, right_ast_file, as_array=None, num_hops=None):
 
-    with gzip.open(left_ast_file, 'rb') as f:
-        left_ast = pickle.load(f)
+    with span("load_ast"):
+        with gzip.open(left_ast_file, 'rb') as f:
+            left_ast = pickle.load(f)
 
-    with gzip.open(right_ast_file, 'rb') as f:
-        right_ast = pickle.load(f)
+        with gzip.open(right_ast_file, 'rb') as f:
+            right_ast = pickle.load(f)
+
+    with span("preprocess"):
+        return preprocess_data_test_time(left_ast, right_ast, as_array, num_hops)
+
+def no_grad(gnn_model):
+    if isinstance(gnn_model, TieredMapper):
+        return no_grad(gnn_model.model)
+    # an Ensemble turns the gradients off in each of its threads
+    if isinstance(gnn_model, (NumpyVariableMappingGNN, Ensemble)):
+        return nullcontext()
+    import torch
+    return torch.no_grad()
+
+def predict(gnn_model, left_ast_file, right_ast_file):
 
-    left_ast, right_ast = preprocess_data_test_time(left_ast, right_ast)
+    left_ast, right_ast = load_pair(left_ast_file, right_ast_file, getattr(gnn_model, "as_array", None), pruning_hops(gnn_model))
 
-    op_var_dict, op_dist_dict = gnn_model.test_time_output((left_ast, right_ast))
+    with span("test_time_output"):
+        op_var_dict, op_dist_dict = gnn_model.test_time_output((left_ast, right_ast))
 
     return op_var_dict, op_dist_dict
 
+def predict_batch(gnn_model, pairs):
+    # pairs is a list of (incorrect AST file, correct AST file)
+    if isinstance(gnn_model, WorkerPool):
+        return gnn_model.map(pairs)
+    samples = [load_pair(left_ast_file, right_ast_file, getattr(gnn_model, "as_array", None), pruning_hops(gnn_model)) for left_ast_file, right_ast_file in pairs]
+
+    with no_grad(gnn_model), span("predict_batch"):
+        return gnn_model.predict_batch(samples)
+
+def read_manifest(manifest):
+    # one JSON object per line with the same keys as the command line options:
+    # {"inc_ast": ..., "cor_ast": ..., "var_map": ..., "var_map_dist": ..., "time": ...}
+    with open(manifest, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def run_manifest(gnn_model, manifest, batch_size, verbose=False):
+    # a WorkerPool maps one batch per worker at the same time
+    batch_size *= getattr(gnn_model, "workers", 1)
+    batch = []
+    for entry in read_manifest(manifest):
+        batch.append(entry)
+        if len(batch) == batch_size:
+            map_entries(gnn_model, batch, verbose)
+            batch = []
+    if batch:
+        map_entries(gnn_model, batch, verbose)
+
+def mapping_score(var_map, var_map_dist):
+    # total score of a mapping, i.e. the sum of the scores of every variable's chosen counterpart
+    return sum(var_map_dist[k][0][0][var_map_dist[k][1].index(var_map[k])] for k in var_map)
+
+def rounds_used(gnn_model, num_pairs):
+    # message passing rounds of the last num_pairs pairs, when the model stops early (see gnn.EarlyExit)
+    early_exit = getattr(gnn_model, "early_exit", None)
+    if early_exit is None or len(early_exit.rounds) < num_pairs:
+        return None
+    return early_exit.rounds[-num_pairs:]
+
+def map_entries(gnn_model, entries, verbose=False):
+    time_0 = time.time()
+    results = predict_batch(gnn_model, [(entry['inc_ast'], entry['cor_ast']) for entry in entries])
+    # the batch is mapped at once, so each pair is charged an equal share of its time
+    time_f = (time.time()-time_0) / len(entries)
+    rounds = rounds_used(gnn_model, len(entries))
+
+    for e, (entry, result) in enumerate(zip(entries, results)):
+        if isinstance(result, dict):
+            # result has the mapping of every model, written to the entry's paths with {model} replaced by its name
+            for name in result:
+                print(entry['inc_ast'], name, result[name][0])
+                save_entry(model_entry(entry, name), result[name], time_f, verbose)
+            continue
+        print(entry['inc_ast'], result[0])
+        if rounds:
+            print("Message passing rounds:", rounds[e])
+        save_entry(entry, result, time_f, verbose)
+
+def model_entry(entry, name):
+    return {k: entry[k].replace("{model}", name) if isinstance(entry[k], str) else entry[k] for k in entry}
+
+def save_entry(entry, result, time_f, verbose=False):
+    model_output, model_output_distributions = result
+    if verbose:
+        print("Mapping score:", mapping_score(model_output, model_output_distributions))
+    save_var_maps(model_output, entry['var_map'])
+    if entry.get('var_map_dist'):
+        save_var_maps(model_output_distributions, entry['var_map_dist'])
+    if entry.get('time'):
+        with open(entry['time'], 'w+') as writer:
+            writer.writelines("Time: {t}".format(t=round(time_f,3)))
+
 def save_var_maps(var_dict, p_name):
-    fp=gzip.open(p_name,'wb')
-    pickle.dump(var_dict,fp)
-    fp.close()
+    os.makedirs(os.path.dirname(p_name) or '.', exist_ok=True)
+    # .vmd paths get the compact format of var_map_format.py, anything else a gzipped pickle
+    write_var_map(var_dict, p_name)
 
 
 def parser():
@@ -81,30 +245,107 @@ def parser():
     parser.add_argument('-ia', '--inc_ast', help='Incorrect Program\'s AST.')
     parser.add_argument('-ca', '--cor_ast', help='Correct program\'s AST.')
     parser.add_argument('-m', '--var_map', help='Variable mapping Path.')
-    parser.add_argument('-md', '--var_map_dist', help='Path for the each variable mapping distribution.')    
-    parser.add_argument('-gm', '--gnn_model', help='GNN model to use.')
+    parser.add_argument('-md', '--var_map_dist', help='Path for the each variable mapping distribution (compact format if it ends in .vmd, see var_map_format.py).')    
+    parser.add_argument('-gm', '--gnn_model', help='GNN model to use: a .pt state dict, a TorchScript model frozen by freeze_model.py (.ts) or weights exported by numpy_gnn.py (.npz, runs without torch).')
     parser.add_argument('-t', '--time', help='File where the time spent predicting the model will be written to.')
+    parser.add_argument('-mf', '--manifest', help='JSON-lines file with one {"inc_ast", "cor_ast", "var_map", "var_map_dist", "time"} object per pair. All the pairs are mapped in this process, in batches.')
+    parser.add_argument('-bs', '--batch_size', type=int, default=32, help='Number of pairs mapped by each forward pass when using --manifest.')
+    parser.add_argument('-en', '--ensemble', nargs='+', help='Maps the --manifest pairs with all these models (names looked up in --models_dir like the shell drivers, or paths) in one process, reading each pair once. The manifest paths contain {model}, replaced by each model\'s name. The other options apply to every model.')
+    parser.add_argument('-gd', '--models_dir', default='gnn_models', help='Directory of the --ensemble models.')
+    parser.add_argument('-cb', '--combined', action='store_true', default=False, help='With --ensemble, also writes the mapping of the mean of the models\' distributions, as model "ensemble".')
+    parser.add_argument('-et', '--ensemble_threads', type=int, default=1, help='With --ensemble, number of models run at the same time.')
+    parser.add_argument('-w', '--workers', type=int, help='Maps the --manifest pairs in this many processes forked after the model is loaded, sharing its weights, each pinned to its own slice of the cores (see worker_pool.py). 0 uses mapping_workers of the parallelism profile. Not with a reduced --precision, whose accuracy check runs before the fork.')
+    parser.add_argument('-b', '--backend', default='rgcn', help='Implementation of the RGCN rounds: rgcn, fast_rgcn, segment or auto (see rgcn_backends.py).')
+    parser.add_argument('-p', '--precision', default='fp32', help='fp32, int8 or bf16. Precision of the model\'s weights and matmuls (see quantization.py). A reduced precision is only used if it passes the accuracy check on --heldout.')
+    parser.add_argument('-ho', '--heldout', help='eval.py manifest with the held-out pairs used to check a reduced --precision against fp32.')
+    parser.add_argument('-ad', '--max_accuracy_drop', type=float, default=0.01, help='Largest fraction of variables a reduced --precision may map differently from fp32.')
+    parser.add_argument('-d', '--decoding', default='argmax', choices=decodings, help='argmax: each variable takes its best scoring counterpart.\nassignment: maximum-weight bipartite assignment, no two variables are mapped to the same one. When the incorrect program has more variables than the correct one, the extra variables keep their argmax and share a counterpart.')
+    parser.add_argument('-ee', '--early_exit', type=float, help='Stops the message passing of a pair once its mapping has converged, i.e. the argmax mapping, top-k score margins and variable embeddings change by at most this fraction between rounds (see gnn.EarlyExit). Prints the rounds used by every pair. Not used with --embedding_store.')
+    parser.add_argument('-inc', '--incremental', type=float, help='Embeds every incorrect program from the cached per-round states of its correct program (or of the previous incorrect program), recomputing only the nodes its edits reach (see incremental.py). Falls back to a full pass when more than this fraction of the nodes is reached (e.g. 0.5). For --manifest runs over mutated or mutilated programs. fp32 only.')
+    parser.add_argument('-es', '--embedding_store', help='Directory of the persistent store of correct programs\' embeddings. Programs already stored skip the right-hand message passing.')
+    parser.add_argument('-pr', '--prune', action='store_true', default=False, help='Cuts every program graph down to the nodes within as many hops of a variable node as the model has message passing rounds, the only ones that reach the scores (see receptive_field). The scores are unchanged.')
+    parser.add_argument('-ti', '--tiers', nargs='+', choices=tiers, help='Fixes the variables with the same name in the correct program (name) and then the ones with a unique declared type and read/write/chrono usage counts (signature); the model\'s scores then only map the variables left to the candidates left, and the model is skipped when no variable is left (see tiered_mapper.py). The written distributions keep some mass on the other candidates of the fixed variables. Prints how many variables each tier resolved and how many nodes the model embedded.')
+    parser.add_argument('-pf', '--profile', nargs='?', const='eval-profile.json', help='Profiles the run with the torch profiler plus wall-clock spans of the AST reading, preprocessing and mapping (see profiling.py). Writes a Chrome trace to this file (default eval-profile.json) and prints a summary, also written next to it.')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Prints debugging information.')
     args = parser.parse_args(argv[1:])
+    if args.incremental is not None and args.precision != "fp32":
+        parser.error("--incremental only runs in fp32")
+    if args.ensemble and not args.manifest:
+        parser.error("--ensemble needs --manifest")
+    if args.workers is not None and not args.manifest:
+        parser.error("--workers needs --manifest")
+    if args.tiers and args.ensemble:
+        parser.error("--tiers maps with a single model, not --ensemble")
+    if args.precision != "fp32" and args.workers is not None:
+        # its accuracy check runs the model in this process, and the workers must be forked before any inference
+        parser.error("--precision {p} does not run with --workers (see worker_pool.py)".format(p=args.precision))
+    if args.profile and args.workers is not None:
+        parser.error("--profile only follows this process, not the --workers ones")
+    if args.precision != "fp32" and not args.heldout:
+        parser.error("--precision {p} needs --heldout to check its accuracy against fp32".format(p=args.precision))
     return args
 
+def setup_model(model, args):
+    if not isinstance(model, NumpyVariableMappingGNN):
+        from gnn import VariableMappingGNN, EarlyExit
+        from embedding_store import attach_embedding_store
+        from incremental import attach_incremental
+        from quantization import guarded_precision
+
+        set_torch_threads(load_profile(), "inference")
+        if args.precision != "fp32":
+            heldout = [load_pair(entry['inc_ast'], entry['cor_ast']) for entry in read_manifest(args.heldout)]
+            model, _ = guarded_precision(model, args.precision, heldout, args.max_accuracy_drop)
+        if args.embedding_store and isinstance(model, VariableMappingGNN):
+            attach_embedding_store(model, args.embedding_store)
+        if args.early_exit is not None and isinstance(model, VariableMappingGNN):
+            model.early_exit = EarlyExit(args.early_exit)
+        if args.incremental is not None and isinstance(model, VariableMappingGNN):
+            attach_incremental(model, args.incremental)
+    return model
+
 
 if __name__ == "__main__":
     args = parser()
+    if args.profile:
+        # written when the run ends; the NumPy engine is profiled without importing torch, by its spans only
+        atexit.register(Profiler(args.profile, torch_ops=not (args.gnn_model or "").endswith(".npz")).start().stop)
     
-    model_location = args.gnn_model
-    model = load_model(model_location)
-    
-    buggy_ast_file = args.inc_ast
-    correct_ast_file = args.cor_ast
+    with span("load_model"):
+        if args.ensemble:
+            model = load_ensemble(args.ensemble, args.models_dir, args.backend, args.ensemble_threads, args.combined)
+            for name in model.models:
+                model.models[name] = setup_model(model.models[name], args)
+        else:
+            model = setup_model(load_model(args.gnn_model, backend=args.backend), args)
+    if args.tiers:
+        model = TieredMapper(model, args.tiers)
+    # on the outermost model: an Ensemble passes its decoding on to its models and prunes the samples they share
+    model.decoding = args.decoding
+    model.prune = args.prune
 
-    time_0 = time.time()
-    model_output, model_output_distributions = predict(model, buggy_ast_file, correct_ast_file)
-    time_f = time.time()-time_0
-    with open(args.time, 'w+') as writer:
-        writer.writelines("Time: {t}".format(t=round(time_f,3)))
-    
-    print(model_output)
-    save_var_maps(model_output, args.var_map)
-    save_var_maps(model_output_distributions, args.var_map_dist)
-    # TODO Use the {model_output_distributions} to sample
+    if args.manifest and args.workers is not None:
+        with WorkerPool(model, args.workers, args.batch_size) as pool:
+            run_manifest(pool, args.manifest, args.batch_size, args.verbose)
+    elif args.manifest:
+        run_manifest(model, args.manifest, args.batch_size, args.verbose)
+    else:
+        buggy_ast_file = args.inc_ast
+        correct_ast_file = args.cor_ast
+
+        time_0 = time.time()
+        model_output, model_output_distributions = predict(model, buggy_ast_file, correct_ast_file)
+        time_f = time.time()-time_0
+        with open(args.time, 'w+') as writer:
+            writer.writelines("Time: {t}".format(t=round(time_f,3)))
+
+        print(model_output)
+        if rounds_used(model, 1):
+            print("Message passing rounds:", rounds_used(model, 1)[0])
+        if args.verbose:
+            print("Mapping score:", mapping_score(model_output, model_output_distributions))
+        save_var_maps(model_output, args.var_map)
+        save_var_maps(model_output_distributions, args.var_map_dist)
+    if args.tiers:
+        print(model.report())
+    # TODO Use the {model_output_distributions} to sample
\ No newline at end of file
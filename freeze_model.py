@@ -0,0 +1,121 @@
+import argparse
+from sys import argv
+import time
+import torch
+from gnn import VariableMappingGNN
+
+# Frozen TorchScript version of a trained VariableMappingGNN, for CPU inference only.
+# Compared to the eager model it does not go through torch_geometric: every round of RGCNConv's mean
+# aggregation is one matmul for all the relations plus a single index_add, and the per-edge normalisation
+# is computed once per graph instead of once per round.
+
+
+class FrozenVariableMappingGNN(torch.nn.Module):
+
+    def __init__(self, gnn):
+        super().__init__()
+
+        self.message_passing_rounds = gnn.message_passing_rounds
+        self.num_relations = gnn.left_conv.num_relations
+        self.channels = gnn.channels
+        self.ln_eps = gnn.ln.eps
+
+        self.register_buffer("node_embeddings", gnn.node_embeddings.detach().clone())
+        self.register_buffer("left_weight", self.stack_relations(gnn.left_conv.weight))
+        self.register_buffer("left_root", gnn.left_conv.root.detach().clone())
+        self.register_buffer("left_bias", gnn.left_conv.bias.detach().clone())
+        self.register_buffer("right_weight", self.stack_relations(gnn.right_conv.weight))
+        self.register_buffer("right_root", gnn.right_conv.root.detach().clone())
+        self.register_buffer("right_bias", gnn.right_conv.bias.detach().clone())
+        self.register_buffer("ln_weight", gnn.ln.weight.detach().clone())
+        self.register_buffer("ln_bias", gnn.ln.bias.detach().clone())
+
+    @staticmethod
+    def stack_relations(weight):
+        # [relations, in, out] -> [in, relations * out], so x @ weight transforms x for every relation at once
+        num_relations, in_channels, out_channels = weight.shape
+        return weight.detach().permute(1, 0, 2).reshape(in_channels, num_relations * out_channels).contiguous()
+
+    def edge_norm(self, dst, edge_types, num_nodes: int):
+        # RGCNConv's mean aggregation: each edge is weighted by 1 / (incoming edges of its relation at dst)
+        slot = dst * self.num_relations + edge_types
+        counts = torch.zeros(num_nodes * self.num_relations, dtype=torch.float, device=dst.device)
+        counts = counts.index_add(0, slot, torch.ones(slot.shape[0], dtype=torch.float, device=dst.device))
+        return (1.0 / counts.index_select(0, slot)).unsqueeze(1)
+
+    def embed(self, node_types, edges, edge_types, weight, root, bias):
+        x = self.node_embeddings.index_select(0, node_types)
+        num_nodes = x.shape[0]
+        src = edges[:, 0]
+        dst = edges[:, 1]
+        norm = self.edge_norm(dst, edge_types, num_nodes)
+        # row of the [nodes * relations, channels] messages each edge reads
+        gather = src * self.num_relations + edge_types
+
+        for i in range(self.message_passing_rounds):
+            messages = torch.mm(x, weight).view(num_nodes * self.num_relations, self.channels)
+            out = torch.addmm(bias, x, root)
+            out = out.index_add(0, dst, messages.index_select(0, gather) * norm)
+            x = torch.relu(torch.layer_norm(out, [self.channels], self.ln_weight, self.ln_bias, self.ln_eps))
+
+        return x
+
+    def forward(self, left_node_types, left_edges, left_edge_types, left_vars,
+                right_node_types, right_edges, right_edge_types, right_vars):
+        left_x = self.embed(left_node_types, left_edges, left_edge_types, self.left_weight, self.left_root, self.left_bias)
+        right_x = self.embed(right_node_types, right_edges, right_edge_types, self.right_weight, self.right_root, self.right_bias)
+
+        return torch.mm(left_x.index_select(0, left_vars), right_x.index_select(0, right_vars).t())
+
+
+class FrozenMapper:
+    # same test_time_output / predict_batch interface as VariableMappingGNN, on top of a frozen module
+
+    def __init__(self, module):
+        self.module = module
+        self.decoding = "argmax"
+        # eval.pruning_hops reads it; models frozen before it was preserved do not prune
+        self.message_passing_rounds = getattr(module, "message_passing_rounds", None)
+
+    @staticmethod
+    def var_index(ast):
+        return torch.as_tensor([ast['vars2id'][k] for k in ast['vars2id']], dtype=torch.long)
+
+    def test_time_output(self, sample):
+        left_sample, right_sample = sample
+        with torch.no_grad():
+            dot_products = self.module(left_sample[0], left_sample[1], left_sample[2], self.var_index(left_sample[3]),
+                                       right_sample[0], right_sample[1], right_sample[2], self.var_index(right_sample[3]))
+
+        output = torch.tensor_split(dot_products, len(left_sample[3]['vars2id']))
+        return VariableMappingGNN.decode(output, left_sample[3], right_sample[3], self.decoding)
+
+    def predict_batch(self, samples):
+        return [self.test_time_output(sample) for sample in samples]
+
+
+def freeze(gnn):
+    module = torch.jit.script(FrozenVariableMappingGNN(gnn).eval())
+    return torch.jit.freeze(module, preserved_attrs=["message_passing_rounds"])
+
+
+def load_frozen_model(frozen_location):
+    return FrozenMapper(torch.jit.load(frozen_location, map_location=torch.device('cpu')))
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='freeze_model.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-gm', '--gnn_model', help='Trained model (.pt state dict).')
+    parser.add_argument('-o', '--output', help='Frozen model to write; eval.py loads it through -gm when it ends in .ts')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    from eval import load_model
+
+    args = parser()
+    time_0 = time.time()
+    frozen = freeze(load_model(args.gnn_model))
+    torch.jit.save(frozen, args.output)
+    print("Frozen model written to {o} in {t}s".format(o=args.output, t=round(time.time()-time_0, 3)))
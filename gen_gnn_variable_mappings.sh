@@ -34,41 +34,43 @@ labs=("lab02")
 #models=("ed")
 models=("all")
 
-for((m=0;m<${#models[@]};m++));
+# every pair is written once to a manifest whose paths contain {model}, and all the models map it in a single
+# eval.py process that reads each pair once (eval.py --ensemble)
+results_dir="results/var_maps-{model}"
+mkdir -p results
+manifest=results/var_maps-pairs.jsonl
+rm -f $manifest
+for((l=0;l<${#labs[@]};l++));
 do
-    model=${models[$m]}
-    echo $model
-    results_dir="results/var_maps-"$model
-    mkdir -p $results_dir
-    for((l=0;l<${#labs[@]};l++));
+    lab=${labs[$l]}
+    for ex in $(find $data_dir/incorrect_submissions/$lab/ex* -maxdepth 0 -type d);
     do
-	lab=${labs[$l]}
-	for ex in $(find $data_dir/incorrect_submissions/$lab/ex* -maxdepth 0 -type d);
+	ex=$(echo $ex | rev | cut -d '/' -f 1 | rev)
+	for mut_dir in $(find $data_dir/incorrect_submissions/$lab/$ex/* -maxdepth 0 -mindepth 0 -type d);
 	do
-	    ex=$(echo $ex | rev | cut -d '/' -f 1 | rev)
-	    for mut_dir in $(find $data_dir/incorrect_submissions/$lab/$ex/* -maxdepth 0 -mindepth 0 -type d);
+	    mut=$(echo $mut_dir | rev | cut -d '/' -f 1 | rev)
+	    for mutl_dir in $(find $data_dir/incorrect_submissions/$lab/$ex/$mut/* -maxdepth 0 -mindepth 0 -type d);
 	    do
-		mut=$(echo $mut_dir | rev | cut -d '/' -f 1 | rev)
-		for mutl_dir in $(find $data_dir/incorrect_submissions/$lab/$ex/$mut/* -maxdepth 0 -mindepth 0 -type d);
+		mutl=$(echo $mutl_dir | rev | cut -d '/' -f 1 | rev)
+		echo "Dealing with "$mutl_dir
+		for p in $(find $data_dir/incorrect_submissions/$lab/$ex/$mut/$mutl/*.c -maxdepth 0 -mindepth 0 -type f);
 		do
-		    mutl=$(echo $mutl_dir | rev | cut -d '/' -f 1 | rev)
-		    echo "Dealing with "$mutl_dir
-		    for p in $(find $data_dir/incorrect_submissions/$lab/$ex/$mut/$mutl/*.c -maxdepth 0 -mindepth 0 -type f);
+		    stu_id=$(echo $p | rev | cut -d '/' -f 1 | rev)
+		    stu_id=$(echo $stu_id | sed "s/.c//g")
+		    d=$results_dir/$lab/$ex/$mut/$mutl/$stu_id-{model}
+		    for((m=0;m<${#models[@]};m++));
 		    do
-			stu_id=$(echo $p | rev | cut -d '/' -f 1 | rev)
-			stu_id=$(echo $stu_id | sed "s/.c//g")
-			d=$results_dir/$lab/$ex/$mut/$mutl/$stu_id-$model
-			mkdir -p $d $initial_dir/variable_mappings/$model/$lab/$ex/$mut/$mutl
-			c_prog_ast=$(find $data_dir/correct_submissions/$lab/$ex/"ast-"$stu_id* -type f | tail -n 1)
-			i_prog_ast=$mutl_dir/"ast-"$stu_id".pkl.gz"
-			gnn_model=$(find $gnn_models_dir/$model*.pt -type f | tail -1 )
-			# /home/pmorvalho/runsolver/src/runsolver -o $d/out.o -w $d/watcher.w -v $d/var.v -W $TIMEOUT_REPAIR --rss-swap-limit 32000 \
-			python3 eval.py -ia $i_prog_ast -ca $c_prog_ast -m $var_maps_dir/$model/$lab/$ex/$mut/$mutl"/var_map-"$stu_id".pkl.gz" -md $var_maps_dir/$model/$lab/$ex/$mut/$mutl"/var_map_distributions-"$stu_id".pkl.gz" -gm $gnn_model -t $d/var_map_time.txt > $d/out.o
+			model=${models[$m]}
+			mkdir -p ${d//\{model\}/$model} $initial_dir/variable_mappings/$model/$lab/$ex/$mut/$mutl
 		    done
-		    # wait
+		    c_prog_ast=$(find $data_dir/correct_submissions/$lab/$ex/"ast-"$stu_id* -type f | tail -n 1)
+		    i_prog_ast=$mutl_dir/"ast-"$stu_id".pkl.gz"
+		    echo "{\"inc_ast\": \"$i_prog_ast\", \"cor_ast\": \"$c_prog_ast\", \"var_map\": \"$var_maps_dir/{model}/$lab/$ex/$mut/$mutl/var_map-$stu_id.pkl.gz\", \"var_map_dist\": \"$var_maps_dir/{model}/$lab/$ex/$mut/$mutl/var_map_distributions-$stu_id.vmd\", \"time\": \"$d/var_map_time.txt\"}" >> $manifest
 		done
+		# wait
 	    done
 	done
     done
 done
-
+# /home/pmorvalho/runsolver/src/runsolver -o results/var_maps.o -w results/var_maps.w -v results/var_maps.v -W $TIMEOUT_REPAIR --rss-swap-limit 32000 \
+python3 eval.py --manifest $manifest --ensemble ${models[@]} -gd $gnn_models_dir --workers 0 > results/var_maps.o
@@ -20,6 +20,13 @@ labs=("lab02")
 model="all"
 bugs=("wco" "vm" "ed" "all")
 
+NUM_WORKERS=$(python3 tune_parallelism.py --get repair_workers) # prog_fixer.py processes at once, 0 without a profile
+function pwait() {
+    while [ $NUM_WORKERS -gt 0 ] && [ $(jobs -p | wc -l) -ge $NUM_WORKERS ]; do
+        sleep 1
+    done
+}
+
 for((l=0;l<${#labs[@]};l++));
 do
     lab=${labs[$l]}
@@ -46,13 +53,16 @@ do
 			d=$results_dir/$lab/$ex/$mut/$mutl/$stu_id-$bug
 			mkdir -p $d
 			# /home/pmorvalho/runsolver/src/runsolver -o $d/out.o -w $d/watcher.w -v $d/var.v -W $TIMEOUT_REPAIR --rss-swap-limit 32000 \
-			python3 prog_fixer.py -ip $p -cp $c_prog -m $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"var_map-"$stu_id".pkl.gz" -md $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"var_map_distributions-"$stu_id".pkl.gz" --$bug --ipa $lab/$ex -o $d/$stu_id"-fixed" -v -b > $d/out.o &
+			pwait
+			python3 prog_fixer.py -ip $p -cp $c_prog -m $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"var_map-"$stu_id".pkl.gz" -md $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"var_map_distributions-"$stu_id".vmd" --$bug --ipa $lab/$ex -o $d/$stu_id"-fixed" -v -b > $d/out.o &
 		    done
-		    wait
+		    # without a parallelism profile, one student at a time
+		    if [ $NUM_WORKERS -eq 0 ]; then wait; fi
 		done
 		# wait
 	    done
 	done
     done
 done
+wait
 
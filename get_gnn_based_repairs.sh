@@ -13,6 +13,13 @@ data_dir="eval-dataset"
 var_maps_dir=$initial_dir"/variable_mappings"
 TIMEOUT_REPAIR=122 # in seconds 
 
+NUM_WORKERS=$(python3 tune_parallelism.py --get repair_workers) # prog_fixer.py processes at once, 0 without a profile
+function pwait() {
+    while [ $NUM_WORKERS -gt 0 ] && [ $(jobs -p | wc -l) -ge $NUM_WORKERS ]; do
+        sleep 1
+    done
+}
+
 #labs=("lab02" "lab03" "lab04") 	# we are not considering lab05 for this dataset, and only year 2020/2021 has lab05.
 labs=("lab02")
 # we will only use lab02 of the second year as the evaluation dataset
@@ -55,9 +62,11 @@ do
 			    d=$results_dir/$lab/$ex/$mut/$mutl/$stu_id-$bug
 			    mkdir -p $d
 			    # /home/pmorvalho/runsolver/src/runsolver -o $d/out.o -w $d/watcher.w -v $d/var.v -W $TIMEOUT_REPAIR --rss-swap-limit 32000 \
-			    python3 prog_fixer.py -ip $p -cp $c_prog -m $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"/var_map-"$stu_id".pkl.gz" -md $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"/var_map_distributions-"$stu_id".pkl.gz" --$bug --ipa $lab/$ex -o $d/$stu_id"-fixed" -v > $d/out.o &
+			    pwait
+			    python3 prog_fixer.py -ip $p -cp $c_prog -m $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"/var_map-"$stu_id".pkl.gz" -md $var_maps_dir/$model/$lab/$ex/$mut/$mutl/"/var_map_distributions-"$stu_id".vmd" --$bug --ipa $lab/$ex -o $d/$stu_id"-fixed" -v > $d/out.o &
 			done
-			wait
+			# without a parallelism profile, one student at a time
+			if [ $NUM_WORKERS -eq 0 ]; then wait; fi
 		    done
 		    # wait
 		done
@@ -67,3 +76,4 @@ do
 	# telegram-send "$lab is done!"
     done
 done
+wait
@@ -18,6 +18,14 @@ TIMEOUT_REPAIR=122 # in seconds
 labs=("lab02")
 # we will only use lab02 of the second year as the evaluation dataset
 bugs=("wco" "vm" "ed" "all")
+
+NUM_WORKERS=$(python3 tune_parallelism.py --get repair_workers) # prog_fixer.py processes at once, 0 without a profile
+function pwait() {
+    while [ $NUM_WORKERS -gt 0 ] && [ $(jobs -p | wc -l) -ge $NUM_WORKERS ]; do
+        sleep 1
+    done
+}
+
 mkdir -p $results_dir
 
 for((l=0;l<${#labs[@]};l++));
@@ -45,11 +53,13 @@ do
 		       mkdir -p $d
 		       c_prog=$(find $data_dir/correct_submissions/$lab/$ex/*$stu_id*.c -type f | tail -n 1)
 		       #/home/pmorvalho/runsolver/src/runsolver -o $d/out.o -w $d/watcher.w -v $d/var.v -W $TIMEOUT_REPAIR --rss-swap-limit 32000 \
+		       pwait
 		       python3 prog_fixer.py -ip $p -cp $c_prog -m $mutl_dir"/var_map-"$stu_id".pkl.gz" --$bug --ipa $lab/$ex -o $d/$stu_id"-fixed" -v > $d/out.o & 
 		   done
-		   wait
+		   # without a parallelism profile, one student at a time
+		   if [ $NUM_WORKERS -eq 0 ]; then wait; fi
 	       done
-	       #wait
+	       wait
 	       #assuming that this script and the GNN script are not running at the same time, we can execute the following:
 	       rm -rf tmp-*
 	    done
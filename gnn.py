@@ -1,10 +1,46 @@
-from torch_geometric.data import Data
+from torch_geometric.data import Data, Batch
 from torch_geometric.nn import RGCNConv
+from torch_geometric.utils import to_dense_batch
 import torch
+from torch.utils.checkpoint import checkpoint
+from rgcn_backends import RGCNBackend, fused_rgcn
+from decoding import decodings, assignment
+from profiling import span
+
+class EarlyExit:
+    # stops the message passing of a pair once its mapping has converged: after at least min_rounds, when the
+    # argmax mapping is the one of the previous round and the margin between every variable's best and top_k-th
+    # best score, and the variable embeddings, changed by at most tolerance (relative)
+
+    def __init__(self, tolerance=0.05, top_k=2, min_rounds=2):
+        self.tolerance = tolerance
+        self.top_k = top_k
+        self.min_rounds = min_rounds
+        # rounds used by every pair mapped so far
+        self.rounds = []
+
+    def state(self, vars1, vars2):
+        scores = vars1 @ vars2.t()
+        best = scores.topk(min(self.top_k, scores.shape[1]), dim=1).values
+        return vars1, vars2, scores.argmax(dim=1), best[:, 0] - best[:, -1]
+
+    def relative_change(self, previous, current):
+        return ((current - previous).norm(dim=-1) / previous.norm(dim=-1).clamp(min=1e-6)).max().item() if current.numel() else 0.0
+
+    def converged(self, previous, current, rounds):
+        if previous is None or rounds < self.min_rounds:
+            return False
+        if not torch.equal(previous[2], current[2]):
+            return False
+        margins = (current[3] - previous[3]).abs() / previous[3].abs().clamp(min=1e-6)
+        if margins.numel() and margins.max().item() > self.tolerance:
+            return False
+        return max(self.relative_change(previous[0], current[0]), self.relative_change(previous[1], current[1])) <= self.tolerance
+
 
 class VariableMappingGNN(torch.nn.Module):
 
-    def __init__(self, num_types, device, message_passing_rounds=5, channels=32):
+    def __init__(self, num_types, device, message_passing_rounds=5, channels=32, backend="rgcn"):
         super().__init__()
 
         self.device = device
@@ -22,12 +58,42 @@ class VariableMappingGNN(torch.nn.Module):
         self.relu = torch.nn.ReLU()
         self.ln = torch.nn.LayerNorm(self.channels)
 
+        # which implementation of the RGCN rounds to run, see rgcn_backends.py
+        self.rgcn = RGCNBackend(backend)
+        # fp32, or a reduced precision set by quantization.apply_precision
+        self.precision = "fp32"
+        self.decoding = "argmax"
+        # optional EarlyExit, for inference only
+        self.early_exit = None
+
+        # optional EmbeddingStore with the message passing output of the correct (right) programs already seen
+        self.embedding_store = None
+        # optional incremental.IncrementalEmbedder of the incorrect (left) programs, for inference only
+        self.incremental = None
+        # recompute every message passing round in backward instead of keeping its activations, for training on
+        # large programs: only the input of each round is kept (training.py --checkpoint)
+        self.checkpoint_rounds = False
+
     def initial_embedding(self, indices):
 
         return torch.index_select(self.node_embeddings, 0, torch.as_tensor(indices, device=self.device))
 
+    def graph_data(self, side_sample):
+
+        with span("graph_data"):
+            return Data(x=self.initial_embedding(side_sample[0]), edge_index=side_sample[1].t().contiguous(),
+                        edge_attr=side_sample[2]).to(self.device)
+
+    def checkpointed(self, round_function, x):
+        if self.checkpoint_rounds and self.training and torch.is_grad_enabled():
+            return checkpoint(round_function, x, use_reentrant=False)
+        return round_function(x)
+
     def message_passing(self, left_data, right_data):
 
+        if self.rgcn.fuses():
+            return self.fused_message_passing(left_data, right_data)
+
         left_x = left_data.x
         right_x = right_data.x
 
@@ -35,22 +101,90 @@ class VariableMappingGNN(torch.nn.Module):
             # print(left_x)
             # print(left_x.shape)
             # print(left_data.edge_index)
-            left_x = self.left_conv.forward(left_x, left_data.edge_index, left_data.edge_attr)
-            left_x = self.ln(left_x)
+            left_x = self.checkpointed(lambda x: self.relu(self.ln(self.rgcn.convolve(self.left_conv, x, left_data))), left_x)
+            right_x = self.checkpointed(lambda x: self.relu(self.ln(self.rgcn.convolve(self.right_conv, x, right_data))), right_x)
+
+        return left_x, right_x
+
+    def fused_message_passing(self, left_data, right_data):
+        # same rounds as message_passing, on the disjoint union of both graphs
+        num_left = left_data.x.shape[0]
+        weight, adjacency, bias = self.rgcn.fuse(self.left_conv, self.right_conv, left_data, right_data)
+
+        x = torch.cat([left_data.x, right_data.x])
+        for i in range(self.message_passing_rounds):
+            x = self.checkpointed(lambda x: self.relu(self.ln(fused_rgcn(weight, x, adjacency, bias))), x)
+
+        return x[:num_left], x[num_left:]
+
+    def early_exit_message_passing(self, left_data, right_data, left_ast, right_ast):
+        # the rounds of message_passing until self.early_exit finds the mapping of the pair converged
+        num_left = left_data.x.shape[0]
+        varindex1 = torch.as_tensor([left_ast['vars2id'][k] for k in left_ast['vars2id']], dtype=torch.long, device=self.device)
+        varindex2 = torch.as_tensor([right_ast['vars2id'][k] for k in right_ast['vars2id']], dtype=torch.long, device=self.device)
 
-            left_x = self.relu(left_x)
-            right_x = self.right_conv.forward(right_x, right_data.edge_index, right_data.edge_attr)
-            right_x = self.ln(right_x)
-            right_x = self.relu(right_x)
+        if self.rgcn.fuses():
+            weight, adjacency, bias = self.rgcn.fuse(self.left_conv, self.right_conv, left_data, right_data)
 
+            def step(left_x, right_x):
+                x = self.relu(self.ln(fused_rgcn(weight, torch.cat([left_x, right_x]), adjacency, bias)))
+                return x[:num_left], x[num_left:]
+        else:
+            def step(left_x, right_x):
+                return (self.relu(self.ln(self.rgcn.convolve(self.left_conv, left_x, left_data))),
+                        self.relu(self.ln(self.rgcn.convolve(self.right_conv, right_x, right_data))))
+
+        left_x = left_data.x
+        right_x = right_data.x
+        previous = None
+        for i in range(self.message_passing_rounds):
+            left_x, right_x = step(left_x, right_x)
+            current = self.early_exit.state(left_x.index_select(0, varindex1), right_x.index_select(0, varindex2))
+            if self.early_exit.converged(previous, current, i + 1):
+                break
+            previous = current
+
+        self.early_exit.rounds.append(i + 1)
         return left_x, right_x
 
+    def embed(self, conv, data):
+        # message passing on a single side, the same rounds message_passing runs for it
+        x = data.x
+        for i in range(self.message_passing_rounds):
+            x = self.rgcn.convolve(conv, x, data)
+            x = self.ln(x)
+            x = self.relu(x)
+
+        return x
+
+    def right_embeddings(self, right_samples):
+        # message passing output of each correct program, served from the embedding store when possible;
+        # the graphs that are missing are embedded together in one Batch and then stored
+        keys = [self.embedding_store.key("right", right_sample) for right_sample in right_samples]
+        outputs = [self.embedding_store.get(k) for k in keys]
+
+        missing = {}
+        for e, k in enumerate(keys):
+            if outputs[e] is None and k not in missing:
+                missing[k] = e
+        if missing:
+            batch = Batch.from_data_list([self.graph_data(right_samples[e]) for e in missing.values()])
+            right_mp_output = self.embed(self.right_conv, batch)
+            for j, k in enumerate(missing):
+                missing[k] = right_mp_output[batch.ptr[j]:batch.ptr[j + 1]]
+                self.embedding_store.put(k, missing[k])
+
+        return [o if o is not None else missing[k] for o, k in zip(outputs, keys)]
 
     def forward(self, left_ast, right_ast, left_data, right_data):
 
 
         left_mp_output, right_mp_output = self.message_passing(left_data, right_data)
 
+        return self.score(left_ast, right_ast, left_mp_output, right_mp_output), left_mp_output
+
+    def score(self, left_ast, right_ast, left_mp_output, right_mp_output):
+
         varindex1 = torch.as_tensor([left_ast['vars2id'][k] for k in left_ast['vars2id']], device=self.device)
         varindex2 = torch.as_tensor([right_ast['vars2id'][k] for k in right_ast['vars2id']], device=self.device)
 
@@ -71,27 +205,110 @@ class VariableMappingGNN(torch.nn.Module):
 
         split_res = torch.tensor_split(dot_products, num_vars_left_program)
 
-        return split_res, left_mp_output
+        return split_res
 
 
     def test_time_output(self, sample):
 
         left_sample, right_sample = sample
-        l_data = Data(x=self.initial_embedding(left_sample[0]), edge_index=left_sample[1].t().contiguous(),
-                      edge_attr=left_sample[2]).to(self.device)
+        if self.incremental is not None:
+            # the incorrect program is usually an edit of the correct one, embedded by the left side as its base
+            left_mp_output = self.incremental.embed(left_sample, [self.incremental.add_base(right_sample)])
+            if self.embedding_store is None:
+                right_mp_output = self.embed(self.right_conv, self.graph_data(right_sample))
+            else:
+                right_mp_output = self.right_embeddings([right_sample])[0]
+            return self.decode(self.score(left_sample[3], right_sample[3], left_mp_output, right_mp_output), left_sample[3], right_sample[3], self.decoding)
+
+        l_data = self.graph_data(left_sample)
+        if self.embedding_store is None and self.early_exit is not None:
+            left_mp_output, right_mp_output = self.early_exit_message_passing(l_data, self.graph_data(right_sample), left_sample[3], right_sample[3])
+            output = self.score(left_sample[3], right_sample[3], left_mp_output, right_mp_output)
+        elif self.embedding_store is None:
+            r_data = self.graph_data(right_sample)
+            output, leftmean = self.forward(left_sample[3], right_sample[3], l_data, r_data)
+        else:
+            # only the left side needs message passing when the correct program is already stored
+            right_mp_output = self.right_embeddings([right_sample])[0]
+            output = self.score(left_sample[3], right_sample[3], self.embed(self.left_conv, l_data), right_mp_output)
+
+        return self.decode(output, left_sample[3], right_sample[3], self.decoding)
+
+    def variable_index(self, asts, ptr):
+        # global node ids of the variable nodes of every graph in a Batch, plus the graph each one belongs to
+        index = []
+        batch = []
+        for e, ast in enumerate(asts):
+            offset = int(ptr[e])
+            index += [ast['vars2id'][k] + offset for k in ast['vars2id']]
+            batch += [e] * len(ast['vars2id'])
+
+        return torch.as_tensor(index, dtype=torch.long, device=self.device), torch.as_tensor(batch, dtype=torch.long, device=self.device)
 
-        r_data = Data(x=self.initial_embedding(right_sample[0]), edge_index=right_sample[1].t().contiguous(),
-                      edge_attr=right_sample[2]).to(self.device)
-        output, leftmean = self.forward(left_sample[3], right_sample[3], l_data, r_data)
+    def batch_scores(self, left_asts, right_asts, left_mp_output, right_mp_output, left_ptr, right_ptr):
+        # padded [num_pairs, max_left_vars, max_right_vars] dot products for a batch of pairs
+        num_pairs = len(left_asts)
+
+        varindex1, varbatch1 = self.variable_index(left_asts, left_ptr)
+        varindex2, varbatch2 = self.variable_index(right_asts, right_ptr)
+
+        vars1, left_mask = to_dense_batch(torch.index_select(left_mp_output, 0, varindex1), varbatch1, batch_size=num_pairs)
+        vars2, right_mask = to_dense_batch(torch.index_select(right_mp_output, 0, varindex2), varbatch2, batch_size=num_pairs)
+
+        dot_products = torch.einsum('bin, bjn->bij', vars1, vars2)
+
+        return dot_products, left_mask, right_mask
+
+    def predict_batch(self, samples):
+        # maps many (incorrect, correct) pairs at once: every side is packed into one disjoint-union Batch,
+        # so a single message passing call serves all the pairs
+        if (self.embedding_store is None and self.early_exit is not None) or self.incremental is not None:
+            # every pair stops after its own number of rounds, or is embedded from its own base
+            return [self.test_time_output(sample) for sample in samples]
+
+        left_asts = [left_sample[3] for left_sample, _ in samples]
+        right_asts = [right_sample[3] for _, right_sample in samples]
+
+        left_batch = Batch.from_data_list([self.graph_data(left_sample) for left_sample, _ in samples])
+        if self.embedding_store is None:
+            right_batch = Batch.from_data_list([self.graph_data(right_sample) for _, right_sample in samples])
+            left_mp_output, right_mp_output = self.message_passing(left_batch, right_batch)
+            right_ptr = right_batch.ptr
+        else:
+            left_mp_output = self.embed(self.left_conv, left_batch)
+            right_outputs = self.right_embeddings([right_sample for _, right_sample in samples])
+            right_mp_output = torch.cat(right_outputs)
+            right_ptr = [0]
+            for o in right_outputs:
+                right_ptr.append(right_ptr[-1] + o.shape[0])
+
+        dot_products, _, _ = self.batch_scores(left_asts, right_asts, left_mp_output, right_mp_output, left_batch.ptr, right_ptr)
+
+        results = []
+        for e in range(len(samples)):
+            num_vars_left_program = len(left_asts[e]['vars2id'])
+            num_vars_right_program = len(right_asts[e]['vars2id'])
+            pair_scores = dot_products[e, :num_vars_left_program, :num_vars_right_program]
+            results.append(self.decode(torch.tensor_split(pair_scores, num_vars_left_program), left_asts[e], right_asts[e], self.decoding))
+
+        return results
+
+    @staticmethod
+    def decode(output, left_ast, right_ast, decoding="argmax"):
 
         # convert back to strings from id
-        vars_left = left_sample[3]['vars2id']
-        vars_right = right_sample[3]['vars2id']
+        vars_left = left_ast['vars2id']
+        vars_right = right_ast['vars2id']
 
         # print(vars_left)
         # print(vars_right)
         # print(output)
-        indices = [torch.argmax(k) for k in output]
+        if decoding not in decodings:
+            raise ValueError("Unknown decoding {d}, use one of: {l}".format(d=decoding, l=", ".join(decodings)))
+        if decoding == "assignment":
+            indices, _ = assignment(torch.cat(output).detach().float().cpu().numpy())
+        else:
+            indices = [torch.argmax(k) for k in output]
         distributions = [k.tolist() for k in output]
 
         vars_left_list = [k for k in vars_left]
@@ -100,7 +317,7 @@ class VariableMappingGNN(torch.nn.Module):
         varmap_result = {}
         varmap_dist = {}
         for e, o in enumerate(indices):
-            varmap_result[vars_left_list[e]] = vars_right_list[int(indices[e].item())]
+            varmap_result[vars_left_list[e]] = vars_right_list[int(indices[e])]
         # print(varmap_result)
 
         # assert 2 > 3
@@ -109,72 +326,59 @@ class VariableMappingGNN(torch.nn.Module):
 
         return varmap_result, varmap_dist
 
-    def train_step(self, sample, loss_function, optimizer):
-        optimizer.zero_grad()
-        left_sample, right_sample, labels, orig_spec = sample
-
-        l_data = Data(x=self.initial_embedding(left_sample[0]), edge_index=left_sample[1].t().contiguous(),
-                    edge_attr=left_sample[2]).to(self.device)
-
-        r_data = Data(x=self.initial_embedding(right_sample[0]), edge_index=right_sample[1].t().contiguous(),
-                      edge_attr=right_sample[2]).to(self.device)
-        output, leftmean = self.forward(left_sample[3], right_sample[3], l_data, r_data)
-        # global_orig_sample_list.append(orig_spec.parents[0])
-        # global_representation_list.append(torch.mean(leftmean, dim=0).detach().cpu().numpy())
-        total_loss = 0
-        # print(labels)
-        # print(len(labels))
-        for lab, spl in zip(labels, output):
-            # print(lab)
-            # print(torch.softmax(spl, dim=1))
-
-            l = loss_function(spl.reshape(1, -1), torch.tensor(lab, device=self.device).reshape(1))
-            # print(l.item())
-            total_loss += l
-        # print(total_loss.item())
-        # print()
-        total_loss = total_loss / len(labels)
-        total_loss.backward()
-        #
-        optimizer.step()
-
-    def eval_step(self, sample, loss_function):
-
-        left_sample, right_sample, labels, _ = sample
-
-        l_data = Data(x=self.initial_embedding(left_sample[0]), edge_index=left_sample[1].t().contiguous(),
-                      edge_attr=left_sample[2]).to(self.device)
-
-        r_data = Data(x=self.initial_embedding(right_sample[0]), edge_index=right_sample[1].t().contiguous(),
-                      edge_attr=right_sample[2]).to(self.device)
-        output, leftmean = self.forward(left_sample[3], right_sample[3], l_data, r_data)
-
-        total_loss = 0
-        #
-        corr = 0
-        total = 0
-        for lab, spl in zip(labels, output):
-            # print(lab)
-            # print(torch.softmax(spl, dim=1))
-
-            # print(lab, torch.argmax(spl).item())
-            if lab == torch.argmax(spl).item():
-
-                corr += 1
-
-            l = loss_function(spl.reshape(1, -1), torch.tensor(lab, device=self.device).reshape(1))
-            # print(l.item())
-            total_loss += l
-
-            total += 1
-
-        if total == corr:
-            fully_correct = 1
-        else:
-            fully_correct = 0
-        # print(total_loss.item())
+    def batch_output(self, samples):
+        # padded scores of a batch of training samples (left, right, labels, spec); padded right-hand
+        # variables get a score no variable can lose to
+        left_asts = [sample[0][3] for sample in samples]
+        right_asts = [sample[1][3] for sample in samples]
+
+        left_batch = Batch.from_data_list([self.graph_data(sample[0]) for sample in samples])
+        right_batch = Batch.from_data_list([self.graph_data(sample[1]) for sample in samples])
+
+        left_mp_output, right_mp_output = self.message_passing(left_batch, right_batch)
+        dot_products, left_mask, right_mask = self.batch_scores(left_asts, right_asts, left_mp_output, right_mp_output, left_batch.ptr, right_batch.ptr)
+
+        return dot_products.masked_fill(~right_mask.unsqueeze(1), -1e9)
+
+    def batch_loss(self, batch, loss_function):
+        # batch comes from training.collate; loss_function must use reduction="none" and ignore the -100 labels
+        samples, labels, weights = batch
+        dot_products = self.batch_output(samples)
+
+        labels = labels.to(self.device)
+        losses = loss_function(dot_products.reshape(-1, dot_products.shape[2]), labels.reshape(-1))
+
+        # the loss of a sample is the mean over its labelled variables, then averaged over the batch
+        return (losses * weights.to(self.device).reshape(-1)).sum() / len(samples)
+
+    def batch_distillation_loss(self, batch, loss_function, teacher, temperature=2.0, alpha=0.5):
+        # alpha * batch_loss + (1 - alpha) * the KL divergence of every labelled variable's score distribution from
+        # the teacher's, both softened by temperature; the KL term is scaled by temperature^2 so that its gradients
+        # keep the size of the hard loss ones
+        samples, labels, weights = batch
+        dot_products = self.batch_output(samples)
+        with torch.no_grad():
+            teacher_dot_products = teacher.batch_output(samples)
+
+        num_right = dot_products.shape[2]
+        scores = dot_products.reshape(-1, num_right)
+        hard = loss_function(scores, labels.to(self.device).reshape(-1))
+        soft = torch.nn.functional.kl_div(torch.log_softmax(scores / temperature, dim=1),
+                                          torch.log_softmax(teacher_dot_products.reshape(-1, num_right) / temperature, dim=1),
+                                          reduction="none", log_target=True).sum(dim=1) * temperature ** 2
+
+        return ((alpha * hard + (1 - alpha) * soft) * weights.to(self.device).reshape(-1)).sum() / len(samples)
+
+    def eval_batch_step(self, batch):
+
+        samples, labels, _ = batch
+        dot_products = self.batch_output(samples)
 
-        # print(f"Eval: {corr} / {total}")
+        labels = labels.to(self.device)
+        labelled = labels != -100
+        correct = (dot_products.argmax(dim=2) == labels) & labelled
 
+        corr = correct.sum(dim=1)
+        total = labelled.sum(dim=1)
 
-        return corr, total, fully_correct
\ No newline at end of file
+        return int(corr.sum()), int(total.sum()), (corr == total).long().tolist()
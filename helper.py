@@ -21,11 +21,13 @@ from numpy import binary_repr
 import pickle
 import gzip
 import pathlib
+import tempfile
 # This is not required if you've installed pycparser into
 # your site-packages/ with setup.py
 sys.path.extend(['.', '..'])
 
 from pycparser import c_parser, c_ast, parse_file, c_generator
+from tune_parallelism import load_profile
 
 #-----------------------------------------------------------------
 
@@ -121,7 +123,10 @@ def program_checker(ast, c_gen, includes, ipa):
     return check_program(tmp_file, ipa)
 
 def check_program(tmp_file, ipa):
-    os.system("./prog_checker.sh {p} {lab} > {o}".format(p=tmp_file, lab=ipa, o=tmp_file[:-2]+".o")) 
+    # at most gcc_jobs (see tune_parallelism.py) checks compile at the same time, over all the repair processes;
+    # prog_checker.sh only holds the slot while gcc runs, not while the tests run
+    os.system("GCC_JOBS={j} GCC_LOCK_DIR={d} ./prog_checker.sh {p} {lab} > {o}".format(
+        j=load_profile()["gcc_jobs"] or 0, d=tempfile.gettempdir(), p=tmp_file, lab=ipa, o=tmp_file[:-2]+".o"))
     with open(tmp_file[:-2]+".o", 'r') as f:
         lines = f.readlines()
         # print(lines)
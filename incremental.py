@@ -0,0 +1,196 @@
+from collections import OrderedDict
+import difflib
+import numpy as np
+import torch
+from embedding_store import graph_key
+
+# Incremental message passing for programs that differ from an already embedded one by a few AST edits, like the
+# mutated and mutilated programs, which are made from a correct program, or the successive programs of a repair
+# loop. The node states of every round of the base program are cached. For an edited program:
+#   1. its nodes are matched to the base's nodes (graph_delta): the node type sequences, in the visitor's order,
+#      are aligned, so a swapped operator keeps its node and a deleted statement only removes its own nodes. Edits
+#      spread over more than max_alignment nodes are not aligned, the program is embedded in full
+#   2. a node's state at round t is the base's one unless it is dirty (dirty_rounds): it is new or has another
+#      type (dirty from round 0), its incoming edges are not the base's (from round 1) or one of its sources was
+#      dirty the round before
+#   3. each round recomputes only the dirty nodes, from the edges into them
+# When more than max_dirty_fraction of the nodes are dirty at the last round, the whole graph is embedded instead.
+# Either way the states are the ones of a full pass, up to the float rounding of the sums.
+
+
+def structure(side_sample):
+    # node types and [edges, 3] (source, target, relation) array of a sample, what graph_delta and dirty_rounds read
+    return np.asarray(side_sample[0], dtype=np.int64), np.column_stack([np.asarray(side_sample[1], dtype=np.int64).reshape(-1, 2), np.asarray(side_sample[2], dtype=np.int64)])
+
+
+def graph_delta(base_types, edited_types, max_alignment=512):
+    # base node of every edited node (-1 for the new ones), from the alignment of the two type sequences, or None
+    # when the part left to align has more than max_alignment nodes
+    if len(base_types) == len(edited_types):
+        # edits that keep the number of nodes (a swapped operator, a misused variable) only change node types
+        return np.arange(len(edited_types))
+
+    # edits are local: only the part between the common prefix and suffix goes through the (quadratic) alignment
+    length = min(len(base_types), len(edited_types))
+    differs = np.flatnonzero(base_types[:length] != edited_types[:length])
+    prefix = differs[0] if len(differs) else length
+    differs = np.flatnonzero(base_types[::-1][:length - prefix] != edited_types[::-1][:length - prefix])
+    suffix = differs[0] if len(differs) else length - prefix
+    if max(len(base_types), len(edited_types)) - prefix - suffix > max_alignment:
+        return None
+
+    base_of = np.full(len(edited_types), -1, dtype=np.int64)
+    base_of[:prefix] = np.arange(prefix)
+    base_of[len(edited_types) - suffix:] = np.arange(len(base_types) - suffix, len(base_types))
+    matcher = difflib.SequenceMatcher(None, base_types[prefix:len(base_types) - suffix].tolist(), edited_types[prefix:len(edited_types) - suffix].tolist(), autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        # "replace" blocks of the same length are nodes that changed type, e.g. a swapped comparison
+        if tag == "equal" or (tag == "replace" and i2 - i1 == j2 - j1):
+            base_of[prefix + j1:prefix + j2] = np.arange(prefix + i1, prefix + i2)
+
+    return base_of
+
+
+def dirty_rounds(base, edited, num_rounds):
+    # the dirty nodes of every round 0..num_rounds (boolean masks) and the base node of every edited node, for the
+    # structure() of the base and of the edited graph; None when graph_delta gives up
+    base_types, base_edges = base
+    edited_types, edges = edited
+    base_of = graph_delta(base_types, edited_types)
+    if base_of is None:
+        return None, None
+    num_base = len(base_types)
+    edited_of = np.full(num_base, -1, dtype=np.int64)
+    edited_of[base_of[base_of >= 0]] = np.flatnonzero(base_of >= 0)
+
+    dirty = (base_of < 0) | (base_types[np.maximum(base_of, 0)] != edited_types)
+
+    # edges in only one of the graphs, once the edited ones are written with base node ids (new nodes are -1),
+    # change the aggregation of their target
+    mapped = np.stack([base_of[edges[:, 0]], base_of[edges[:, 1]], edges[:, 2]], axis=1)
+    num_relations = int(max(edges[:, 2].max(initial=0), base_edges[:, 2].max(initial=0))) + 1
+
+    def edge_key(e):
+        return ((e[:, 0] + 1) * (num_base + 1) + e[:, 1] + 1) * num_relations + e[:, 2]
+
+    keys, inverse = np.unique(np.concatenate([edge_key(mapped), edge_key(base_edges)]), return_inverse=True)
+    net = np.bincount(inverse, weights=np.concatenate([np.ones(len(edges)), -np.ones(len(base_edges))]), minlength=len(keys))
+    targets = (keys[net != 0] // num_relations) % (num_base + 1) - 1
+    targets = edited_of[targets[targets >= 0]]
+    rewired = dirty.copy()
+    rewired[targets[targets >= 0]] = True
+
+    rounds = [dirty]
+    for t in range(num_rounds):
+        dirty = rounds[-1] | rewired
+        dirty[edges[rounds[-1][edges[:, 0]], 1]] = True
+        rounds.append(dirty)
+
+    return rounds, base_of
+
+
+def rgcn_rows(conv, x, edge_index, edge_types, rows):
+    # conv (RGCNConv, aggr="mean") output for the nodes rows only, from the edges into them
+    num_relations, in_channels, _ = conv.weight.shape
+    local = torch.full((x.shape[0],), -1, dtype=torch.long, device=x.device)
+    local[rows] = torch.arange(rows.shape[0], device=x.device)
+
+    src, dst = edge_index
+    into = local[dst] >= 0
+    slot = edge_types[into] * rows.shape[0] + local[dst[into]]
+    counts = torch.bincount(slot, minlength=num_relations * rows.shape[0]).clamp(min=1).to(x.dtype).unsqueeze(1)
+    aggregated = torch.zeros(num_relations * rows.shape[0], in_channels, dtype=x.dtype, device=x.device)
+    aggregated = aggregated.index_add(0, slot, x.index_select(0, src[into])) / counts
+    aggregated = aggregated.view(num_relations, rows.shape[0], in_channels).transpose(0, 1).reshape(rows.shape[0], -1)
+
+    x_rows = x.index_select(0, rows)
+    return aggregated @ conv.weight.view(num_relations * in_channels, -1) + x_rows @ conv.root + conv.bias
+
+
+class IncrementalEmbedder:
+
+    def __init__(self, gnn, conv, side="left", max_dirty_fraction=0.5, capacity=16):
+        self.gnn = gnn
+        self.conv = conv
+        self.side = side
+        self.max_dirty_fraction = max_dirty_fraction
+        self.capacity = capacity
+
+        # graph key -> (structure, [states of rounds 0..k]) of the programs embedded last, and the very last one
+        self.cache = OrderedDict()
+        self.last = None
+        # node rounds of the programs embedded (not counting the bases) and the ones actually recomputed
+        self.nodes = 0
+        self.recomputed = 0
+        self.full_passes = 0
+
+    def full_pass(self, data):
+        states = [data.x]
+        for i in range(self.gnn.message_passing_rounds):
+            states.append(self.gnn.relu(self.gnn.ln(self.gnn.rgcn.convolve(self.conv, states[-1], data))))
+        self.full_passes += 1
+        self.recomputed += data.x.shape[0] * self.gnn.message_passing_rounds
+        return states
+
+    def incremental_pass(self, data, base_states, rounds, base_of):
+        base_index = torch.as_tensor(np.maximum(base_of, 0), dtype=torch.long, device=data.x.device)
+
+        states = [data.x]
+        for t in range(1, len(rounds)):
+            x = base_states[t].index_select(0, base_index)
+            if rounds[t].any():
+                rows = torch.as_tensor(np.flatnonzero(rounds[t]), dtype=torch.long, device=data.x.device)
+                out = rgcn_rows(self.conv, states[-1], data.edge_index, data.edge_attr, rows)
+                x = x.index_copy(0, rows, self.gnn.relu(self.gnn.ln(out)))
+                self.recomputed += rows.shape[0]
+            states.append(x)
+
+        return states
+
+    def remember(self, k, graph, states):
+        self.cache[k] = (graph, states)
+        self.cache.move_to_end(k)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def states(self, side_sample, bases=()):
+        # node states of every round for side_sample, incrementally from the cached base (among the keys bases,
+        # plus the last program embedded) with the fewest dirty nodes
+        k = graph_key(self.side, side_sample)
+        if k in self.cache:
+            self.cache.move_to_end(k)
+            return k, self.cache[k][1]
+
+        graph = structure(side_sample)
+        data = self.gnn.graph_data(side_sample)
+        best = None
+        for base in list(bases) + [self.last]:
+            if base not in self.cache:
+                continue
+            rounds, base_of = dirty_rounds(self.cache[base][0], graph, self.gnn.message_passing_rounds)
+            if rounds is None:
+                continue
+            if best is None or rounds[-1].sum() < best[1][-1].sum():
+                best = (base, rounds, base_of)
+
+        if best is None or best[1][-1].sum() > self.max_dirty_fraction * len(side_sample[0]):
+            states = self.full_pass(data)
+        else:
+            states = self.incremental_pass(data, self.cache[best[0]][1], best[1], best[2])
+        self.remember(k, graph, states)
+        return k, states
+
+    def add_base(self, side_sample):
+        # caches the states of side_sample (e.g. the correct program the edited ones come from), returns its key
+        return self.states(side_sample)[0]
+
+    def embed(self, side_sample, bases=()):
+        # the last round's states, i.e. the message passing output; side_sample is the next candidate base
+        self.last, states = self.states(side_sample, bases)
+        self.nodes += len(side_sample[0]) * self.gnn.message_passing_rounds
+        return states[-1]
+
+
+def attach_incremental(gnn, max_dirty_fraction=0.5, capacity=16):
+    gnn.incremental = IncrementalEmbedder(gnn, gnn.left_conv, "left", max_dirty_fraction, capacity)
+    return gnn.incremental
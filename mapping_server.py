@@ -0,0 +1,186 @@
+import argparse
+from sys import argv
+from collections import OrderedDict
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# Only the standard library is imported at module level, so that clients (the shell drivers, prog_fixer.py)
+# can talk to a running server without paying for the torch / torch_geometric imports.
+
+default_socket = "/tmp/gnn_mapping_server.sock"
+models_dir = "gnn_models"
+
+
+class ModelRegistry:
+    # keeps at most {capacity} VariableMappingGNN models in memory, evicting the least recently used one
+
+    def __init__(self, models_dir, capacity, embedding_store=None, types_location="types2int.pkl.gz", decoding="argmax"):
+        from eval import load_num_types
+
+        self.models_dir = models_dir
+        self.capacity = capacity
+        self.embedding_store = embedding_store
+        self.decoding = decoding
+        self.num_types = load_num_types(types_location)
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def model_path(self, name):
+        from ensemble import model_path
+
+        return model_path(name, self.models_dir)
+
+    def get(self, name):
+        from eval import load_model
+        from embedding_store import attach_embedding_store
+        from gnn import VariableMappingGNN
+
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+
+            model = load_model(self.model_path(name), self.num_types)
+            model.decoding = self.decoding
+            # frozen (.ts) and NumPy (.npz) models have no train mode and no embedding store
+            if isinstance(model, VariableMappingGNN):
+                model.eval()
+                if self.embedding_store:
+                    attach_embedding_store(model, self.embedding_store)
+            self.models[name] = model
+            if len(self.models) > self.capacity:
+                self.models.popitem(last=False)
+            return model
+
+    def loaded(self):
+        with self.lock:
+            return list(self.models.keys())
+
+
+def repr_from_json(prog_repr):
+    # JSON turns the integer node ids of nodes2types into strings
+    return {"edges": prog_repr["edges"],
+            "nodes2types": {int(k): prog_repr["nodes2types"][k] for k in prog_repr["nodes2types"]},
+            "vars2id": prog_repr["vars2id"]}
+
+
+def handle_request(registry, request):
+    import torch
+    from eval import load_pair, preprocess_data_test_time, save_var_maps
+
+    if request.get("cmd") == "ping":
+        return {"models": registry.loaded()}
+
+    model = registry.get(request.get("model", "all"))
+
+    time_0 = time.time()
+    if "inc_repr" in request:
+        sample = preprocess_data_test_time(repr_from_json(request["inc_repr"]), repr_from_json(request["cor_repr"]))
+    else:
+        sample = load_pair(request["inc_ast"], request["cor_ast"])
+
+    with torch.no_grad():
+        var_map, var_map_dist = model.test_time_output(sample)
+    time_f = time.time()-time_0
+
+    if request.get("var_map"):
+        save_var_maps(var_map, request["var_map"])
+    if request.get("var_map_dist"):
+        save_var_maps(var_map_dist, request["var_map_dist"])
+    if request.get("time"):
+        with open(request["time"], 'w+') as writer:
+            writer.writelines("Time: {t}".format(t=round(time_f,3)))
+
+    return {"var_map": var_map, "var_map_dist": var_map_dist, "time": time_f}
+
+
+class MappingRequestHandler(socketserver.StreamRequestHandler):
+    # JSON-lines protocol: every line received is one request and gets exactly one line back
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                response = handle_request(self.server.registry, json.loads(line))
+            except Exception as e:
+                response = {"error": "{t}: {e}".format(t=type(e).__name__, e=e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class MappingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, registry):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, MappingRequestHandler)
+        self.registry = registry
+
+
+def serve(socket_path, models_dir, capacity, preload, embedding_store=None, decoding="argmax"):
+    from tune_parallelism import load_profile, set_torch_threads
+
+    set_torch_threads(load_profile(), "inference")
+    registry = ModelRegistry(models_dir, capacity, embedding_store, decoding=decoding)
+    for name in preload:
+        registry.get(name)
+
+    server = MappingServer(socket_path, registry)
+    print("Serving variable mappings on", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request_mapping(request, socket_path=default_socket):
+    # sends one request to a running server and returns its decoded response
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(request) + "\n").encode())
+        with s.makefile('rb') as f:
+            response = json.loads(f.readline())
+
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='mapping_server.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-S', '--serve', action='store_true', default=False, help='Starts the server. Otherwise, sends one mapping request to a running server.')
+    parser.add_argument('-s', '--socket', default=default_socket, help='Unix socket the server listens on.')
+    parser.add_argument('-d', '--models_dir', default=models_dir, help='Directory with the trained models (wco, vm, ed, all).')
+    parser.add_argument('-c', '--capacity', type=int, default=4, help='Maximum number of models kept in memory.')
+    parser.add_argument('-p', '--preload', default="", help='Comma-separated list of models to load at startup e.g. wco,vm,ed,all.')
+    parser.add_argument('-es', '--embedding_store', help='Directory of the persistent store of correct programs\' embeddings.')
+    parser.add_argument('-dc', '--decoding', default="argmax", help='How the served models turn scores into mappings: argmax or assignment (see decoding.py).')
+    parser.add_argument('-ia', '--inc_ast', help='Incorrect Program\'s AST.')
+    parser.add_argument('-ca', '--cor_ast', help='Correct program\'s AST.')
+    parser.add_argument('-m', '--var_map', help='Variable mapping Path.')
+    parser.add_argument('-md', '--var_map_dist', help='Path for the each variable mapping distribution.')
+    parser.add_argument('-gm', '--gnn_model', default="all", help='GNN model to use (name in the models directory or path to a .pt file).')
+    parser.add_argument('-t', '--time', help='File where the time spent predicting the model will be written to.')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    args = parser()
+
+    if args.serve:
+        serve(args.socket, args.models_dir, args.capacity, [m for m in args.preload.split(",") if m], args.embedding_store, args.decoding)
+    else:
+        response = request_mapping({"model": args.gnn_model, "inc_ast": os.path.abspath(args.inc_ast), "cor_ast": os.path.abspath(args.cor_ast),
+                                    "var_map": args.var_map and os.path.abspath(args.var_map),
+                                    "var_map_dist": args.var_map_dist and os.path.abspath(args.var_map_dist),
+                                    "time": args.time and os.path.abspath(args.time)}, args.socket)
+        print(response["var_map"])
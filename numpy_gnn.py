@@ -0,0 +1,113 @@
+import argparse
+from sys import argv
+import time
+import numpy as np
+from decoding import decode_scores
+
+# NumPy-only inference for a trained VariableMappingGNN, for processes that should not pay for importing torch.
+# numpy_gnn.py -gm model.pt -o model.npz exports the weights as one flat .npz file:
+#   node_embeddings                      [types, channels]
+#   left_weight, right_weight            [relations, channels, channels] RGCNConv weight of each side
+#   left_root, right_root                [channels, channels]
+#   left_bias, right_bias                [channels]
+#   ln_weight, ln_bias, ln_eps, rounds   LayerNorm parameters and number of message passing rounds
+# eval.py runs a model with this engine when its path ends in .npz. Like rgcn_backends.segment_rgcn, every round
+# averages the neighbours of each relation (the grouping is computed once per graph) and then does one matmul
+# over the relations stacked side by side.
+
+
+class NumpyVariableMappingGNN:
+    # same test_time_output / predict_batch interface as VariableMappingGNN
+
+    # eval.load_pair builds the samples with this instead of torch.as_tensor
+    as_array = staticmethod(np.asarray)
+
+    def __init__(self, weights_location):
+        with np.load(weights_location) as weights:
+            self.weights = {k: weights[k] for k in weights.files}
+        self.message_passing_rounds = int(self.weights["rounds"])
+        self.ln_eps = float(self.weights["ln_eps"])
+        self.num_relations, self.channels, _ = self.weights["left_weight"].shape
+        self.decoding = "argmax"
+
+        for side in ["left", "right"]:
+            self.weights[side + "_weight"] = self.weights[side + "_weight"].reshape(self.num_relations * self.channels, self.channels)
+
+    def grouping(self, edges, edge_types, num_nodes):
+        # the edges sorted by (relation, target node), the first edge of every group, the row of the group in the
+        # [relations * nodes, channels] aggregation and its number of edges
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        slot = np.asarray(edge_types, dtype=np.int64) * num_nodes + edges[:, 1]
+        order = np.argsort(slot, kind="stable")
+        slot = slot[order]
+        starts = np.flatnonzero(np.concatenate([[True], slot[1:] != slot[:-1]])) if len(slot) else np.zeros(0, dtype=np.int64)
+        counts = np.diff(np.append(starts, len(slot))).astype(np.float32)[:, None]
+
+        return edges[order, 0], starts, slot[starts], counts
+
+    def embed(self, side, side_sample):
+        node_types, edges, edge_types = side_sample[:3]
+        x = self.weights["node_embeddings"][np.asarray(node_types, dtype=np.int64)]
+        num_nodes = x.shape[0]
+        src, starts, rows, counts = self.grouping(edges, edge_types, num_nodes)
+        weight = self.weights[side + "_weight"]
+        root = self.weights[side + "_root"]
+        bias = self.weights[side + "_bias"]
+
+        for i in range(self.message_passing_rounds):
+            aggregated = np.zeros((self.num_relations * num_nodes, self.channels), dtype=np.float32)
+            if len(src):
+                aggregated[rows] = np.add.reduceat(x[src], starts, axis=0) / counts
+            aggregated = aggregated.reshape(self.num_relations, num_nodes, self.channels).transpose(1, 0, 2).reshape(num_nodes, -1)
+            x = aggregated @ weight + x @ root + bias
+
+            mean = x.mean(axis=1, keepdims=True)
+            var = x.var(axis=1, keepdims=True)
+            x = (x - mean) / np.sqrt(var + self.ln_eps) * self.weights["ln_weight"] + self.weights["ln_bias"]
+            x = np.maximum(x, 0)
+
+        return x
+
+    def scores(self, sample):
+        left_sample, right_sample = sample
+        left_x = self.embed("left", left_sample)
+        right_x = self.embed("right", right_sample)
+
+        varindex1 = [left_sample[3]['vars2id'][k] for k in left_sample[3]['vars2id']]
+        varindex2 = [right_sample[3]['vars2id'][k] for k in right_sample[3]['vars2id']]
+        return left_x[varindex1] @ right_x[varindex2].T
+
+    def test_time_output(self, sample):
+        return decode_scores(self.scores(sample), sample[0][3], sample[1][3], self.decoding)
+
+    def predict_batch(self, samples):
+        return [self.test_time_output(sample) for sample in samples]
+
+
+def export(gnn, weights_location):
+    weights = {"node_embeddings": gnn.node_embeddings,
+               "ln_weight": gnn.ln.weight, "ln_bias": gnn.ln.bias}
+    for side, conv in [("left", gnn.left_conv), ("right", gnn.right_conv)]:
+        weights[side + "_weight"] = conv.weight
+        weights[side + "_root"] = conv.root
+        weights[side + "_bias"] = conv.bias
+
+    weights = {k: weights[k].detach().cpu().float().numpy() for k in weights}
+    np.savez(weights_location, rounds=np.int64(gnn.message_passing_rounds), ln_eps=np.float32(gnn.ln.eps), **weights)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='numpy_gnn.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-gm', '--gnn_model', help='Trained model (.pt state dict).')
+    parser.add_argument('-o', '--output', help='Weights file to write; eval.py runs it without torch through -gm when it ends in .npz')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    from eval import load_model
+
+    args = parser()
+    time_0 = time.time()
+    export(load_model(args.gnn_model), args.output)
+    print("Weights written to {o} in {t}s".format(o=args.output, t=round(time.time()-time_0, 3)))
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import time
+
+# --profile of training.py and eval.py: the torch profiler (operator level) plus wall-clock spans around the
+# Python-side stages the operators do not show, i.e. reading the ASTs (gunzip + unpickle), preprocessing them,
+# building the Data objects and the steps of the model. The spans are also record_function ranges, so they show
+# up in the Chrome trace (chrome://tracing or https://ui.perfetto.dev) around the operators they contain.
+# Without torch (the NumPy engine) only the spans are recorded, and written as a Chrome trace of their own.
+
+# the running Profiler, if any
+_active = None
+
+
+def span(name):
+    # wall-clock span of the stage name, nothing when no profiler runs
+    if _active is None:
+        return nullcontext()
+    return _active.span(name)
+
+
+class Profiler:
+
+    def __init__(self, trace_file, torch_ops=True, row_limit=25):
+        self.trace_file = trace_file
+        self.torch_ops = torch_ops
+        self.row_limit = row_limit
+        # name -> [(start, duration)] in seconds since start()
+        self.spans = OrderedDict()
+        self.profiler = None
+        self.record_function = None
+
+    @contextmanager
+    def span(self, name):
+        t1 = time.perf_counter()
+        with self.record_function(name) if self.record_function else nullcontext():
+            yield
+        self.spans.setdefault(name, []).append((t1 - self.started, time.perf_counter() - t1))
+
+    def start(self):
+        global _active
+        if self.torch_ops:
+            import torch
+            from torch.profiler import profile, record_function, ProfilerActivity
+
+            activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+            self.profiler = profile(activities=activities)
+            self.profiler.__enter__()
+            self.record_function = record_function
+        self.started = time.perf_counter()
+        _active = self
+        return self
+
+    def stop(self):
+        global _active
+        if _active is not self:
+            return
+        _active = None
+        self.wall = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_file)
+        else:
+            self.export_spans()
+
+        summary = self.summary()
+        print(summary)
+        with open(os.path.splitext(self.trace_file)[0] + "-summary.txt", 'w') as f:
+            f.write(summary)
+
+    def export_spans(self):
+        events = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": 0}
+                  for name in self.spans for start, duration in self.spans[name]]
+        with open(self.trace_file, 'w') as f:
+            json.dump({"traceEvents": events}, f)
+
+    def summary(self):
+        # the spans (inclusive of the spans nested in them) by total time, then the torch operators by self time
+        lines = ["Profile of {w:.3f}s, Chrome trace in {t}".format(w=self.wall, t=self.trace_file), "",
+                 "%-25s%10s%12s%12s%10s" % ("span", "calls", "total s", "mean ms", "% wall")]
+        for name in sorted(self.spans, key=lambda n: -sum(d for _, d in self.spans[n])):
+            total = sum(d for _, d in self.spans[name])
+            lines.append("%-25s%10d%12.3f%12.3f%9.1f%%" % (name, len(self.spans[name]), total, total / len(self.spans[name]) * 1000, total / self.wall * 100))
+        if self.profiler is not None:
+            lines += ["", self.profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=self.row_limit)]
+
+        return "\n".join(lines)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
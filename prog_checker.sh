@@ -8,6 +8,35 @@
 # (C) Copyright 2022 Pedro Orvalho.
 #==============================================================================
 
+# with GCC_JOBS set (helper.check_program passes gcc_jobs, see tune_parallelism.py), at most GCC_JOBS scripts
+# compile at the same time, over all the repair processes: each one holds one of GCC_JOBS lock files in
+# GCC_LOCK_DIR while gcc runs
+gcc_slot() {
+    if [[ -z $GCC_JOBS || $GCC_JOBS -le 0 ]]; then
+        "$@"
+        return
+    fi
+    while true; do
+        for ((i = 0; i < GCC_JOBS; i++)); do
+            exec {slot}>"${GCC_LOCK_DIR:-/tmp}/prog_checker-slot-$i.lock"
+            if flock -n $slot; then
+                "$@"
+                status=$?
+                flock -u $slot
+                exec {slot}>&-
+                return $status
+            fi
+            exec {slot}>&-
+        done
+        sleep 0.05
+    done
+}
+
+compile() {
+    gcc -O3 -ansi -Wall $prog_name -lm -o prog_2_check.out
+    gcc -O3 -ansi -Wall ex* -lm -o ref_impl.out
+}
+
 initial_dir=$(pwd)
 prog_2_check=$1
 exercise=$2
@@ -29,8 +58,7 @@ cp $prog_2_check $wdir/$prog_name
 cp $ref_impl $wdir/.
 cd $wdir
 
-gcc -O3 -ansi -Wall $prog_name -lm -o prog_2_check.out
-gcc -O3 -ansi -Wall ex* -lm -o ref_impl.out
+gcc_slot compile
 
 for t in $(find $dataset/tests/$exercise/*.in -maxdepth 0 -type f);
 do
@@ -29,6 +29,8 @@ sys.path.extend(['.', '..'])
 
 from pycparser import c_parser, c_ast, parse_file, c_generator
 from helper import *
+from mapping_server import request_mapping, default_socket
+from var_map_format import VarMapDistributions, read_var_map
 
 #-----------------------------------------------------------------
 
@@ -668,10 +670,8 @@ class AssignmentInsertionVisitor(ASTVisitor):
 #-----------------------------------------------------------------
    
 def load_dict(vm):
-    fp=gzip.open(vm,'rb') # This assumes that primes.data is already packed with gzip
-    var_map=pickle.load(fp)
-    fp.close()
-    return var_map
+    # gzipped pickle, or the compact format of var_map_format.py for the distributions
+    return read_var_map(vm)
 
 def softmax(x):
     """Compute softmax values for each sets of scores in x."""
@@ -680,14 +680,13 @@ def softmax(x):
 
 def variables_distributions(d):
     # given a dictionary with a non-normalized distribution per variable, this function normalizes the distribution ['distribution'] considering the possible mappings ['mapped_to']
+    d = VarMapDistributions.from_dict(d)
+    distributions = d.softmax()
     dists=dict()
-    for k in d.keys():
+    for e, k in enumerate(d.vars_left):
         dists[k] = dict()
-        dst = d[k][0][0]
-        # dst = softmax(dst)
-        # dists[k]['distribution'] = [i/sum(dst) for i in dst]
-        dists[k]['distribution'] = softmax(dst)
-        dists[k]['mapped_to'] = d[k][1]
+        dists[k]['distribution'] = distributions[e]
+        dists[k]['mapped_to'] = d.vars_right
     return dists
 
 def baseline_distributions(d):
@@ -702,8 +701,27 @@ def baseline_distributions(d):
     return dists
 
 
+def in_support(mapping):
+    # whether the distributions can give mapping (the model's var_map may map a variable to a counterpart of zero
+    # probability, e.g. with eval.py --decoding assignment)
+    if mapping.keys() != vars_dists.keys():
+        return False
+    for k in vars_dists.keys():
+        mapped_to = list(vars_dists[k]['mapped_to'])
+        if mapping[k] not in mapped_to or vars_dists[k]['distribution'][mapped_to.index(mapping[k])] <= 0:
+            return False
+    return True
+
 def get_next_mapping():
     used_mappings.append(var_map)    
+    # every mapping the distributions can give was tried, e.g. when eval.py --tiers fixed all the variables; the
+    # empty placeholder of --baseline and the mappings outside the support do not count
+    num_mappings = 1
+    for k in vars_dists.keys():
+        num_mappings *= int(np.count_nonzero(vars_dists[k]['distribution']))
+    if len([m for m in used_mappings if m and in_support(m)]) >= num_mappings:
+        print("FAILED")
+        sys.exit(0)
     while True:
         d = dict()
         for k in vars_dists.keys():
@@ -892,19 +910,27 @@ def parser():
     parser.add_argument('-a', '--all', action='store_true', default=False, help='Tries to fix all the mutilations above.')    
     parser.add_argument('-e', '--ipa', help='Name of the lab and exercise (IPA) so we can check the IO tests.')
     parser.add_argument('-o', '--output_prog', nargs='?', help='Output program (program fixed).')
+    parser.add_argument('-s', '--server', nargs='?', const=default_socket, help='Asks a running mapping_server.py (listening on this socket) for the variable mapping instead of reading --var_map and --var_map_dist.')
+    parser.add_argument('-ia', '--inc_ast', help='Incorrect program\'s AST, used with --server.')
+    parser.add_argument('-ca', '--cor_ast', help='Correct program\'s AST, used with --server.')
+    parser.add_argument('-gm', '--gnn_model', default='all', help='GNN model the server should use (wco, vm, ed or all), used with --server.')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Prints debugging information.')
     args = parser.parse_args(argv[1:])
     return args
 
 if __name__ == '__main__':
     args = parser()
-    var_map = load_dict(args.var_map)
+    if args.server:
+        response = request_mapping({"model": args.gnn_model, "inc_ast": os.path.abspath(args.inc_ast), "cor_ast": os.path.abspath(args.cor_ast)}, args.server)
+        var_map, var_map_dist = response["var_map"], response["var_map_dist"]
+    else:
+        var_map, var_map_dist = load_dict(args.var_map), load_dict(args.var_map_dist)
     # var_map = {'cont': 'maior', 'i': 'i', 'maior': 'maior'}
     used_mappings = list()
-    vars_dists = variables_distributions(load_dict(args.var_map_dist))
+    vars_dists = variables_distributions(var_map_dist)
 
     if args.baseline:
-        vars_dists = baseline_distributions(load_dict(args.var_map_dist))
+        vars_dists = baseline_distributions(var_map_dist)
         var_map=dict()
         var_map=get_next_mapping()
         used_mappings=list()
@@ -0,0 +1,149 @@
+import argparse
+from sys import argv
+import copy
+import statistics
+import time
+import torch
+from rgcn_backends import RGCNBackend, segment_available
+
+# Reduced-precision CPU inference for VariableMappingGNN.
+#   int8  the two matmuls of every RGCN round (relations and root, see rgcn_backends.segment_rgcn) run as
+#         dynamically quantized int8 Linear layers; the node embedding table is quantized per row to int8
+#         (lookups are gathers, so the table is kept dequantized)
+#   bf16  the same Linear layers and the node embedding table are in bfloat16
+# The message aggregation and the LayerNorm stay in float32.
+precisions = ["fp32", "int8", "bf16"]
+
+
+class QuantizedRelationalConv(torch.nn.Module):
+
+    def __init__(self, conv, precision):
+        super().__init__()
+
+        num_relations, in_channels, out_channels = conv.weight.shape
+        self.num_relations = num_relations
+        self.precision = precision
+
+        self.relations = torch.nn.Linear(num_relations * in_channels, out_channels, bias=False)
+        self.relations.weight.data = conv.weight.detach().reshape(num_relations * in_channels, out_channels).t().contiguous()
+        self.root = torch.nn.Linear(in_channels, out_channels)
+        self.root.weight.data = conv.root.detach().t().contiguous()
+        self.root.bias.data = conv.bias.detach().clone()
+
+        if precision == "int8":
+            self.relations = torch.quantization.quantize_dynamic(self.relations, {torch.nn.Linear}, dtype=torch.qint8)
+            self.root = torch.quantization.quantize_dynamic(self.root, {torch.nn.Linear}, dtype=torch.qint8)
+        elif precision == "bf16":
+            self.relations = self.relations.to(torch.bfloat16)
+            self.root = self.root.to(torch.bfloat16)
+
+    def forward(self, x, adjacency):
+        num_nodes, in_channels = x.shape
+
+        aggregated = torch.mm(adjacency, x)
+        aggregated = aggregated.view(self.num_relations, num_nodes, in_channels).transpose(0, 1).reshape(num_nodes, self.num_relations * in_channels)
+
+        if self.precision == "bf16":
+            return (self.relations(aggregated.to(torch.bfloat16)) + self.root(x.to(torch.bfloat16))).float()
+        return self.relations(aggregated) + self.root(x)
+
+
+class QuantizedBackend(RGCNBackend):
+
+    def __init__(self, convs):
+        super().__init__("segment")
+        self.quantized_convs = convs
+
+    def convolve(self, conv, x, data):
+        return self.quantized_convs[conv](x, self.adjacency(conv, x, data))
+
+
+def quantize_embeddings(table, precision):
+    if precision == "int8":
+        scale = table.abs().max(dim=1, keepdim=True).values.clamp(min=1e-12) / 127
+        return torch.round(table / scale).clamp(-127, 127).to(torch.int8).float() * scale
+    return table.to(torch.bfloat16).float()
+
+
+def apply_precision(gnn, precision):
+    if precision == "fp32":
+        return gnn
+    if precision not in precisions:
+        raise ValueError("Unknown precision {p}, use one of: {l}".format(p=precision, l=", ".join(precisions)))
+    if not segment_available:
+        raise ValueError("Reduced precision needs sparse CSR matmul, which this torch build does not have")
+
+    with torch.no_grad():
+        gnn.node_embeddings.data = quantize_embeddings(gnn.node_embeddings.data, precision)
+    gnn.rgcn = QuantizedBackend({conv: QuantizedRelationalConv(conv, precision) for conv in [gnn.left_conv, gnn.right_conv]})
+    gnn.precision = precision
+
+    return gnn
+
+
+def mapping_agreement(reference, candidate, samples):
+    # fraction of the variables (and of the pairs, fully) that candidate maps like the fp32 reference
+    same = 0
+    total = 0
+    fully_same = 0
+    with torch.no_grad():
+        for ref_output, output in zip(reference.predict_batch(samples), candidate.predict_batch(samples)):
+            matches = [ref_output[0][k] == output[0][k] for k in ref_output[0]]
+            same += sum(matches)
+            total += len(matches)
+            fully_same += all(matches)
+
+    return same / max(total, 1), fully_same / max(len(samples), 1)
+
+
+def latency(gnn, samples, n=3):
+    times = []
+    with torch.no_grad():
+        for i in range(n):
+            time_0 = time.time()
+            for sample in samples:
+                gnn.test_time_output(sample)
+            times.append((time.time()-time_0) / max(len(samples), 1))
+    return statistics.mean(times)
+
+
+def guarded_precision(gnn, precision, samples, max_accuracy_drop, verbose=True):
+    # returns the model in the requested precision, or the fp32 model when the mapping accuracy, measured against
+    # the fp32 model on the held-out samples, drops by more than max_accuracy_drop
+    if precision == "fp32":
+        return gnn, None
+
+    candidate = apply_precision(copy.deepcopy(gnn), precision)
+    agreement, fully_same = mapping_agreement(gnn, candidate, samples)
+    report = {"precision": precision, "variables": agreement, "pairs": fully_same,
+              "fp32_ms": latency(gnn, samples) * 1000, "reduced_ms": latency(candidate, samples) * 1000}
+    if verbose:
+        print("{p} vs fp32 on {n} held-out pairs: {v:.2%} of the variables and {f:.2%} of the pairs mapped the same; {p} {a:.3f} ms vs fp32 {b:.3f} ms per pair".format(
+            p=precision, n=len(samples), v=agreement, f=fully_same, a=report["reduced_ms"], b=report["fp32_ms"]))
+
+    if 1 - agreement > max_accuracy_drop:
+        if verbose:
+            print("Refusing {p}: accuracy drop {d:.2%} is above the threshold of {t:.2%}, using fp32".format(p=precision, d=1 - agreement, t=max_accuracy_drop))
+        return gnn, report
+
+    return candidate, report
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='quantization.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-gm', '--gnn_model', help='GNN model to use.')
+    parser.add_argument('-mf', '--manifest', help='eval.py manifest with the held-out pairs.')
+    parser.add_argument('-p', '--precision', default='int8', choices=precisions, help='Precision to check.')
+    parser.add_argument('-d', '--max_accuracy_drop', type=float, default=0.01, help='Largest fraction of variables allowed to be mapped differently from fp32.')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    from eval import load_model, load_pair, read_manifest
+
+    args = parser()
+    model = load_model(args.gnn_model)
+    samples = [load_pair(entry['inc_ast'], entry['cor_ast']) for entry in read_manifest(args.manifest)]
+    guarded, report = guarded_precision(model, args.precision, samples, args.max_accuracy_drop)
+    exit(0 if report is None or guarded is not model else 1)
@@ -0,0 +1,152 @@
+import argparse
+from sys import argv
+import glob
+import os
+import time
+import numpy as np
+
+# Index of the correct programs by the mean of their node embeddings after message passing (the leftmean of
+# VariableMappingGNN.forward), to find the correct programs structurally closest to an incorrect one. Every program, correct or
+# incorrect, is embedded by the model's left side so that all the vectors are in the same space.
+# On-disk layout, one directory per model (named after the hash of its weights, see embedding_store.py):
+#   vectors.f32   one L2-normalised float32 row of {channels} values per program, in the order of programs.txt
+#   programs.txt  the AST file of every indexed program, one per line
+# A query ranks the indexed programs by cosine similarity; rescore then maps the incorrect program against every
+# shortlisted one in a single batch and orders them by the confidence of the mapping (mapping_confidence).
+
+
+class ReferenceIndex:
+
+    def __init__(self, directory, model):
+        from embedding_store import weights_hash
+
+        self.model = model
+        self.directory = os.path.join(directory, weights_hash(model))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_file = os.path.join(self.directory, "vectors.f32")
+        self.programs_file = os.path.join(self.directory, "programs.txt")
+
+        self.programs = []
+        if os.path.exists(self.programs_file):
+            with open(self.programs_file, 'r') as f:
+                self.programs = [line.rstrip("\n") for line in f if line.strip()]
+        self.vectors = np.zeros((0, model.channels), dtype=np.float32)
+        if self.programs:
+            self.vectors = np.fromfile(self.vectors_file, dtype=np.float32).reshape(-1, model.channels)[:len(self.programs)]
+        self.rows = {p: e for e, p in enumerate(self.programs)}
+
+    def __len__(self):
+        return len(self.programs)
+
+    def embed(self, ast_files, batch_size=64):
+        # L2-normalised mean node embedding of every program, embedded batch_size at a time
+        import torch
+        from torch_geometric.data import Batch
+        from torch_geometric.nn import global_mean_pool
+        from eval import load_pair
+
+        vectors = []
+        with torch.no_grad():
+            for i in range(0, len(ast_files), batch_size):
+                # load_pair reads an (incorrect, correct) pair, here both sides are the same program
+                samples = [load_pair(f, f)[0] for f in ast_files[i:i + batch_size]]
+                batch = Batch.from_data_list([self.model.graph_data(sample) for sample in samples])
+                pooled = global_mean_pool(self.model.embed(self.model.left_conv, batch), batch.batch)
+                vectors.append(torch.nn.functional.normalize(pooled, dim=1).cpu().numpy().astype(np.float32))
+
+        return np.concatenate(vectors) if vectors else np.zeros((0, self.model.channels), dtype=np.float32)
+
+    def add(self, ast_files):
+        # indexes the programs that are not indexed yet, returns how many were added
+        ast_files = [f for f in dict.fromkeys(os.path.abspath(f) for f in ast_files) if f not in self.rows]
+        if not ast_files:
+            return 0
+
+        vectors = self.embed(ast_files)
+        with open(self.vectors_file, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.programs_file, 'a') as f:
+            f.writelines(p + "\n" for p in ast_files)
+
+        for p in ast_files:
+            self.rows[p] = len(self.programs)
+            self.programs.append(p)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        return len(ast_files)
+
+    def query(self, inc_ast_file, k=5, exclude=()):
+        # the k indexed programs closest to inc_ast_file, as (AST file, cosine similarity)
+        similarities = self.vectors @ self.embed([inc_ast_file])[0]
+        for p in exclude:
+            if os.path.abspath(p) in self.rows:
+                similarities[self.rows[os.path.abspath(p)]] = -np.inf
+        k = min(k, len(self.programs))
+        top = np.argpartition(-similarities, k - 1)[:k] if k else []
+        top = sorted(top, key=lambda e: -similarities[e])
+
+        return [(self.programs[e], float(similarities[e])) for e in top if similarities[e] > -np.inf]
+
+    def rescore(self, inc_ast_file, candidates):
+        # maps inc_ast_file against every candidate (AST file, similarity) in one batch, best mapping score first,
+        # as (AST file, similarity, mapping confidence, var_map)
+        from eval import predict_batch
+
+        results = predict_batch(self.model, [(inc_ast_file, p) for p, _ in candidates])
+        scored = [(p, similarity, mapping_confidence(var_map, var_map_dist), var_map)
+                  for (p, similarity), (var_map, var_map_dist) in zip(candidates, results)]
+
+        return sorted(scored, key=lambda c: -c[2])
+
+    def closest(self, inc_ast_file, k=5, shortlist=20, exclude=()):
+        return self.rescore(inc_ast_file, self.query(inc_ast_file, shortlist, exclude))[:k]
+
+
+def mapping_confidence(var_map, var_map_dist):
+    # softmax probability of every variable's counterpart, summed over the variables mapped one-to-one and divided
+    # by the number of variables of the larger program: a reference with other variables than the incorrect
+    # program ranks lower however confident the mapping is (raw dot products would favour the larger programs)
+    if not var_map:
+        return 0.0
+    vars_right = next(iter(var_map_dist.values()))[1]
+    counterparts = list(var_map.values())
+    confidence = 0.0
+    for k in var_map:
+        if counterparts.count(var_map[k]) > 1:
+            continue
+        scores = np.asarray(var_map_dist[k][0][0], dtype=np.float64)
+        exp = np.exp(scores - scores.max())
+        confidence += exp[vars_right.index(var_map[k])] / exp.sum()
+    return float(confidence / max(len(var_map), len(vars_right)))
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='reference_retrieval.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-gm', '--gnn_model', help='GNN model to use (.pt state dict).')
+    parser.add_argument('-x', '--index', default='reference_index', help='Directory of the index.')
+    parser.add_argument('-a', '--add', nargs='+', help='Correct programs\' ASTs to index, or directories searched for ast-*.pkl.gz.')
+    parser.add_argument('-q', '--query', help='Incorrect program\'s AST, prints the closest indexed correct programs.')
+    parser.add_argument('-k', '--top_k', type=int, default=5, help='Number of correct programs printed by --query.')
+    parser.add_argument('-s', '--shortlist', type=int, default=20, help='Number of nearest correct programs re-scored by mapping the incorrect program against each one.')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    from eval import load_model
+
+    args = parser()
+    index = ReferenceIndex(args.index, load_model(args.gnn_model))
+
+    if args.add:
+        ast_files = []
+        for path in args.add:
+            ast_files += sorted(glob.glob(os.path.join(path, "**", "ast-*.pkl.gz"), recursive=True)) if os.path.isdir(path) else [path]
+        time_0 = time.time()
+        added = index.add(ast_files)
+        print("Indexed {a} programs ({n} in total) in {t}s".format(a=added, n=len(index), t=round(time.time()-time_0, 3)))
+
+    if args.query:
+        time_0 = time.time()
+        for p, similarity, score, var_map in index.closest(args.query, args.top_k, args.shortlist):
+            print(p, round(similarity, 4), round(score, 4), var_map)
+        print("Query time: {t}s".format(t=round(time.time()-time_0, 3)))
@@ -0,0 +1,154 @@
+import warnings
+import torch
+from torch_geometric.nn import FastRGCNConv
+
+# Implementations of the RGCNConv(aggr="mean") rounds of VariableMappingGNN. All of them read the parameters of
+# the model's own RGCNConv modules, so they can be switched on any trained model.
+#   rgcn       torch_geometric's RGCNConv: one masked propagate per relation, every round
+#   fast_rgcn  torch_geometric's FastRGCNConv: one propagate with a [edges, in, out] weight gather
+#   segment    per-relation CSR adjacency with the mean-aggregation weights, built once per graph, then every
+#              round is one sparse matmul plus one dense matmul over the relations stacked side by side
+#   fused      segment over the disjoint union of the left and right graphs: the left and right relations, plus
+#              one self-loop relation per side for the roots, so both sides take a single call per round
+#   auto       fused when sparse CSR matmul is available, otherwise picks fast_rgcn or rgcn by graph size
+backends = ["rgcn", "fast_rgcn", "segment", "fused", "auto"]
+
+# On C-Pack-IPAs sized graphs (8 to 4096 edges) segment was the fastest at every size, 2-6x faster than rgcn.
+# Without sparse CSR matmul (older torch builds) FastRGCNConv beats RGCNConv until its [edges, in, out] weight
+# gather gets too large. See utils/benchmark/benchmark-gnn.py for the timings.
+fast_rgcn_max_edges = 512
+
+
+def csr_matmul_available():
+    try:
+        # also silences torch's one-time "sparse CSR support is in beta" warning
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            torch.mm(torch.sparse_csr_tensor(torch.tensor([0, 1]), torch.tensor([0]), torch.tensor([1.0]), size=(1, 1)), torch.ones(1, 1))
+            return True
+    except (AttributeError, NotImplementedError, RuntimeError):
+        return False
+
+
+segment_available = csr_matmul_available()
+
+
+def select_backend(num_edges):
+    if segment_available:
+        return "segment"
+    if num_edges <= fast_rgcn_max_edges:
+        return "fast_rgcn"
+    return "rgcn"
+
+
+def relational_adjacency(edge_index, edge_types, num_nodes, num_relations, dtype=torch.float):
+    # [relations * nodes, nodes] CSR matrix: row r * nodes + i averages the sources of the relation r edges into i
+    src, dst = edge_index[0], edge_index[1]
+    row = edge_types * num_nodes + dst
+    counts = torch.bincount(row, minlength=num_relations * num_nodes)
+    order = torch.argsort(row)
+
+    crow = torch.zeros(num_relations * num_nodes + 1, dtype=torch.long, device=src.device)
+    crow[1:] = torch.cumsum(counts, 0)
+    value = 1.0 / counts[row[order]].to(dtype)
+
+    return torch.sparse_csr_tensor(crow, src[order], value, size=(num_relations * num_nodes, num_nodes))
+
+
+def segment_rgcn(conv, x, adjacency):
+    num_nodes, in_channels = x.shape
+    num_relations = conv.num_relations
+
+    aggregated = torch.mm(adjacency, x)
+    # [relations, nodes, in] -> [nodes, relations * in], matching weight viewed as [relations * in, out]
+    aggregated = aggregated.view(num_relations, num_nodes, in_channels).transpose(0, 1).reshape(num_nodes, num_relations * in_channels)
+
+    out = torch.mm(aggregated, conv.weight.view(num_relations * in_channels, -1))
+    return out + x @ conv.root + conv.bias
+
+
+def fused_adjacency(left_data, right_data, num_relations):
+    # relations [0, R) are the left edges, [R, 2R) the right ones and 2R, 2R + 1 a self-loop on every left and
+    # every right node, which apply the root weight of their side
+    num_left = left_data.x.shape[0]
+    num_right = right_data.x.shape[0]
+    device = left_data.x.device
+    left_nodes = torch.arange(num_left, device=device)
+    right_nodes = torch.arange(num_left, num_left + num_right, device=device)
+
+    edge_index = torch.cat([left_data.edge_index, right_data.edge_index + num_left,
+                            torch.stack([left_nodes, left_nodes]), torch.stack([right_nodes, right_nodes])], dim=1)
+    edge_types = torch.cat([left_data.edge_attr, right_data.edge_attr + num_relations,
+                            torch.full((num_left,), 2 * num_relations, dtype=left_data.edge_attr.dtype, device=device),
+                            torch.full((num_right,), 2 * num_relations + 1, dtype=left_data.edge_attr.dtype, device=device)])
+
+    return relational_adjacency(edge_index, edge_types, num_left + num_right, 2 * num_relations + 2, left_data.x.dtype)
+
+
+def fused_weight(left_conv, right_conv):
+    # [2R + 2, in, out], in the relation order of fused_adjacency
+    return torch.cat([left_conv.weight, right_conv.weight, left_conv.root.unsqueeze(0), right_conv.root.unsqueeze(0)])
+
+
+def fused_bias(left_conv, right_conv, num_left, num_right):
+    return torch.cat([left_conv.bias.expand(num_left, -1), right_conv.bias.expand(num_right, -1)])
+
+
+def fused_rgcn(weight, x, adjacency, bias):
+    num_nodes, in_channels = x.shape
+    num_relations = weight.shape[0]
+
+    aggregated = torch.mm(adjacency, x)
+    aggregated = aggregated.view(num_relations, num_nodes, in_channels).transpose(0, 1).reshape(num_nodes, num_relations * in_channels)
+
+    return torch.addmm(bias, aggregated, weight.view(num_relations * in_channels, -1))
+
+
+def fast_rgcn_conv(conv):
+    # a FastRGCNConv that shares (not copies) the parameters of conv
+    fast = FastRGCNConv(conv.in_channels, conv.out_channels, conv.num_relations, aggr=conv.aggr)
+    fast.weight = conv.weight
+    fast.root = conv.root
+    fast.bias = conv.bias
+    return fast
+
+
+class RGCNBackend:
+
+    def __init__(self, name="rgcn"):
+        if name not in backends:
+            raise ValueError("Unknown RGCN backend {b}, use one of: {l}".format(b=name, l=", ".join(backends)))
+        self.name = name
+        self.fast_convs = {}
+
+    def convolve(self, conv, x, data):
+        backend = self.name
+        if backend == "auto":
+            backend = select_backend(data.edge_index.shape[1])
+
+        if backend == "rgcn":
+            return conv.forward(x, data.edge_index, data.edge_attr)
+
+        if backend == "fast_rgcn":
+            if conv not in self.fast_convs:
+                self.fast_convs[conv] = fast_rgcn_conv(conv)
+            return self.fast_convs[conv].forward(x, data.edge_index, data.edge_attr)
+
+        # fused only applies to message passing over both sides (see fuse), a single side runs segment
+        return segment_rgcn(conv, x, self.adjacency(conv, x, data))
+
+    def fuses(self):
+        # fused was 1.3-1.6x faster than segment per pair, see utils/benchmark/benchmark-gnn.py
+        return self.name == "fused" or (self.name == "auto" and segment_available)
+
+    def fuse(self, left_conv, right_conv, left_data, right_data):
+        # weight, adjacency and bias of the single fused_rgcn call per round over both sides
+        adjacency = fused_adjacency(left_data, right_data, left_conv.num_relations)
+        bias = fused_bias(left_conv, right_conv, left_data.x.shape[0], right_data.x.shape[0])
+        return fused_weight(left_conv, right_conv), adjacency, bias
+
+    def adjacency(self, conv, x, data):
+        # the adjacency is kept on the graph, so it is built once and reused by every round
+        if getattr(data, "adjacency", None) is None:
+            data.adjacency = relational_adjacency(data.edge_index, data.edge_attr, x.shape[0], conv.num_relations, x.dtype)
+        return data.adjacency
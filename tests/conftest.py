@@ -0,0 +1,72 @@
+# Fixtures shared by the tests: the models of gnn_models.zip and the pairs of the motivating example and of
+# tests/programs, preprocessed by gen_progs_repr.py. Run from anywhere with: python -m pytest tests
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the models read types2int.pkl.gz, gen_progs_repr.py its fake libc headers, from the working directory
+os.chdir(ROOT)
+
+PROGRAMS = [os.path.join(ROOT, "motivating_example", "motivating_example.c"),
+            os.path.join(ROOT, "motivating_example", "motivating_example_incorrect.c"),
+            os.path.join(ROOT, "tests", "programs", "sum_even.c"),
+            os.path.join(ROOT, "tests", "programs", "sum_even_incorrect.c")]
+
+
+@pytest.fixture(scope="session")
+def models_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("models")
+    with zipfile.ZipFile(os.path.join(ROOT, "gnn_models.zip")) as f:
+        f.extractall(directory)
+    return str(directory / "gnn_models")
+
+
+@pytest.fixture(scope="session")
+def model_location(models_dir):
+    pytest.importorskip("torch_geometric")
+    return os.path.join(models_dir, "all.pt")
+
+
+@pytest.fixture(scope="session")
+def pairs(tmp_path_factory):
+    # (incorrect AST file, correct AST file) of every ordered pair of different programs
+    if shutil.which("gcc") is None:
+        pytest.skip("gen_progs_repr.py needs gcc")
+    directory = tmp_path_factory.mktemp("programs")
+    for program in PROGRAMS:
+        shutil.copy(program, directory)
+    subprocess.run([sys.executable, "gen_progs_repr.py", "-d", str(directory)], check=True, stdout=subprocess.DEVNULL)
+    asts = [str(directory / "ast-{p}.pkl.gz".format(p=os.path.basename(program)[:-2])) for program in PROGRAMS]
+    return list(itertools.permutations(asts, 2))
+
+
+@pytest.fixture(scope="session")
+def manifest(tmp_path_factory, pairs):
+    directory = tmp_path_factory.mktemp("manifest")
+    path = directory / "pairs.jsonl"
+    with open(path, 'w') as f:
+        for e, (inc_ast, cor_ast) in enumerate(pairs):
+            out = directory / str(e)
+            f.write(json.dumps({"inc_ast": inc_ast, "cor_ast": cor_ast, "var_map": str(out / "vm.pkl.gz"),
+                                "var_map_dist": str(out / "vmd.pkl.gz"), "time": str(out / "t.txt")}) + "\n")
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def samples(pairs):
+    from eval import load_pair
+    return [load_pair(*pair) for pair in pairs]
+
+
+def max_score_difference(a, b):
+    # largest difference between the scores of two var_map_dist of the same pair, relative to the scores above 1
+    # (float32 rounding grows with them)
+    return max(abs(x - y) / max(1.0, abs(x)) for k in a for x, y in zip(a[k][0][0], b[k][0][0]))
@@ -0,0 +1,15 @@
+#include <stdio.h>
+int main(){
+  int n, i, s = 0, m;
+  float avg;
+  scanf("%d", &n);
+  for (i = 0; i < n; i++) {
+    scanf("%d", &m);
+    if (m > 0 && m % 2 == 0) s += m;
+    else s = s - 1;
+  }
+  avg = s / (float) n;
+  while (s > 100) { s = s / 2; }
+  printf("%d\n", s);
+  return 0;
+}
@@ -0,0 +1,15 @@
+#include <stdio.h>
+int main(){
+  int n, i, total = 0, x;
+  float avg;
+  scanf("%d", &n);
+  for (i = 0; i <= n; i++) {
+    scanf("%d", &x);
+    if (x > 0 && x % 2 == 0) total += x;
+    else total = total - 1;
+  }
+  avg = total / (float) n;
+  while (total > 100) { total = total / 2; }
+  printf("%d\n", total);
+  return 0;
+}
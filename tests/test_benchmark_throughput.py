@@ -0,0 +1,57 @@
+import importlib.util
+import os
+import random
+
+import pytest
+import torch
+
+from conftest import ROOT
+
+
+@pytest.fixture(scope="module")
+def throughput():
+    pytest.importorskip("torch_geometric")
+    spec = importlib.util.spec_from_file_location("benchmark_gnn_throughput", os.path.join(ROOT, "utils", "benchmark", "benchmark-gnn-throughput.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("num_nodes", [64, 1024])
+def test_synthetic_graphs_are_shaped_like_program_graphs(throughput, num_nodes):
+    from eval import load_num_types
+
+    num_types = load_num_types()
+    ast = throughput.synthetic_ast(num_nodes, num_types, random.Random(0))
+    assert sorted(ast['nodes2types']) == list(range(num_nodes))
+    assert all(0 <= t < num_types for t in ast['nodes2types'].values())
+    assert all(0 <= src < num_nodes and 0 <= dst < num_nodes and 0 <= rel <= throughput.CHRONO_EDGE for src, dst, rel in ast['edges'])
+    # every variable node is linked to its occurrences, which are AST nodes
+    variables = set(ast['vars2id'].values())
+    assert len(variables) == max(2, num_nodes // 20)
+    for src, dst, rel in ast['edges']:
+        if rel == throughput.WRITE_EDGE:
+            assert src not in variables and dst in variables
+        elif rel == throughput.READ_EDGE:
+            assert src in variables and dst not in variables
+
+
+def test_synthetic_pairs_map_and_train(throughput):
+    from eval import load_num_types, preprocess_data_test_time
+    from gnn import VariableMappingGNN
+
+    rng = random.Random(0)
+    num_types = load_num_types()
+    samples = [preprocess_data_test_time(throughput.synthetic_ast(256, num_types, rng), throughput.synthetic_ast(256, num_types, rng)) for _ in range(4)]
+    gnn = VariableMappingGNN(num_types, "cpu", message_passing_rounds=3, channels=16)
+
+    with torch.no_grad():
+        outputs = gnn.predict_batch(samples)
+    for (left, right), (var_map, _) in zip(samples, outputs):
+        assert set(var_map) == set(left[3]['vars2id'])
+        assert set(var_map.values()) <= set(right[3]['vars2id'])
+
+    batch = throughput.collate([throughput.training_sample(sample, rng) for sample in samples])
+    loss = gnn.batch_loss(batch, torch.nn.CrossEntropyLoss(reduction="none"))
+    assert torch.isfinite(loss)
+    loss.backward()
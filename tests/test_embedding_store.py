@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+from conftest import max_score_difference
+
+
+# bf16 rounds to 8 significant bits, and a batch of pairs is not rounded like the pairs one by one
+@pytest.mark.parametrize("precision,tolerance", [("fp32", 1e-5), ("int8", 1e-5), ("bf16", 1e-2)])
+def test_stored_embeddings_map_like_the_model(model_location, samples, tmp_path, precision, tolerance):
+    from eval import load_model
+    from embedding_store import attach_embedding_store, weights_hash
+    from quantization import apply_precision
+
+    def model():
+        return apply_precision(load_model(model_location), precision)
+
+    reference = model()
+    if precision != "fp32":
+        # the store of a reduced precision model is not the fp32 one's
+        assert weights_hash(reference) != weights_hash(load_model(model_location))
+
+    with torch.no_grad():
+        expected = reference.predict_batch(samples)
+        # the first model fills the store, the second one reads every correct program's embeddings from it
+        for hits in [0, len(samples)]:
+            stored = model()
+            store = attach_embedding_store(stored, str(tmp_path))
+            for sample, (var_map, var_map_dist) in zip(samples, expected):
+                stored_var_map, stored_var_map_dist = stored.test_time_output(sample)
+                assert stored_var_map == var_map
+                assert max_score_difference(var_map_dist, stored_var_map_dist) < tolerance
+            assert store.hits >= hits
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from conftest import max_score_difference
+
+
+# the test programs are small: with 5 rounds almost every node reaches a variable, with 2 rounds many do not
+@pytest.mark.parametrize("rounds", [None, 2])
+@pytest.mark.parametrize("engine", ["eager", "numpy"])
+def test_pruned_graphs_map_like_whole_ones(model_location, pairs, tmp_path, engine, rounds):
+    from eval import load_model, load_pair
+    from numpy_gnn import export
+
+    model = load_model(model_location)
+    if engine == "numpy":
+        export(model, str(tmp_path / "model.npz"))
+        model = load_model(str(tmp_path / "model.npz"))
+    model.message_passing_rounds = rounds or model.message_passing_rounds
+    as_array = getattr(model, "as_array", None)
+
+    nodes = [0, 0]
+    with torch.no_grad():
+        for pair in pairs:
+            whole = load_pair(*pair, as_array)
+            pruned = load_pair(*pair, as_array, model.message_passing_rounds)
+            nodes[0] += sum(len(side[0]) for side in whole)
+            nodes[1] += sum(len(side[0]) for side in pruned)
+            var_map, var_map_dist = model.test_time_output(whole)
+            pruned_var_map, pruned_var_map_dist = model.test_time_output(pruned)
+            assert pruned_var_map == var_map
+            assert max_score_difference(var_map_dist, pruned_var_map_dist) < 1e-5
+
+    assert nodes[1] <= nodes[0]
+    if rounds is not None:
+        assert nodes[1] < nodes[0]
@@ -0,0 +1,20 @@
+import torch
+
+from conftest import max_score_difference
+
+
+def test_frozen_model_maps_like_the_eager_one(model_location, samples, tmp_path):
+    from eval import load_model
+    from freeze_model import freeze
+
+    model = load_model(model_location)
+    torch.jit.save(freeze(model), str(tmp_path / "model.ts"))
+    frozen = load_model(str(tmp_path / "model.ts"))
+    assert frozen.message_passing_rounds == model.message_passing_rounds
+
+    with torch.no_grad():
+        for sample in samples:
+            var_map, var_map_dist = model.test_time_output(sample)
+            frozen_var_map, frozen_var_map_dist = frozen.test_time_output(sample)
+            assert frozen_var_map == var_map
+            assert max_score_difference(var_map_dist, frozen_var_map_dist) < 1e-5
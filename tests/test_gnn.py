@@ -0,0 +1,70 @@
+import pytest
+import torch
+
+
+def test_early_exit_maps_like_every_round(model_location, samples):
+    from eval import load_model
+    from gnn import EarlyExit
+
+    full = load_model(model_location)
+    model = load_model(model_location)
+    model.early_exit = EarlyExit()
+    with torch.no_grad():
+        expected = [full.test_time_output(sample)[0] for sample in samples]
+        assert [model.test_time_output(sample)[0] for sample in samples] == expected
+        assert [var_map for var_map, _ in model.predict_batch(samples)] == expected
+
+    assert len(model.early_exit.rounds) == 2 * len(samples)
+    assert all(1 <= rounds <= model.message_passing_rounds for rounds in model.early_exit.rounds)
+
+
+def test_early_exit_stops_after_the_rounds_it_reports(model_location, samples):
+    # with no tolerance on the scores and embeddings, a pair stops as soon as its argmax mapping repeats; its
+    # mapping is then the one of a model with that many rounds
+    from eval import load_model
+    from gnn import EarlyExit
+
+    full = load_model(model_location)
+    model = load_model(model_location)
+    model.early_exit = EarlyExit(tolerance=float("inf"))
+    with torch.no_grad():
+        for sample in samples:
+            var_map = model.test_time_output(sample)[0]
+            full.message_passing_rounds = model.early_exit.rounds[-1]
+            assert var_map == full.test_time_output(sample)[0]
+
+    assert all(model.early_exit.min_rounds <= rounds <= model.message_passing_rounds for rounds in model.early_exit.rounds)
+    assert min(model.early_exit.rounds) < model.message_passing_rounds
+
+
+@pytest.mark.parametrize("backend", ["rgcn", "fused"])
+def test_checkpointed_rounds_train_like_stored_ones(model_location, samples, backend):
+    from eval import load_model
+    from rgcn_backends import segment_available
+
+    if backend == "fused" and not segment_available:
+        pytest.skip("this torch build has no sparse CSR matmul")
+    model = load_model(model_location, backend=backend)
+    grads = []
+    saved = []
+    for checkpoint_rounds in [False, True]:
+        model.checkpoint_rounds = checkpoint_rounds
+        model.zero_grad()
+        # bytes of the dense tensors autograd keeps for the backward (the fused adjacency is sparse and kept either way)
+        storages = {}
+
+        def pack(t):
+            if t.layout == torch.strided:
+                storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+            return t
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            loss = model.batch_output(samples).logsumexp(dim=2).sum()
+        loss.backward()
+        saved.append(sum(storages.values()))
+        grads.append({name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None})
+
+    assert grads[0].keys() == grads[1].keys()
+    for name in grads[0]:
+        assert torch.allclose(grads[0][name], grads[1][name], rtol=1e-5, atol=1e-6), name
+    assert saved[1] < saved[0]
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+import torch
+
+from conftest import max_score_difference
+
+
+def edited_samples(pairs, samples):
+    # the pairs of an incorrect program and the correct program it is an edit of
+    def name(ast_file):
+        return os.path.basename(ast_file)[len("ast-"):-len(".pkl.gz")]
+
+    return [sample for (inc_ast, cor_ast), sample in zip(pairs, samples) if name(inc_ast) == name(cor_ast) + "_incorrect"]
+
+
+# 0 always runs full passes, 1 embeds every incorrect program from its correct program's states
+@pytest.mark.parametrize("max_dirty_fraction", [0.0, 0.5, 1.0])
+def test_incremental_embedding_maps_like_full_passes(model_location, pairs, samples, max_dirty_fraction):
+    from eval import load_model
+    from incremental import attach_incremental
+
+    edited = edited_samples(pairs, samples)
+    assert len(edited) == 2
+    full = load_model(model_location)
+    model = load_model(model_location)
+    incremental = attach_incremental(model, max_dirty_fraction)
+    with torch.no_grad():
+        for sample in edited:
+            incremental.add_base(sample[1])
+        full_passes, recomputed = incremental.full_passes, incremental.recomputed
+        for sample in edited:
+            var_map, var_map_dist = full.test_time_output(sample)
+            incremental_var_map, incremental_var_map_dist = model.test_time_output(sample)
+            assert incremental_var_map == var_map
+            assert max_score_difference(var_map_dist, incremental_var_map_dist) < 1e-5
+
+    if max_dirty_fraction == 0.0:
+        assert incremental.full_passes - full_passes == len(edited)
+    if max_dirty_fraction == 1.0:
+        assert incremental.full_passes == full_passes
+        assert incremental.recomputed - recomputed < incremental.nodes
@@ -0,0 +1,21 @@
+import torch
+
+from conftest import max_score_difference
+
+
+def test_numpy_engine_maps_like_the_torch_model(model_location, pairs, tmp_path):
+    from eval import load_model, load_pair
+    from numpy_gnn import export, NumpyVariableMappingGNN
+
+    model = load_model(model_location)
+    export(model, str(tmp_path / "model.npz"))
+    engine = load_model(str(tmp_path / "model.npz"))
+    assert isinstance(engine, NumpyVariableMappingGNN)
+    assert engine.message_passing_rounds == model.message_passing_rounds
+
+    with torch.no_grad():
+        for pair in pairs:
+            var_map, var_map_dist = model.test_time_output(load_pair(*pair))
+            numpy_var_map, numpy_var_map_dist = engine.test_time_output(load_pair(*pair, engine.as_array))
+            assert numpy_var_map == var_map
+            assert max_score_difference(var_map_dist, numpy_var_map_dist) < 1e-5
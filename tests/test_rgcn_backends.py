@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from conftest import max_score_difference
+
+rgcn_backends = pytest.importorskip("rgcn_backends")
+needs_csr = pytest.mark.skipif(not rgcn_backends.segment_available, reason="this torch build has no sparse CSR matmul")
+
+
+@needs_csr
+def test_fused_message_passing_matches_separate(model_location, samples):
+    from eval import load_model
+
+    model = load_model(model_location)
+    with torch.no_grad():
+        for sample in samples:
+            left_data, right_data = model.graph_data(sample[0]), model.graph_data(sample[1])
+            separate = model.message_passing(left_data, right_data)
+            fused = model.fused_message_passing(left_data, right_data)
+            for a, b in zip(separate, fused):
+                assert a.shape == b.shape
+                assert ((a - b).abs() / a.abs().clamp(min=1.0)).max().item() < 1e-5
+
+    fused_model = load_model(model_location, backend="fused")
+    assert fused_model.rgcn.fuses()
+    with torch.no_grad():
+        for sample in samples:
+            var_map, var_map_dist = model.test_time_output(sample)
+            fused_var_map, fused_var_map_dist = fused_model.test_time_output(sample)
+            assert fused_var_map == var_map
+            assert max_score_difference(var_map_dist, fused_var_map_dist) < 1e-5
+
+
+@pytest.mark.parametrize("backend", [pytest.param(backend, marks=needs_csr if backend in ["segment", "fused", "auto"] else ())
+                                     for backend in rgcn_backends.backends if backend != "rgcn"])
+def test_backend_maps_and_trains_like_rgcn(model_location, samples, backend):
+    from eval import load_model
+
+    reference = load_model(model_location)
+    model = load_model(model_location, backend=backend)
+    with torch.no_grad():
+        for sample in samples:
+            var_map, var_map_dist = reference.test_time_output(sample)
+            backend_var_map, backend_var_map_dist = model.test_time_output(sample)
+            assert backend_var_map == var_map
+            assert max_score_difference(var_map_dist, backend_var_map_dist) < 1e-5
+
+    # same gradients of every parameter for the same batch
+    grads = []
+    for m in [reference, model]:
+        m.zero_grad()
+        m.batch_output(samples).logsumexp(dim=2).sum().backward()
+        grads.append({name: p.grad.clone() for name, p in m.named_parameters() if p.grad is not None})
+    assert grads[0].keys() == grads[1].keys()
+    for name in grads[0]:
+        assert torch.allclose(grads[0][name], grads[1][name], rtol=1e-4, atol=1e-4), name
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+import pytest
+import torch
+
+
+@pytest.mark.parametrize("engine", ["eager", "numpy"])
+def test_tiers_map_like_the_model_masked(model_location, samples, tmp_path, engine):
+    # the variables left are mapped by the scores of the whole pair, without the fixed variables' counterparts
+    from ensemble import numpy_sample
+    from eval import load_model
+    from numpy_gnn import export
+    from tiered_mapper import TieredMapper, tier_mapping
+
+    model = load_model(model_location)
+    if engine == "numpy":
+        export(model, str(tmp_path / "model.npz"))
+        model = load_model(str(tmp_path / "model.npz"))
+        samples = [numpy_sample(sample) for sample in samples]
+    tiered = TieredMapper(model)
+
+    with torch.no_grad():
+        expected = model.predict_batch(samples)
+        outputs = tiered.predict_batch(samples)
+
+    for sample, (_, var_map_dist), (tiered_var_map, tiered_var_map_dist) in zip(samples, expected, outputs):
+        fixed = tier_mapping(sample[0][3], sample[1][3])
+        vars_right = list(sample[1][3]['vars2id'])
+        taken = {v for v, _ in fixed.values()}
+        candidates = [v for v in vars_right if v not in taken] or vars_right
+        for k in sample[0][3]['vars2id']:
+            if k in fixed:
+                assert tiered_var_map[k] == fixed[k][0]
+                continue
+            scores = dict(zip(vars_right, var_map_dist[k][0][0]))
+            assert tiered_var_map[k] == max(candidates, key=scores.get)
+            tiered_scores = dict(zip(tiered_var_map_dist[k][1], tiered_var_map_dist[k][0][0]))
+            for v in candidates:
+                assert abs(tiered_scores[v] - scores[v]) / max(1.0, abs(scores[v])) < 1e-5
+            # the taken candidates stay below every candidate scored
+            assert all(tiered_scores[v] < min(tiered_scores[c] for c in candidates) for v in taken if v not in candidates)
+
+    assert tiered.pairs == len(samples)
+    assert sum(tiered.resolved.values()) == sum(len(sample[0][3]['vars2id']) for sample in samples)
+    # the nodes that only reach fixed variables are not embedded
+    assert tiered.nodes[0] < tiered.nodes[1]
+
+
+def test_workers_report_the_tiers_of_every_pair(model_location, manifest):
+    # in new processes: the pool must be forked before any inference (see worker_pool.py)
+    def run(*options):
+        command = [sys.executable, "eval.py", "-gm", model_location, "--manifest", manifest, "--tiers", "name", "signature"]
+        output = subprocess.run(command + list(options), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True).stdout
+        return [line for line in output.splitlines() if line.startswith(("Variables resolved", "/"))]
+
+    serial = run()
+    assert serial[-1].startswith("Variables resolved")
+    assert run("--workers", "2", "--batch_size", "1") == serial
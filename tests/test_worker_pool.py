@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+
+def run_eval(model_location, manifest, *options):
+    # in new processes: the pool must be forked before any inference (see worker_pool.py)
+    command = [sys.executable, "eval.py", "-gm", model_location, "--manifest", manifest]
+    return subprocess.run(command + list(options), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def test_workers_map_like_one_process(model_location, manifest):
+    # the mappings and, with --early_exit, the rounds of every pair, in the manifest's order
+    serial = run_eval(model_location, manifest, "--early_exit", "0.05")
+    workers = run_eval(model_location, manifest, "--early_exit", "0.05", "--workers", "2", "--batch_size", "1")
+    assert serial.returncode == workers.returncode == 0
+    lines = [line for line in serial.stdout.splitlines() if line.startswith(("/", "Message passing rounds"))]
+    assert len(lines) == 2 * len(open(manifest).readlines())
+    assert [line for line in workers.stdout.splitlines() if line.startswith(("/", "Message passing rounds"))] == lines
+
+
+def test_reduced_precision_is_refused_with_workers(model_location, manifest):
+    result = run_eval(model_location, manifest, "--workers", "2", "--precision", "int8", "--heldout", manifest)
+    assert result.returncode == 2
+    assert "does not run with --workers" in result.stderr
@@ -0,0 +1,204 @@
+from collections import Counter
+import numpy as np
+from decoding import decode_scores
+
+# Tiered variable mapping (eval.py --tiers): the variables that are easy to map are fixed by the tiers below.
+#   name       a variable of the incorrect program whose name is also a variable of the correct one maps to it
+#   signature  a variable whose signature is unique among the variables left in the incorrect program and matches
+#              a single candidate left in the correct one maps to it. The signature is the declared type (the type
+#              of the variable node, "Var-<type>") and the number of WRITE, READ and CHRONO edges of the variable
+#              in the gen_progs_repr.py graph
+#   gnn        the variables still left map to the candidates no tier has taken (to all of them when none is left)
+#              by the model's scores
+# The model only scores the variables left against the candidates left: their vars2id are cut down to them and,
+# when the model's number of message passing rounds is known, the graphs to the receptive field of these variables
+# (eval.receptive_field), so the nodes that only reach fixed variables are not embedded. The variables left have the
+# same embeddings as on the whole graphs, the fixed variables' nodes within reach still carry messages for them.
+# A model caching the node states of whole graphs (embedding store, incremental) keeps its graphs whole. The pairs
+# whose variables are all fixed skip the model.
+# The distributions written for prog_fixer.py are not masked: a fixed variable gets most of the mass on its
+# counterpart and exp(-fallback) of it on every other candidate, and a variable mapped by the model gets its scores
+# on the candidates left and fallback less than its lowest score on the taken ones, so a wrong tier match can still
+# be backed out of.
+tiers = ["name", "signature"]
+
+# edge types of gen_progs_repr.py
+AST_EDGE, CHILD_EDGE, WRITE_EDGE, READ_EDGE, CHRONO_EDGE = range(5)
+
+# score of the candidates a variable cannot map to
+excluded = -1e9
+# score, relative to its counterpart, of every other candidate of a fixed variable in the distributions
+fallback = 4.0
+
+
+def signatures(ast):
+    # {variable: (declared type, writes, reads, CHRONO edges between its occurrences)}
+    var_of = {ast['vars2id'][k]: k for k in ast['vars2id']}
+    writes = Counter()
+    reads = Counter()
+    occurrence_of = {}
+    for src, dst, rel in ast['edges']:
+        if rel == WRITE_EDGE and dst in var_of:
+            writes[var_of[dst]] += 1
+        elif rel == READ_EDGE and src in var_of:
+            reads[var_of[src]] += 1
+        elif rel == AST_EDGE and src in var_of and dst not in var_of:
+            occurrence_of[dst] = var_of[src]
+    chronos = Counter(occurrence_of[src] for src, dst, rel in ast['edges'] if rel == CHRONO_EDGE and src in occurrence_of)
+
+    return {k: (ast['nodes2types'][ast['vars2id'][k]], writes[k], reads[k], chronos[k]) for k in ast['vars2id']}
+
+
+def tier_mapping(left_ast, right_ast, tiers=tiers):
+    # {variable: (counterpart, tier)} of the variables of the incorrect program the tiers fix
+    fixed = {}
+    if "name" in tiers:
+        for k in left_ast['vars2id']:
+            if k in right_ast['vars2id']:
+                fixed[k] = (k, "name")
+
+    if "signature" in tiers:
+        taken = {v for v, _ in fixed.values()}
+        left = {k: s for k, s in signatures(left_ast).items() if k not in fixed}
+        right = {k: s for k, s in signatures(right_ast).items() if k not in taken}
+        left_counts = Counter(left.values())
+        right_counts = Counter(right.values())
+        right_of = {s: k for k, s in right.items()}
+        for k, s in left.items():
+            if left_counts[s] == 1 and right_counts[s] == 1:
+                fixed[k] = (right_of[s], "signature")
+
+    return fixed
+
+
+def restricted(ast, variables):
+    # ast with only {variables} in its vars2id, in the same order
+    return dict(ast, vars2id={k: ast['vars2id'][k] for k in ast['vars2id'] if k in variables})
+
+
+def caches_graphs(model):
+    # whether the model keeps node states keyed by whole program graphs, which cut-down graphs would miss
+    return getattr(model, "embedding_store", None) is not None or getattr(model, "incremental", None) is not None
+
+
+class TieredMapper:
+
+    def __init__(self, model, tiers=tiers):
+        self.model = model
+        self.tiers = list(tiers)
+        self.reset_counts()
+
+    def reset_counts(self):
+        # variables fixed by every tier, pairs mapped, pairs mapped without running the model, and nodes embedded
+        # by the model against the nodes of the pairs' graphs
+        self.resolved = Counter({tier: 0 for tier in self.tiers + ["gnn"]})
+        self.pairs = 0
+        self.skipped = 0
+        self.nodes = [0, 0]
+
+    def take_counts(self):
+        # the counts since the last call, which are reset: the workers of a WorkerPool send theirs to the parent
+        counts = (dict(self.resolved), self.pairs, self.skipped, list(self.nodes))
+        self.reset_counts()
+        return counts
+
+    def add_counts(self, counts):
+        resolved, pairs, skipped, nodes = counts
+        self.resolved.update(resolved)
+        self.pairs += pairs
+        self.skipped += skipped
+        self.nodes = [a + b for a, b in zip(self.nodes, nodes)]
+
+    @property
+    def decoding(self):
+        return self.model.decoding
+
+    @decoding.setter
+    def decoding(self, decoding):
+        self.model.decoding = decoding
+
+    @property
+    def as_array(self):
+        return getattr(self.model, "as_array", None)
+
+    @property
+    def message_passing_rounds(self):
+        return getattr(self.model, "message_passing_rounds", None)
+
+    def share_memory(self):
+        # see worker_pool.py
+        if hasattr(self.model, "share_memory"):
+            self.model.share_memory()
+
+    def reduced_sample(self, sample, fixed):
+        # the sample of the variables left and the candidates left (all of them when none is left), on the
+        # receptive field of these variables
+        left, right = sample
+        taken = {v for v, _ in fixed.values()}
+        left_ast = restricted(left[3], [k for k in left[3]['vars2id'] if k not in fixed])
+        right_ast = restricted(right[3], [k for k in right[3]['vars2id'] if k not in taken] or list(right[3]['vars2id']))
+        if caches_graphs(self.model) or self.message_passing_rounds is None:
+            return tuple(left[:3]) + (left_ast,), tuple(right[:3]) + (right_ast,)
+
+        from eval import preprocess_data_test_time
+        return preprocess_data_test_time(left_ast, right_ast, self.as_array, self.message_passing_rounds)
+
+    def scores(self, left_ast, right_ast, fixed, result=None):
+        # [left vars, right vars] scores: a single candidate for the fixed variables, the model's scores over the
+        # candidates it scored for the others
+        vars_right = list(right_ast['vars2id'])
+        scores = np.full((len(left_ast['vars2id']), len(vars_right)), excluded, dtype=np.float32)
+        for e, k in enumerate(left_ast['vars2id']):
+            if k in fixed:
+                scores[e, vars_right.index(fixed[k][0])] = 0.0
+            else:
+                row, candidates = result[1][k]
+                scores[e, [vars_right.index(v) for v in candidates]] = row[0]
+
+        return scores
+
+    def distributions(self, left_ast, right_ast, fixed, result=None):
+        # var_map_dist of the pair: fixed variables get 0 on their counterpart and -fallback on the other
+        # candidates, the others the model's scores on the candidates it scored and their lowest score - fallback
+        # on the rest
+        vars_right = list(right_ast['vars2id'])
+        var_map_dist = {}
+        for k in left_ast['vars2id']:
+            if k in fixed:
+                scores = [0.0 if v == fixed[k][0] else -fallback for v in vars_right]
+            else:
+                row, candidates = result[1][k]
+                model_scores = dict(zip(candidates, (float(s) for s in row[0])))
+                lowest = min(model_scores.values()) - fallback
+                scores = [model_scores.get(v, lowest) for v in vars_right]
+            var_map_dist[k] = ([scores], vars_right)
+
+        return var_map_dist
+
+    def predict_batch(self, samples):
+        fixed = [tier_mapping(left[3], right[3], self.tiers) for left, right in samples]
+        # the pairs with variables left run the model on their reduced samples, in one batch
+        remaining = [e for e, (left, _) in enumerate(samples) if len(fixed[e]) < len(left[3]['vars2id'])]
+        reduced = [self.reduced_sample(samples[e], fixed[e]) for e in remaining]
+        results = dict(zip(remaining, self.model.predict_batch(reduced))) if remaining else {}
+
+        outputs = []
+        for e, (left, right) in enumerate(samples):
+            self.resolved.update(tier for _, tier in fixed[e].values())
+            self.resolved["gnn"] += len(left[3]['vars2id']) - len(fixed[e])
+            var_map, _ = decode_scores(self.scores(left[3], right[3], fixed[e], results.get(e)), left[3], right[3], self.decoding)
+            outputs.append((var_map, self.distributions(left[3], right[3], fixed[e], results.get(e))))
+        self.pairs += len(samples)
+        self.skipped += len(samples) - len(remaining)
+        self.nodes[0] += sum(len(side[0]) for sample in reduced for side in sample)
+        self.nodes[1] += sum(len(side[0]) for sample in samples for side in sample)
+
+        return outputs
+
+    def test_time_output(self, sample):
+        return self.predict_batch([sample])[0]
+
+    def report(self):
+        return "Variables resolved: {t}; pairs mapped without the model: {s}/{p}; nodes embedded: {n}/{w}".format(
+            t=", ".join("{n} {c}".format(n=tier, c=self.resolved[tier]) for tier in self.tiers + ["gnn"]), s=self.skipped, p=self.pairs,
+            n=self.nodes[0], w=self.nodes[1])
@@ -5,7 +5,12 @@ from pathlib import Path
 import torch
 import random
 from gnn import VariableMappingGNN
+from tune_parallelism import load_profile, set_torch_threads
+from profiling import Profiler, span
+import atexit
 import argparse
+import multiprocessing
+import time
 
 data_dir="data"
 
@@ -103,9 +108,142 @@ def preprocess_data(left_ast, right_ast, varmap, sample_spec):
 
     return ((left_node_types, left_edge_index_pairs, left_edge_types, left_ast), (right_node_types, right_edge_index_pairs, right_edge_types, right_ast), labels, sample_spec)
 
+def load_samples(files):
+    # the preprocessed sample of every (var_map file, incorrect AST file, correct AST file)
+    samples = []
+    for sample_specification, left_ast_file, right_ast_file in files:
+        with span("load_ast"):
+            with gzip.open(sample_specification, 'rb') as f:
+                varmap = pickle.load(f)
+
+            with gzip.open(left_ast_file, 'rb') as f:
+                left_ast = pickle.load(f)
+
+            with gzip.open(right_ast_file, 'rb') as f:
+                right_ast = pickle.load(f)
+
+        with span("preprocess"):
+            samples.append(preprocess_data(left_ast, right_ast, varmap, sample_specification))
+
+    return samples
+
+# Sample loading pool (--workers): the var_map files of the student directories are listed and the samples are
+# loaded (gunzip, unpickle, preprocess_data) by forked worker processes. imap returns them in the order of the
+# inputs, and every random choice is still made by the parent, so the samples and their order do not depend on
+# the number of workers. The workers return every sample with its tensors as NumPy arrays and its ASTs reduced to
+# the vars2id training reads, which are pickled compactly (tensors would be passed as shared memory file
+# descriptors, one per tensor); the parent turns the arrays back into tensors without copying them.
+
+def _loading_worker():
+    import profiling
+    # the spans of the parent's profiler, if any, are not recorded in the workers
+    profiling._active = None
+    torch.set_num_threads(1)
+
+def loading_pool(workers):
+    # None (loading in this process) for a single worker; 0 workers is one per core
+    if workers == 0:
+        from tune_parallelism import available_cores
+        workers = available_cores()
+    if workers <= 1:
+        return None
+    return multiprocessing.get_context("fork").Pool(workers, initializer=_loading_worker)
+
+def pool_map(pool, function, items, chunksize=None):
+    # [function(item) for item in items], in order, on the pool if there is one
+    items = list(items)
+    if pool is None:
+        return [function(item) for item in items]
+    if chunksize is None:
+        # about four chunks per worker to even out the load, without one round trip per item
+        chunksize = max(1, min(64, len(items) // (4 * pool._processes)))
+    return list(pool.imap(function, items, chunksize))
+
+def var_map_files(path):
+    return [p for p in path.rglob("*") if p.name.startswith("var_map")]
+
+def load_compact_sample(files):
+    sample = load_samples([files])[0]
+    sides = [tuple(t.numpy() for t in side[:3]) + ({'vars2id': side[3]['vars2id']},) for side in sample[:2]]
+    return sides[0], sides[1], sample[2], sample[3]
+
+def load_samples_pooled(files, pool):
+    if pool is None:
+        return load_samples(files)
+    with span("load_samples"):
+        samples = pool_map(pool, load_compact_sample, files)
+    return [tuple(tuple(torch.from_numpy(a) for a in side[:3]) + (side[3],) for side in sample[:2]) + tuple(sample[2:]) for sample in samples]
+
+def collate(samples):
+    # labels padded to [samples, max variables] with -100 (ignored by the loss); each label is weighted by
+    # 1 / number of labels of its sample, as the loss of a sample is the mean over its variables
+    num_vars = max(len(sample[0][3]['vars2id']) for sample in samples)
+    labels = torch.full((len(samples), num_vars), -100, dtype=torch.long)
+    weights = torch.zeros(len(samples), num_vars)
+
+    for e, sample in enumerate(samples):
+        lab = sample[2]
+        # rows without label and labels without row are dropped
+        n = min(len(lab), len(sample[0][3]['vars2id']))
+        if n > 0:
+            labels[e, :n] = torch.as_tensor(lab[:n], dtype=torch.long)
+            weights[e, :n] = 1.0 / len(lab)
+
+    return samples, labels, weights
+
+def graph_size(sample):
+    return len(sample[0][0]) + len(sample[1][0])
+
+def size_buckets(samples, batch_size, pool_factor=20):
+    # batches of samples with similar graph sizes, so that little is spent on padding: the (already shuffled)
+    # samples are sorted by size within pools of {pool_factor} batches, and the batches are shuffled afterwards
+    batches = []
+    pool_size = batch_size * pool_factor
+    for p in range(0, len(samples), pool_size):
+        pool = sorted(samples[p:p + pool_size], key=graph_size)
+        batches += [pool[b:b + batch_size] for b in range(0, len(pool), batch_size)]
+    random.shuffle(batches)
+
+    return [collate(batch) for batch in batches]
+
+def compare_models(models, samples, batch_size):
+    # accuracy, fully correct samples, agreement with the first model's mappings and per-pair mapping latency
+    # of every (name, model) on the same samples
+    batches = [collate(samples[b:b + batch_size]) for b in range(0, len(samples), batch_size)]
+    print('%-10s%10s%8s%12s%16s%12s%12s' % ('model', 'channels', 'rounds', 'accuracy', 'fully correct', 'agreement', 'ms/pair'))
+    reference = []
+    for name, gnn in models:
+        gnn.eval()
+        corr = 0
+        total = 0
+        fully_correct = []
+        predictions = []
+        with torch.no_grad():
+            for batch_samples, labels, _ in batches:
+                dot_products = gnn.batch_output(batch_samples)
+                labelled = labels.to(gnn.device) != -100
+                predicted = dot_products.argmax(dim=2)
+                correct = (predicted == labels.to(gnn.device)) & labelled
+                corr += int(correct.sum())
+                total += int(labelled.sum())
+                fully_correct += (correct.sum(dim=1) == labelled.sum(dim=1)).tolist()
+                predictions.append(predicted[labelled])
+
+            # latency-sensitive repair maps one pair at a time
+            time_0 = time.perf_counter()
+            for sample in samples:
+                gnn.test_time_output(sample[:2])
+            latency = (time.perf_counter() - time_0) / len(samples)
+
+        predictions = torch.cat(predictions)
+        reference = reference if len(reference) else predictions
+        print('%-10s%10d%8d%11.1f%%%15.1f%%%11.1f%%%9.3f ms' % (name, gnn.channels, gnn.message_passing_rounds, corr / total * 100,
+              np.mean(fully_correct) * 100, float((predictions == reference).float().mean()) * 100, latency * 1000))
+
 
 if __name__ == "__main__":
-    torch.set_num_threads(20)
+    # 20 threads unless tune_parallelism.py wrote a profile for this machine
+    set_torch_threads(load_profile(), "training")
     parser = argparse.ArgumentParser(description='Train a model.')
     parser.add_argument('--error', type=str,
                         help='What bug we want to train on.')
@@ -116,6 +254,17 @@ if __name__ == "__main__":
     parser.add_argument('--samplecap', type=int,
                         help='How many samples to take from each folder.')
     parser.add_argument('--edgetypes', type=str, help='comma-separated list of which edgetypes to used')
+    parser.add_argument('--batchsize', type=int, default=1, help='How many samples are packed in each forward pass.')
+    parser.add_argument('--accumulate', type=int, default=1, help='How many batches are accumulated before each optimizer step.')
+    parser.add_argument('--profile', nargs='?', const='training-profile.json', help='Profiles the run with the torch profiler plus wall-clock spans of the AST reading, preprocessing, batching and steps (see profiling.py). Writes a Chrome trace to this file (default training-profile.json) and prints a summary, also written next to it.')
+    parser.add_argument('--channels', type=int, help='Channels of the model trained (default 32 for a new model); models of another size than the default are saved with their architecture.')
+    parser.add_argument('--rounds', type=int, help='Message passing rounds of the model trained (default 5).')
+    parser.add_argument('--distill', type=str, help='Trained teacher model (.pt): the model trained, usually a smaller one (--channels, --rounds), also learns to match the teacher\'s per-variable score distributions. Teacher and student are compared on the validation split at the end.')
+    parser.add_argument('--temperature', type=float, default=2.0, help='With --distill, temperature softening both score distributions.')
+    parser.add_argument('--alpha', type=float, default=0.5, help='With --distill, weight of the loss on the labels; the distillation loss gets 1 - alpha.')
+    parser.add_argument('--cache', nargs='?', const=f"{data_dir}/cache", help='Directory of the compiled training samples (default data/cache): the samples of this --error, --edgetypes and sample cap are read from there, and compiled there first when missing or when a source file changed (see dataset_cache.py).')
+    parser.add_argument('--workers', type=int, default=1, help='Processes listing and loading the samples (0: one per core). The samples and their order are the same for any number of workers.')
+    parser.add_argument('--checkpoint', action='store_true', help='Recompute the message passing rounds in backward instead of keeping their activations (less memory on large programs, slower steps).')
 
 
     args = parser.parse_args()
@@ -133,6 +282,12 @@ if __name__ == "__main__":
     errorlist = ["wrong_comp_op", "variable_misuse", "expression_deletion", "all"]
     
     ablation_edges = [int(k) for k in args.edgetypes.split(",")]
+    # forked once ablation_edges (read by preprocess_data) is set, before the profiler starts and before any torch
+    # operator runs
+    pool = loading_pool(args.workers)
+    if args.profile:
+        # written when the run ends, however it ends
+        atexit.register(Profiler(args.profile).start().stop)
     
     error = args.error
     if error not in errorlist:
@@ -245,113 +400,109 @@ if __name__ == "__main__":
     
     error_files = []
 
-    train_samples = []
-    for path in training_data:
-
-        files_c = []
-        files_ast = []
-        files_varmap = []
-
-        for p in path.rglob("*"):
-
-            if p.name.startswith("var_map"):
-                files_varmap.append(p)
-
-
-
-        random.shuffle(files_varmap)
+    walked = None
+    if args.cache:
+        from dataset_cache import read_walked, load_or_compile
+        config = {"error": error, "edgetypes": ablation_edges, "samplecap": student_sample_cap}
+        # the samples of the last run, when none of the student directories nor of the sample files changed
+        walked = read_walked(args.cache, config, training_data + val_data, 2)
 
-        for sample_specification in files_varmap[:student_sample_cap]:
+    if walked is None:
+        # var_map files of every student directory
+        student_var_maps = dict(zip(training_data + val_data, pool_map(pool, var_map_files, training_data + val_data)))
 
-            original_mutation_file = sample_specification.parents[0].name
+        # (var_map file, incorrect AST file, correct AST file) of every sample
+        train_files = []
+        for path in training_data:
 
-            prefix = "var_map-"
-            postfix = ".pkl.gz"
+            files_c = []
+            files_ast = []
+            files_varmap = list(student_var_maps[path])
 
-            tmp_str = str(sample_specification.name)[len(prefix):]
-            tmp_str = tmp_str[:(len(tmp_str) - len(postfix))]
 
-            left, right = tmp_str.split("_")
 
+            random.shuffle(files_varmap)
 
-            if not all([k == '0' for k in right]):
-                # if not (int(left) == 0 and int(right) == 0):
-                left_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + right + postfix
-                right_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + left + postfix
+            for sample_specification in files_varmap[:student_sample_cap]:
 
-                student = str(right_ast_file).replace("mutilated_programs", "C-Pack-IPAs_blocks/correct_submissions")
-                student = Path(student)
-                student_stump = student.parents[0].parents[0].parents[0].parents[0].parents[0]
-                student = Path(right_ast_file).parents[0].parents[0].name
+                original_mutation_file = sample_specification.parents[0].name
 
-                correct_file_path = str(student_stump.absolute()) + "/ast-" + student + ".pkl.gz"
-                right_ast_file = correct_file_path
-                # print(left_ast_file)
-                # print(right_ast_file)
-                # assert 2 > 3
+                prefix = "var_map-"
+                postfix = ".pkl.gz"
 
-                with gzip.open(sample_specification, 'rb') as f:
-                    varmap = pickle.load(f)
-                    print(varmap)
+                tmp_str = str(sample_specification.name)[len(prefix):]
+                tmp_str = tmp_str[:(len(tmp_str) - len(postfix))]
 
-                with gzip.open(left_ast_file, 'rb') as f:
-                    left_ast = pickle.load(f)
+                left, right = tmp_str.split("_")
 
-                with gzip.open(right_ast_file, 'rb') as f:
-                    right_ast = pickle.load(f)
 
-                # perhaps also add the right to left combo
-                train_samples.append(preprocess_data(left_ast, right_ast, varmap, sample_specification))
+                if not all([k == '0' for k in right]):
+                    # if not (int(left) == 0 and int(right) == 0):
+                    left_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + right + postfix
+                    right_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + left + postfix
 
+                    student = str(right_ast_file).replace("mutilated_programs", "C-Pack-IPAs_blocks/correct_submissions")
+                    student = Path(student)
+                    student_stump = student.parents[0].parents[0].parents[0].parents[0].parents[0]
+                    student = Path(right_ast_file).parents[0].parents[0].name
 
-    # assert 2 > 3
-    val_samples = []
-    for path in val_data:
-
-        files_c = []
-        files_ast = []
-        files_varmap = []
+                    correct_file_path = str(student_stump.absolute()) + "/ast-" + student + ".pkl.gz"
+                    right_ast_file = correct_file_path
+                    # print(left_ast_file)
+                    # print(right_ast_file)
+                    # assert 2 > 3
 
-        for p in path.rglob("*"):
+                    # perhaps also add the right to left combo
+                    train_files.append((sample_specification, left_ast_file, right_ast_file))
 
-            if p.name.startswith("var_map"):
-                files_varmap.append(p)
 
-        for sample_specification in files_varmap[:student_sample_cap]:
-            print(sample_specification)
-            # try:
-            prefix = "var_map-"
-            postfix = ".pkl.gz"
+        # assert 2 > 3
+        val_files = []
+        for path in val_data:
 
-            tmp_str = str(sample_specification.name)[len(prefix):]
-            tmp_str = tmp_str[:(len(tmp_str) - len(postfix))]
+            files_c = []
+            files_ast = []
+            files_varmap = list(student_var_maps[path])
 
-            left, right = tmp_str.split("_")
+            for sample_specification in files_varmap[:student_sample_cap]:
+                print(sample_specification)
+                # try:
+                prefix = "var_map-"
+                postfix = ".pkl.gz"
 
-            print("Program Names: ")
-            print(left, right)  #
-            if not all([k == '0' for k in right]):
-                left_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + right + postfix
-                right_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + left + postfix
+                tmp_str = str(sample_specification.name)[len(prefix):]
+                tmp_str = tmp_str[:(len(tmp_str) - len(postfix))]
 
-                student = str(right_ast_file).replace("mutilated_programs", "C-Pack-IPAs_blocks/correct_submissions")
-                student = Path(student)
-                student_stump = student.parents[0].parents[0].parents[0].parents[0].parents[0]
-                student = Path(right_ast_file).parents[0].parents[0].name
+                left, right = tmp_str.split("_")
 
-                correct_file_path = str(student_stump.absolute()) + "/ast-" + student + ".pkl.gz"
+                print("Program Names: ")
+                print(left, right)  #
+                if not all([k == '0' for k in right]):
+                    left_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + right + postfix
+                    right_ast_file = str(sample_specification.parents[0]) + "/" + "ast-" + left + postfix
 
-                with gzip.open(sample_specification, 'rb') as f:
-                    varmap = pickle.load(f)
+                    student = str(right_ast_file).replace("mutilated_programs", "C-Pack-IPAs_blocks/correct_submissions")
+                    student = Path(student)
+                    student_stump = student.parents[0].parents[0].parents[0].parents[0].parents[0]
+                    student = Path(right_ast_file).parents[0].parents[0].name
 
-                with gzip.open(left_ast_file, 'rb') as f:
-                    left_ast = pickle.load(f)
+                    correct_file_path = str(student_stump.absolute()) + "/ast-" + student + ".pkl.gz"
 
-                with gzip.open(right_ast_file, 'rb') as f:
-                    right_ast = pickle.load(f)
+                    # perhaps also add the right to left combo
+                    val_files.append((sample_specification, left_ast_file, right_ast_file))
 
-                # perhaps also add the right to left combo
-                val_samples.append(preprocess_data(left_ast, right_ast, varmap, sample_specification))
+    if walked is not None:
+        train_samples, val_samples = walked
+    elif args.cache:
+        train_samples, val_samples = load_or_compile(args.cache, config, [train_files, val_files], lambda files: load_samples_pooled(files, pool),
+                                                     training_data + val_data)
+    else:
+        train_samples = load_samples_pooled(train_files, pool)
+        val_samples = load_samples_pooled(val_files, pool)
+    if pool is not None:
+        pool.close()
+    # the shuffles of the epochs do not depend on whether the walk ran or its samples were read from the cache
+    random.seed(18)
 
     # Some global information about which types of nodes exist
     with gzip.open("types2int.pkl.gz", 'rb') as f:
@@ -364,15 +515,23 @@ if __name__ == "__main__":
     print(error_files)
     print(len(error_files))
 
-    gnn = VariableMappingGNN(num_types, device).to(device)
+    config = {k: v for k, v in [("channels", args.channels), ("message_passing_rounds", args.rounds)] if v is not None}
+    gnn = VariableMappingGNN(num_types, device, **config).to(device)
+    gnn.checkpoint_rounds = args.checkpoint
 
-    loss = torch.nn.CrossEntropyLoss()
+    teacher = None
+    if args.distill:
+        from eval import load_model
+        teacher = load_model(args.distill, num_types).to(device)
+        teacher.device = device
+        teacher.eval()
+
+    loss = torch.nn.CrossEntropyLoss(reduction="none")
     optimizer = torch.optim.Adam(gnn.parameters())
 
 
     print(len(training_data), len(train_samples))
     print(len(val_data), len(val_samples))
-    assert 2>3
 
     acc_list = []
     fc_l = []
@@ -385,27 +544,48 @@ if __name__ == "__main__":
         ep_corr = 0
         ep_total = 0
         random.shuffle(train_samples)
-        for j in tqdm(range(len(train_samples))):
-
-            gnn.train_step(train_samples[j], loss, optimizer)
+        with span("batching"):
+            train_batches = size_buckets(train_samples, args.batchsize)
+        optimizer.zero_grad()
+        for j in tqdm(range(len(train_batches))):
+
+            with span("train_step"):
+                if teacher is None:
+                    batch_loss = gnn.batch_loss(train_batches[j], loss) / args.accumulate
+                else:
+                    batch_loss = gnn.batch_distillation_loss(train_batches[j], loss, teacher, args.temperature, args.alpha) / args.accumulate
+                batch_loss.backward()
+                if (j + 1) % args.accumulate == 0 or j == len(train_batches) - 1:
+                    optimizer.step()
+                    optimizer.zero_grad()
 
         random.shuffle(val_samples)
+        with span("batching"):
+            val_batches = size_buckets(val_samples, args.batchsize)
         fully_correct_list = []
         with torch.no_grad():
-            for j in tqdm(range(len(val_samples))):
+            for j in tqdm(range(len(val_batches))):
 
-                corr, total, fully_correct = gnn.eval_step(val_samples[j], loss)
+                with span("eval_step"):
+                    corr, total, fully_correct = gnn.eval_batch_step(val_batches[j])
 
                 ep_corr += corr
                 ep_total += total
-                fully_correct_list.append(fully_correct)
+                fully_correct_list += fully_correct
 
             print(f"Epoch Evaluation Accuracy: {ep_corr} / {ep_total}")
             print(f"Epoch Evaluation Samples Fully Correct: {np.mean(fully_correct_list) * 100} %")
             fc_l.append(np.mean(fully_correct_list) * 100)
             acc_list.append(float(ep_corr) / float(ep_total))
 
-    torch.save(gnn.state_dict(), f"{data_dir}/{expname}.pt")
+    if config:
+        # eval.load_model rebuilds the model from its config
+        torch.save({"config": config, "state_dict": gnn.state_dict()}, f"{data_dir}/{expname}.pt")
+    else:
+        torch.save(gnn.state_dict(), f"{data_dir}/{expname}.pt")
+
+    if teacher is not None:
+        compare_models([("teacher", teacher), ("student", gnn)], val_samples, args.batchsize)
 
 # Example command
 # python -u training.py --error variable_misuse --gpu 0 --samplecap 1 --expname dev_cl
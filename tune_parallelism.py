@@ -0,0 +1,195 @@
+import argparse
+from sys import argv
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Parallelism profile of a machine, written by this script and read by training.py, eval.py, mapping_server.py,
+# prog_fixer.py (through helper.check_program) and the shell drivers:
+#   cores                          CPU cores available to this process
+#   training / inference           torch intra-op and inter-op threads
+#   mapping_workers                eval.py / mapping processes run side by side
+#   repair_workers                 prog_fixer.py processes run side by side by the drivers
+#   gcc_jobs                       prog_checker.sh compilations run at the same time, across all the processes
+# Without a profile every setting keeps its previous default (training uses 20 threads, the rest is unbounded).
+default_profile = os.environ.get("GNN_PARALLELISM_PROFILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "parallelism_profile.json"))
+default_settings = {"cores": None,
+                    "training": {"intra_op_threads": 20, "inter_op_threads": None},
+                    "inference": {"intra_op_threads": None, "inter_op_threads": None},
+                    "mapping_workers": None, "repair_workers": None, "gcc_jobs": None}
+
+# a setting is chosen as the smallest one within this fraction of the best measured time
+tolerance = 0.1
+
+_profiles = {}
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def load_profile(path=default_profile):
+    if path not in _profiles:
+        profile = json.loads(json.dumps(default_settings))
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            for k in saved:
+                if isinstance(profile.get(k), dict):
+                    profile[k].update(saved[k])
+                else:
+                    profile[k] = saved[k]
+        _profiles[path] = profile
+    return _profiles[path]
+
+
+def set_torch_threads(profile, role):
+    import torch
+
+    threads = profile[role]
+    if threads["intra_op_threads"]:
+        torch.set_num_threads(threads["intra_op_threads"])
+    if threads["inter_op_threads"]:
+        # can only be set before torch runs its first inter-op parallel work
+        try:
+            torch.set_num_interop_threads(threads["inter_op_threads"])
+        except RuntimeError:
+            pass
+
+
+def candidates(cores):
+    counts = []
+    c = 1
+    while c < cores:
+        counts.append(c)
+        c *= 2
+    return counts + [cores]
+
+
+def smallest_within_tolerance(times):
+    # times is {setting: seconds}; the fastest settings are often only marginally better than a much smaller one
+    best = min(times.values())
+    return min(k for k in times if times[k] <= best * (1 + tolerance))
+
+
+def random_sample(num_types, nodes, edges, num_vars, generator):
+    import torch
+
+    def side():
+        node_types = torch.randint(num_types, (nodes,), generator=generator)
+        edge_pairs = torch.randint(nodes, (edges, 2), generator=generator)
+        edge_types = torch.randint(5, (edges,), generator=generator)
+        vars2id = {"v{i}".format(i=i): i for i in range(num_vars)}
+        return node_types, edge_pairs, edge_types, {"vars2id": vars2id}
+
+    return side(), side()
+
+
+def time_threads(work, threads, n):
+    import torch
+
+    times = {}
+    for t in threads:
+        torch.set_num_threads(t)
+        work()
+        time_0 = time.time()
+        for i in range(n):
+            work()
+        times[t] = (time.time() - time_0) / n
+    return times
+
+
+def tune_torch(cores, num_types=161, batch_size=32, n=5, verbose=False):
+    import torch
+    from gnn import VariableMappingGNN
+
+    generator = torch.Generator().manual_seed(0)
+    model = VariableMappingGNN(num_types, torch.device("cpu"), backend="auto")
+    # graphs of the size of the C-Pack-IPAs programs
+    batch = [random_sample(num_types, 200, 400, 6, generator) for i in range(batch_size)]
+    pair = random_sample(num_types, 200, 400, 6, generator)
+
+    def training_step():
+        model.zero_grad()
+        model.batch_output(batch).logsumexp(dim=2).sum().backward()
+
+    def inference():
+        with torch.no_grad():
+            model.test_time_output(pair)
+
+    training = time_threads(training_step, candidates(cores), n)
+    inference = time_threads(inference, candidates(cores), n * 10)
+    if verbose:
+        print("training step (s) per intra-op threads:", training)
+        print("inference (s) per intra-op threads:", inference)
+
+    return smallest_within_tolerance(training), smallest_within_tolerance(inference)
+
+
+def tune_gcc(cores, n=8, verbose=False):
+    # throughput of concurrent compilations of a small program, like the ones prog_checker.sh compiles
+    gcc = shutil.which("gcc")
+    if gcc is None:
+        return cores
+
+    times = {}
+    with tempfile.TemporaryDirectory() as d:
+        program = os.path.join(d, "p.c")
+        with open(program, 'w') as f:
+            f.write("#include <stdio.h>\nint main(){int i, n, s = 0; scanf(\"%d\", &n); for (i = 0; i < n; i++) s += i; printf(\"%d\\n\", s); return 0;}\n")
+        for jobs in candidates(cores):
+            time_0 = time.time()
+            for i in range(0, n * jobs, jobs):
+                processes = [subprocess.Popen([gcc, program, "-o", os.path.join(d, "p-{j}".format(j=j))]) for j in range(jobs)]
+                for p in processes:
+                    p.wait()
+            times[jobs] = (time.time() - time_0) / (n * jobs)
+    if verbose:
+        print("compilation (s) per concurrent gcc jobs:", times)
+
+    return smallest_within_tolerance(times)
+
+
+def tune(shared=False, verbose=False):
+    cores = available_cores()
+    training_threads, inference_threads = tune_torch(cores, verbose=verbose)
+    gcc_jobs = tune_gcc(cores, verbose=verbose)
+
+    # when training shares the machine with the mapping and repair processes, these only get the cores left
+    spare = max(1, cores - training_threads) if shared else cores
+    return {"cores": cores,
+            "training": {"intra_op_threads": training_threads, "inter_op_threads": 1},
+            "inference": {"intra_op_threads": inference_threads, "inter_op_threads": 1},
+            "mapping_workers": max(1, spare // inference_threads),
+            "repair_workers": spare,
+            "gcc_jobs": min(gcc_jobs, spare)}
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='tune_parallelism.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-o', '--output', default=default_profile, help='Profile to write.')
+    parser.add_argument('-s', '--shared', action='store_true', default=False, help='Training runs on the same machine as the mapping and repair processes.')
+    parser.add_argument('-g', '--get', help='Prints one setting of the existing profile (e.g. repair_workers, training.intra_op_threads), for the shell drivers. Prints 0 when it is unbounded.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Prints the measurements.')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    args = parser()
+
+    if args.get:
+        value = load_profile(args.output)
+        for k in args.get.split("."):
+            value = value[k]
+        print(value or 0)
+    else:
+        profile = tune(args.shared, args.verbose)
+        with open(args.output, 'w') as f:
+            json.dump(profile, f, indent=2)
+        print("Parallelism profile written to {o}: {p}".format(o=args.output, p=json.dumps(profile)))
@@ -0,0 +1,241 @@
+#-----------------------------------------------------------------
+# Benchmarking the training and inference throughput of the variable
+# mapping GNN across architecture settings.
+#
+# Every combination of channels, message passing rounds and graph size is
+# run on synthetic program graphs (and on the pairs of an eval.py
+# --manifest file, if given) with a randomly initialised VariableMappingGNN:
+# the throughput does not depend on the weights.
+#
+# Run from the repository's root (types2int.pkl.gz is read from there):
+#   python utils/benchmark/benchmark-gnn-throughput.py --manifest pairs.jsonl -o gnn-throughput.json
+#-----------------------------------------------------------------
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+
+sys.path.extend(['.', '..'])
+
+import torch
+from torch_geometric.data import Batch
+from eval import preprocess_data_test_time, read_manifest
+from gnn import VariableMappingGNN
+from rgcn_backends import backends
+from training import collate
+from tune_parallelism import available_cores
+
+# edge types of gen_progs_repr.py
+AST_EDGE, CHILD_EDGE, WRITE_EDGE, READ_EDGE, CHRONO_EDGE = range(5)
+
+
+def synthetic_ast(num_nodes, num_types, rng):
+    """A program graph of num_nodes nodes shaped like the ones of gen_progs_repr.py.
+
+    The AST is a random tree (AST edges both ways, CHILD edges between
+    consecutive siblings) and one node in twenty is a variable: every
+    variable has its own node, linked to its occurrences (AST both ways
+    and a WRITE or READ edge) and its occurrences are chained by CHRONO
+    edges.
+    """
+    num_vars = max(2, num_nodes // 20)
+    num_ast = num_nodes - num_vars
+    edges = []
+    children = {}
+    for n in range(1, num_ast):
+        parent = rng.randrange(max(0, n - 8), n)
+        edges += [[parent, n, AST_EDGE], [n, parent, AST_EDGE]]
+        if parent in children:
+            edges.append([children[parent], n, CHILD_EDGE])
+        children[parent] = n
+
+    occurrences = {}
+    for n in rng.sample(range(1, num_ast), min(num_ast - 1, 3 * num_vars)):
+        occurrences.setdefault(num_ast + rng.randrange(num_vars), []).append(n)
+    for v in range(num_ast, num_nodes):
+        for e, n in enumerate(sorted(occurrences.get(v, []))):
+            edges += [[n, v, AST_EDGE], [v, n, AST_EDGE]]
+            edges.append([n, v, WRITE_EDGE] if rng.random() < 0.3 else [v, n, READ_EDGE])
+            if e > 0:
+                edges.append([previous, n, CHRONO_EDGE])
+            previous = n
+
+    return {'edges': edges,
+            'nodes2types': {n: rng.randrange(num_types) for n in range(num_nodes)},
+            'vars2id': {'v%d' % v: v for v in range(num_ast, num_nodes)}}
+
+
+def training_sample(sample, rng):
+    # (left, right, labels, spec) as training.preprocess_data builds them, with random labels
+    left, right = sample
+    labels = [rng.randrange(len(right[3]['vars2id'])) for _ in left[3]['vars2id']]
+    return left, right, labels, None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    # None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        return None
+
+
+def timed(stages, name, function, *args):
+    t1 = time.perf_counter()
+    result = function(*args)
+    stages.setdefault(name, []).append(time.perf_counter() - t1)
+    return result
+
+
+def inference_step(gnn, samples, stages):
+    # the steps of VariableMappingGNN.predict_batch, one stage at a time
+    left_asts = [left[3] for left, _ in samples]
+    right_asts = [right[3] for _, right in samples]
+    left_batch, right_batch = timed(stages, 'graphs', lambda: (Batch.from_data_list([gnn.graph_data(left) for left, _ in samples]),
+                                                               Batch.from_data_list([gnn.graph_data(right) for _, right in samples])))
+    left_mp_output, right_mp_output = timed(stages, 'message_passing', gnn.message_passing, left_batch, right_batch)
+
+    def decode():
+        dot_products, _, _ = gnn.batch_scores(left_asts, right_asts, left_mp_output, right_mp_output, left_batch.ptr, right_batch.ptr)
+        for e in range(len(samples)):
+            pair_scores = dot_products[e, :len(left_asts[e]['vars2id']), :len(right_asts[e]['vars2id'])]
+            gnn.decode(torch.tensor_split(pair_scores, len(left_asts[e]['vars2id'])), left_asts[e], right_asts[e], gnn.decoding)
+
+    timed(stages, 'scoring', decode)
+
+
+def training_step(gnn, batch, loss_function, optimizer, stages):
+    optimizer.zero_grad()
+    batch_loss = timed(stages, 'forward', gnn.batch_loss, batch, loss_function)
+    timed(stages, 'backward', batch_loss.backward)
+    timed(stages, 'optimizer', optimizer.step)
+
+
+def measure_throughput(gnn, samples, n, step):
+    """Measure n runs of step(stages) over a batch of len(samples) pairs, after one warm-up run.
+
+    Returns the pairs per second and the mean latency of every stage (ms)
+    of one batch.
+    """
+    step({})
+    stages = {}
+    times = []
+    for i in range(n):
+        t1 = time.perf_counter()
+        step(stages)
+        times.append(time.perf_counter() - t1)
+    return {'pairs_per_s': len(samples) / statistics.mean(times),
+            'batch_ms': statistics.mean(times) * 1000,
+            'stages_ms': {name: statistics.mean(t) * 1000 for name, t in stages.items()}}
+
+
+def run_config(config, samples, num_types, n, results):
+    # runs in its own forked process (see sweep), so that ru_maxrss is the peak of this configuration only;
+    # start_rss_mb is the resident size before the model is built
+    start_rss_mb = current_rss_mb()
+    torch.manual_seed(0)
+    rng = random.Random(0)
+    gnn = VariableMappingGNN(num_types, torch.device('cpu'), config['rounds'], config['channels'], config['backend'])
+    result = dict(config)
+
+    gnn.eval()
+    with torch.no_grad():
+        result['inference'] = measure_throughput(gnn, samples, n, lambda stages: inference_step(gnn, samples, stages))
+
+    gnn.train()
+    batch = collate([training_sample(sample, rng) for sample in samples])
+    loss_function = torch.nn.CrossEntropyLoss(reduction="none")
+    optimizer = torch.optim.Adam(gnn.parameters())
+    result['training'] = measure_throughput(gnn, samples, n, lambda stages: training_step(gnn, batch, loss_function, optimizer, stages))
+
+    result['start_rss_mb'] = start_rss_mb
+    result['peak_rss_mb'] = peak_rss_mb()
+    results.put(result)
+
+
+def sweep(configs, graphs, num_types, n):
+    # graphs is {graph set name: samples}; every configuration runs in a fresh forked process
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    results = []
+    print('%-30s%14s%14s%12s%12s%12s%12s' % ('graphs channels rounds', 'infer pairs/s', 'train pairs/s', 'mp ms', 'forward ms', 'backward ms', 'peak RSS'))
+    for name, samples in graphs.items():
+        nodes = [len(side[0]) for sample in samples for side in sample]
+        for config in configs:
+            config = dict(config, graphs=name, pairs=len(samples), mean_nodes=statistics.mean(nodes))
+            process = context.Process(target=run_config, args=(config, samples, num_types, n, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print('%-30s%14.1f%14.1f%12.3f%12.3f%12.3f%9.1f MB' % ('%s %d %d' % (name, config['channels'], config['rounds']),
+                  result['inference']['pairs_per_s'], result['training']['pairs_per_s'],
+                  result['inference']['stages_ms']['message_passing'], result['training']['stages_ms']['forward'],
+                  result['training']['stages_ms']['backward'], result['peak_rss_mb']), flush=True)
+            results.append(result)
+    return results
+
+
+def int_list(value):
+    return [int(k) for k in value.split(',')]
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='benchmark-gnn-throughput.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--manifest', help='eval.py --manifest file whose pairs are benchmarked as one batch, besides the synthetic graphs.')
+    parser.add_argument('--channels', type=int_list, default=[16, 32, 64], help='Comma-separated channels to sweep.')
+    parser.add_argument('--rounds', type=int_list, default=[3, 5, 7], help='Comma-separated message passing rounds to sweep.')
+    parser.add_argument('--sizes', type=int_list, default=[64, 256, 1024, 4096], help='Comma-separated numbers of nodes of the synthetic graphs.')
+    parser.add_argument('--batch_size', type=int, default=16, help='Number of synthetic pairs per batch.')
+    parser.add_argument('--backend', default='auto', choices=backends, help='RGCN backend, see rgcn_backends.py.')
+    parser.add_argument('-n', '--runs', type=int, default=NUM_RUNS, help='Measured runs of every configuration.')
+    parser.add_argument('-o', '--output', default='gnn-throughput.json', help='Where the results are written (JSON).')
+    return parser.parse_args(sys.argv[1:])
+
+
+NUM_RUNS = 5
+
+
+if __name__ == '__main__':
+    args = parser()
+    with gzip.open('types2int.pkl.gz', 'rb') as f:
+        num_types = pickle.load(f)['diff_types']
+
+    rng = random.Random(0)
+    graphs = {}
+    for size in args.sizes:
+        graphs['synthetic-%d' % size] = [preprocess_data_test_time(synthetic_ast(size, num_types, rng), synthetic_ast(size, num_types, rng))
+                                         for _ in range(args.batch_size)]
+    if args.manifest:
+        samples = []
+        for entry in read_manifest(args.manifest):
+            with gzip.open(entry['inc_ast'], 'rb') as f:
+                left_ast = pickle.load(f)
+            with gzip.open(entry['cor_ast'], 'rb') as f:
+                right_ast = pickle.load(f)
+            samples.append(preprocess_data_test_time(left_ast, right_ast))
+        graphs['real'] = samples
+
+    configs = [{'channels': channels, 'rounds': rounds, 'backend': args.backend} for channels in args.channels for rounds in args.rounds]
+    results = sweep(configs, graphs, num_types, args.runs)
+
+    with open(args.output, 'w') as f:
+        json.dump({'machine': {'platform': platform.platform(), 'cores': available_cores(), 'torch': torch.__version__,
+                               'torch_threads': torch.get_num_threads()},
+                   'runs': args.runs,
+                   'results': results}, f, indent=2)
+    print('Results written to', args.output)
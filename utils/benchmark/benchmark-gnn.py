@@ -0,0 +1,345 @@
+#-----------------------------------------------------------------
+# Benchmarking the per-pair inference latency of the variable mapping GNN
+# with the different inference engines available.
+#
+# Run from the repository's root (types2int.pkl.gz is read from there):
+#   python utils/benchmark/benchmark-gnn.py gnn_models/all.pt pairs.jsonl [other models...]
+# where pairs.jsonl is an eval.py --manifest file. With other models, the ensemble of all of them is
+# compared to mapping the pairs with one model after the other.
+# This only measures time and memory: that the engines and options map like the eager model is checked by the
+# tests (python -m pytest tests).
+#-----------------------------------------------------------------
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.extend(['.', '..'])
+
+import torch
+from eval import load_model, load_pair, predict, read_manifest
+from freeze_model import freeze, FrozenMapper
+from gnn import EarlyExit
+from incremental import attach_incremental
+from ensemble import Ensemble
+from tiered_mapper import TieredMapper
+from tune_parallelism import available_cores, candidates
+from worker_pool import WorkerPool
+from numpy_gnn import export, NumpyVariableMappingGNN
+from rgcn_backends import backends
+
+
+def measure_pairs(engine, samples, n, progress_cb):
+    """Measure the mapping of every (incorrect, correct) pair in samples.
+
+    n is the number of iterations to measure. progress_cb will be called
+    with the iteration number each time one is done.
+
+    Returns a list of mean per-pair times, one per iteration.
+    """
+    times = []
+    for i in range(n):
+        t1 = time.time()
+        for sample in samples:
+            engine.test_time_output(sample)
+        elapsed = time.time() - t1
+        times.append(elapsed / len(samples))
+        progress_cb(i)
+    return times
+
+
+def numpy_sample(sample):
+    return tuple((side[0].numpy(), side[1].numpy(), side[2].numpy(), side[3]) for side in sample)
+
+
+def as_engine_sample(engine, sample):
+    return numpy_sample(sample) if isinstance(engine, NumpyVariableMappingGNN) else sample
+
+
+def measure_engine(name, engine, samples, n):
+    progress_cb = lambda i: print('.', sep='', end='', flush=True)
+    print('%-25s' % name, end='', flush=True)
+    # warm-up, TorchScript optimises the graph on its first runs
+    engine_samples = [as_engine_sample(engine, sample) for sample in samples]
+    measure_pairs(engine, engine_samples, 2, lambda i: None)
+    times = measure_pairs(engine, engine_samples, n, progress_cb)
+    print('    Mean: %.3f ms  Stddev: %.3f ms' % (statistics.mean(times) * 1000, statistics.stdev(times) * 1000))
+
+
+def measure_backends_by_size(models, samples, n):
+    # mean per-pair time of every RGCN backend, with the pairs grouped by their number of edges
+    buckets = {}
+    for sample in samples:
+        edges = max(len(side[2]) for side in sample)
+        bucket = 1
+        while bucket < edges:
+            bucket *= 2
+        buckets.setdefault(bucket, []).append(sample)
+
+    print('%-25s' % 'edges <=', ''.join('%12s' % name for name, _ in models))
+    for bucket in sorted(buckets):
+        means = [statistics.mean(measure_pairs(model, buckets[bucket], n, lambda i: None)) for _, model in models]
+        fastest = models[means.index(min(means))][0]
+        print('%-25d' % bucket, ''.join('%9.3f ms' % (m * 1000) for m in means), '   fastest:', fastest)
+
+
+def measure_startup(model_locations, entry, n):
+    # wall time of a whole `eval.py` run mapping one pair, i.e. what every mapping of the shell drivers pays,
+    # dominated by the imports of the engine
+    with tempfile.TemporaryDirectory() as d:
+        for name, model_location in model_locations:
+            command = [sys.executable, 'eval.py', '-gm', model_location, '-ia', entry['inc_ast'], '-ca', entry['cor_ast'],
+                       '-m', os.path.join(d, 'vm.pkl.gz'), '-md', os.path.join(d, 'vmd.vmd'), '-t', os.path.join(d, 't.txt')]
+            times = []
+            for i in range(n):
+                t1 = time.time()
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                times.append(time.time() - t1)
+            print('%-25s    Mean: %.3f s  Stddev: %.3f s' % (name, statistics.mean(times), statistics.stdev(times)))
+
+
+def measure_precision_store(model_location, manifest, entry, n):
+    # eval.py --precision with --embedding_store: a run with an empty store, then n runs reading the correct
+    # program's embeddings from it. The accuracy check is disabled (-ad 1) so that the reduced precision is always
+    # used
+    for precision in ['int8', 'bf16']:
+        with tempfile.TemporaryDirectory() as d:
+            command = [sys.executable, 'eval.py', '-gm', model_location, '-ia', entry['inc_ast'], '-ca', entry['cor_ast'],
+                       '-m', os.path.join(d, 'vm.pkl.gz'), '-md', os.path.join(d, 'vmd.vmd'), '-t', os.path.join(d, 't.txt'),
+                       '-p', precision, '-ho', manifest, '-ad', '1', '-es', os.path.join(d, 'store')]
+            times = []
+            for i in range(n + 1):
+                t1 = time.time()
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                times.append(time.time() - t1)
+            print('%-25s    Empty store: %.3f s  Stored: %.3f s' % (precision + '-store', times[0], statistics.mean(times[1:])))
+
+
+def measure_early_exit(model_location, samples, tolerances, n):
+    # per-pair time and rounds with gnn.EarlyExit
+    full = load_model(model_location, backend='auto')
+    measure_engine('early-exit off', full, samples, n)
+    for tolerance in tolerances:
+        model = load_model(model_location, backend='auto')
+        model.early_exit = EarlyExit(tolerance)
+        for sample in samples:
+            model.test_time_output(sample)
+        rounds = model.early_exit.rounds[:]
+        measure_engine('early-exit tol=%g' % tolerance, model, samples, n)
+        print('%-25s    Mean rounds: %.2f' % ('', statistics.mean(rounds)))
+
+
+def measure_pruning(engines, entries, n):
+    # eval.py --prune: per-pair time on the receptive fields of the variables instead of the whole graphs
+    for name, engine in engines:
+        as_array = getattr(engine, 'as_array', None)
+        hops = engine.message_passing_rounds
+        whole = [load_pair(entry['inc_ast'], entry['cor_ast'], as_array) for entry in entries]
+        pruned = [load_pair(entry['inc_ast'], entry['cor_ast'], as_array, hops) for entry in entries]
+        kept = sum(len(side[0]) for sample in pruned for side in sample) / sum(len(side[0]) for sample in whole for side in sample)
+
+        times = [statistics.mean(measure_pairs(engine, samples, n, lambda i: None)) for samples in [whole, pruned]]
+        print('%-25s    Whole: %.3f ms  Pruned: %.3f ms  Nodes kept: %.1f%%' % (
+            'pruned-' + name, times[0] * 1000, times[1] * 1000, kept * 100))
+
+
+def measure_incremental(model_location, samples, n, max_dirty_fractions=(0.0, 0.5, 1.0)):
+    # per-pair time when the incorrect programs are embedded from the cached states of their correct program
+    # (incremental.py) and the fraction of the node rounds recomputed. The correct programs' states are cached
+    # before timing, as in a sweep over their mutilated programs; max_dirty_fraction 0 always runs full passes.
+    model = load_model(model_location, backend='auto')
+    for max_dirty_fraction in max_dirty_fractions:
+        times = []
+        for i in range(n):
+            incremental = attach_incremental(model, max_dirty_fraction)
+            for sample in samples:
+                incremental.add_base(sample[1])
+            recomputed, full_passes = incremental.recomputed, incremental.full_passes
+            t1 = time.time()
+            for sample in samples:
+                model.test_time_output(sample)
+            times.append((time.time() - t1) / len(samples))
+        print('%-25s    Mean: %.3f ms  Recomputed: %.1f%%  Full passes: %d/%d' % (
+            'incremental max=%g' % max_dirty_fraction, statistics.mean(times) * 1000, (incremental.recomputed - recomputed) / max(incremental.nodes, 1) * 100,
+            incremental.full_passes - full_passes, len(samples)))
+    model.incremental = None
+
+
+def measure_tiered(engines, entries, n):
+    # end-to-end time per pair (reading, preprocessing and mapping, i.e. eval.predict) of every engine without
+    # and with tiered_mapper.py, the variables each tier resolved and the nodes the model still embeds
+    pairs = [(entry['inc_ast'], entry['cor_ast']) for entry in entries]
+    tiered = TieredMapper(engines[0][1])
+    tiered.predict_batch([load_pair(*pair) for pair in pairs])
+    print('%-25s    %s' % ('tiers', tiered.report()))
+    for name, engine in engines:
+        tiered = TieredMapper(engine)
+        times = []
+        for model in [engine, tiered]:
+            t1 = time.time()
+            for i in range(n):
+                for pair in pairs:
+                    predict(model, *pair)
+            times.append((time.time() - t1) / (n * len(pairs)))
+        print('%-25s    Model: %.3f ms  Tiered: %.3f ms' % (name, times[0] * 1000, times[1] * 1000))
+
+
+def measure_ensemble(model_locations, entries, n):
+    # per-pair time of mapping with every model: one eval.py pipeline per model (each reads and preprocesses the
+    # pairs again) against an Ensemble mapping the shared samples, in one thread or one thread per model
+    models = [load_model(location, backend='auto') for location in model_locations]
+    pairs = [(entry['inc_ast'], entry['cor_ast']) for entry in entries]
+
+    def separately():
+        for model in models:
+            model.predict_batch([load_pair(l, r) for l, r in pairs])
+
+    def shared(ensemble):
+        return lambda: ensemble.predict_batch([load_pair(l, r) for l, r in pairs])
+
+    runs = [('ensemble separate', separately)]
+    for threads in [1, len(models)]:
+        for combined in [False, True]:
+            name = 'ensemble threads=%d%s' % (threads, ' +combined' if combined else '')
+            runs.append((name, shared(Ensemble(zip(model_locations, models), threads, combined))))
+    for name, run in runs:
+        run()
+        times = []
+        for i in range(n):
+            t1 = time.time()
+            run()
+            times.append((time.time() - t1) / len(pairs))
+        print('%-25s    Mean: %.3f ms  Stddev: %.3f ms' % (name, statistics.mean(times) * 1000, statistics.stdev(times) * 1000))
+
+
+def measure_worker_pool(model_location, entries, n):
+    # pairs per second of eval.py --workers for 1, 2, 4... workers up to the number of cores; scaling should be
+    # close to linear. The pairs are repeated so that every worker gets several batches.
+    pairs = [(entry['inc_ast'], entry['cor_ast']) for entry in entries] * max(1, 64 // len(entries))
+    base = None
+    for workers in candidates(available_cores()):
+        # a new model for each pool: the parent must not run inference before forking
+        with WorkerPool(load_model(model_location, backend='auto'), workers) as pool:
+            pool.map(pairs)
+            times = []
+            for i in range(n):
+                t1 = time.time()
+                pool.map(pairs)
+                times.append(time.time() - t1)
+        throughput = len(pairs) / statistics.mean(times)
+        base = base or throughput
+        print('%-25s    %.1f pairs/s  Speedup: %.2fx' % ('workers=%d' % workers, throughput, throughput / base))
+
+
+def saved_bytes(model, samples):
+    # bytes of the tensors autograd keeps for the backward of one training batch, i.e. the activation memory,
+    # then runs the backward
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    model.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = model.batch_output(samples).logsumexp(dim=2).sum()
+    loss.backward()
+    return sum(storages.values())
+
+
+def measure_checkpointing(model_location, samples, n):
+    # activation memory and forward + backward time of a training batch with and without checkpoint_rounds,
+    # with the pairs grouped by their number of edges
+    model = load_model(model_location)
+    buckets = {}
+    for sample in samples:
+        edges = max(len(side[2]) for side in sample)
+        bucket = 1
+        while bucket < edges:
+            bucket *= 2
+        buckets.setdefault(bucket, []).append(sample)
+
+    print('%-25s%14s%14s%14s%14s' % ('edges <= (pairs)', 'saved', 'checkpointed', 'time', 'checkpointed'))
+    for bucket in sorted(buckets):
+        memory = []
+        times = []
+        for checkpoint_rounds in [False, True]:
+            model.checkpoint_rounds = checkpoint_rounds
+            memory.append(saved_bytes(model, buckets[bucket]))
+            t1 = time.time()
+            for i in range(n):
+                saved_bytes(model, buckets[bucket])
+            times.append((time.time() - t1) / n)
+        print('%-25s%11.1f KB%11.1f KB%11.3f ms%11.3f ms' % ('%d (%d)' % (bucket, len(buckets[bucket])),
+              memory[0] / 1024, memory[1] / 1024, times[0] * 1000, times[1] * 1000))
+    model.checkpoint_rounds = False
+
+
+def graph_sizes(samples):
+    nodes = [len(side[0]) for sample in samples for side in sample]
+    edges = [len(side[2]) for sample in samples for side in sample]
+    print('%d pairs, nodes per graph: mean %.1f max %d, edges per graph: mean %.1f max %d' % (
+        len(samples), statistics.mean(nodes), max(nodes), statistics.mean(edges), max(edges)))
+
+
+NUM_RUNS = 5
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: %s <model.pt> <pairs manifest>" % sys.argv[0])
+        sys.exit(1)
+
+    model = load_model(sys.argv[1])
+    samples = [load_pair(entry['inc_ast'], entry['cor_ast']) for entry in read_manifest(sys.argv[2])]
+    graph_sizes(samples)
+
+    # first, before this process runs any inference (see worker_pool.py)
+    measure_worker_pool(sys.argv[1], list(read_manifest(sys.argv[2])), NUM_RUNS)
+    print()
+
+    numpy_weights = os.path.join(tempfile.mkdtemp(), 'model.npz')
+    export(model, numpy_weights)
+
+    backend_models = [(backend, load_model(sys.argv[1], backend=backend)) for backend in backends]
+    engines = [("eager", model),
+               ("frozen", FrozenMapper(freeze(model))),
+               ("numpy", load_model(numpy_weights))]
+    engines += [("eager-" + name, backend_model) for name, backend_model in backend_models]
+
+    with torch.no_grad():
+        for name, engine in engines:
+            measure_engine(name, engine, samples, NUM_RUNS)
+
+        print()
+        measure_backends_by_size(backend_models, samples, NUM_RUNS)
+
+        print()
+        measure_early_exit(sys.argv[1], samples, [0.05, 0.2], NUM_RUNS)
+
+        print()
+        measure_pruning(engines[:3], list(read_manifest(sys.argv[2])), NUM_RUNS)
+
+        print()
+        measure_incremental(sys.argv[1], samples, NUM_RUNS)
+
+        print()
+        measure_tiered(engines[:3], list(read_manifest(sys.argv[2])), NUM_RUNS)
+
+        if len(sys.argv) > 3:
+            print()
+            measure_ensemble(sys.argv[1:2] + sys.argv[3:], list(read_manifest(sys.argv[2])), NUM_RUNS)
+
+    print()
+    print('training with checkpoint_rounds')
+    measure_checkpointing(sys.argv[1], samples, NUM_RUNS)
+
+    print()
+    print('eval.py startup + one pair')
+    measure_startup([("torch (.pt)", sys.argv[1]), ("numpy (.npz)", numpy_weights)], next(read_manifest(sys.argv[2])), NUM_RUNS)
+
+    print()
+    print('eval.py --precision with --embedding_store')
+    measure_precision_store(sys.argv[1], sys.argv[2], next(read_manifest(sys.argv[2])), NUM_RUNS)
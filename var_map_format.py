@@ -0,0 +1,112 @@
+import argparse
+from sys import argv
+import gzip
+import os
+import pickle
+import struct
+import numpy as np
+
+# Compact file format of the variable mapping distributions (eval.py writes it for paths ending in .vmd):
+#   b"VMD1", the number of left and right variables (two little-endian uint32), the [left vars, right vars]
+#   float32 score matrix, and then the left and the right variable names (utf-8, one per line)
+# Any other path is the legacy gzipped pickle of {left var: ([[scores]], right vars)}, which is still read.
+magic = b"VMD1"
+compact_extension = ".vmd"
+header = struct.Struct("<4sII")
+
+
+class VarMapDistributions:
+    # one score matrix instead of a ([[scores]], right vars) tuple per left variable. Reading it like a dict
+    # (d[k][0][0], d[k][1], keys()) gives the legacy layout, so code written against the pickles keeps working.
+
+    def __init__(self, scores, vars_left, vars_right):
+        self.vars_left = list(vars_left)
+        self.vars_right = list(vars_right)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(len(self.vars_left), len(self.vars_right))
+        self.rows = {k: e for e, k in enumerate(self.vars_left)}
+
+    @classmethod
+    def from_dict(cls, d):
+        if isinstance(d, cls):
+            return d
+        vars_left = list(d.keys())
+        vars_right = d[vars_left[0]][1] if vars_left else []
+        return cls([d[k][0][0] for k in vars_left], vars_left, vars_right)
+
+    def to_dict(self):
+        return {k: ([self.scores[e].tolist()], self.vars_right) for e, k in enumerate(self.vars_left)}
+
+    def softmax(self):
+        # row-wise, in float64 like the legacy per-variable softmax of prog_fixer.py
+        scores = self.scores.astype(np.float64)
+        exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def keys(self):
+        return list(self.vars_left)
+
+    def items(self):
+        return [(k, self[k]) for k in self.vars_left]
+
+    def __getitem__(self, k):
+        return ([self.scores[self.rows[k]].tolist()], self.vars_right)
+
+    def __contains__(self, k):
+        return k in self.rows
+
+    def __iter__(self):
+        return iter(self.vars_left)
+
+    def __len__(self):
+        return len(self.vars_left)
+
+    def tobytes(self):
+        names = "\n".join(self.vars_left + self.vars_right).encode()
+        return header.pack(magic, len(self.vars_left), len(self.vars_right)) + self.scores.tobytes() + names
+
+    @classmethod
+    def frombytes(cls, data):
+        _, num_left, num_right = header.unpack_from(data)
+        end = header.size + 4 * num_left * num_right
+        scores = np.frombuffer(data, dtype=np.float32, count=num_left * num_right, offset=header.size)
+        names = data[end:].decode().split("\n") if num_left + num_right else []
+        return cls(scores, names[:num_left], names[num_left:])
+
+
+def write_var_map(var_map, path):
+    if path.endswith(compact_extension):
+        with open(path, 'wb') as f:
+            f.write(VarMapDistributions.from_dict(var_map).tobytes())
+        return
+
+    if isinstance(var_map, VarMapDistributions):
+        var_map = var_map.to_dict()
+    with gzip.open(path, 'wb') as f:
+        pickle.dump(var_map, f)
+
+
+def read_var_map(path):
+    # the format is told by the file's first bytes, so renamed files are read correctly too
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(magic)] == magic:
+        return VarMapDistributions.frombytes(data)
+    return pickle.loads(gzip.decompress(data))
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='var_map_format.py', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-i', '--input', nargs='+', help='Variable mapping distributions to convert (gzipped pickles).')
+    parser.add_argument('-r', '--remove', action='store_true', default=False, help='Removes every input once converted.')
+    args = parser.parse_args(argv[1:])
+    return args
+
+
+if __name__ == "__main__":
+    # converts legacy distributions in place: var_map_distributions-x.pkl.gz -> var_map_distributions-x.vmd
+    args = parser()
+    for path in args.input:
+        output = (path[:-len(".pkl.gz")] if path.endswith(".pkl.gz") else path) + compact_extension
+        write_var_map(read_var_map(path), output)
+        if args.remove:
+            os.remove(path)
@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+from tune_parallelism import available_cores, load_profile
+
+# Pool of mapping processes forked once the model is loaded, for bulk mapping (eval.py --manifest --workers).
+# The workers inherit the model from the fork: the weights of a torch model are moved to shared memory first and
+# the arrays of the NumPy engine are shared copy-on-write, so they are in memory once whatever the number of
+# workers. Every worker is pinned to its own slice of the cores and runs as many torch threads as it has cores.
+# The pool must be created before the parent runs any torch inference: OpenMP thread pools do not survive a fork.
+
+# the model of the workers, set in the parent right before forking
+_model = None
+_core_slices = None
+_next_slice = None
+
+
+def core_slices(workers, cores=None):
+    # splits the cores this process may run on into {workers} slices of (almost) the same size
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(available_cores()))
+    workers = min(workers, len(cores))
+    return [cores[i * len(cores) // workers:(i + 1) * len(cores) // workers] for i in range(workers)]
+
+
+def _pin_worker():
+    with _next_slice.get_lock():
+        cores = _core_slices[_next_slice.value % len(_core_slices)]
+        _next_slice.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    if not getattr(_model, "as_array", None):
+        import torch
+        torch.set_num_threads(len(cores))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+
+
+def _map_chunk(pairs):
+    from eval import load_pair, no_grad, pruning_hops, rounds_used
+
+    samples = [load_pair(left_ast_file, right_ast_file, getattr(_model, "as_array", None), pruning_hops(_model)) for left_ast_file, right_ast_file in pairs]
+    with no_grad(_model):
+        results = _model.predict_batch(samples)
+    # with gnn.EarlyExit, the rounds of every pair go back to the parent along with the mappings, and so do the
+    # counts of a tiered_mapper.TieredMapper
+    return results, rounds_used(_model, len(samples)), _model.take_counts() if hasattr(_model, "take_counts") else None
+
+
+class WorkerPool:
+
+    def __init__(self, model, workers=None, chunksize=8):
+        global _model, _core_slices, _next_slice
+
+        if not workers:
+            workers = load_profile()["mapping_workers"] or available_cores()
+        if hasattr(model, "share_memory"):
+            model.share_memory()
+
+        _model = model
+        _core_slices = core_slices(workers)
+        _next_slice = multiprocessing.Value("i", 0)
+        self.model = model
+        # the parent's EarlyExit runs nothing, it collects the rounds of the workers (eval.rounds_used reads it)
+        self.early_exit = getattr(model, "early_exit", None)
+        # and a TieredMapper sums their counts (for its report)
+        self.tiered = model if hasattr(model, "add_counts") else None
+        self.workers = len(_core_slices)
+        self.chunksize = chunksize
+        self.pool = multiprocessing.get_context("fork").Pool(self.workers, initializer=_pin_worker)
+
+    def map(self, pairs):
+        # the (var_map, var_map_dist) of every (incorrect AST file, correct AST file) pair, in order
+        pairs = list(pairs)
+        chunks = [pairs[i:i + self.chunksize] for i in range(0, len(pairs), self.chunksize)]
+        results = []
+        for chunk_results, rounds, counts in self.pool.imap(_map_chunk, chunks):
+            results += chunk_results
+            if rounds is not None and self.early_exit is not None:
+                self.early_exit.rounds += rounds
+            if counts is not None and self.tiered is not None:
+                self.tiered.add_counts(counts)
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()